@@ -0,0 +1,732 @@
+"""
+Benchmarks the stages of the apk and install commands on synthetic
+inputs, without the Android sdk, Gradle or a device.
+
+The benchmark generates source trees of different sizes, a template
+repository with REPLACE markers that is served from a local bare git
+repository and stand-in gradlew, adb and emulator scripts. It then runs
+build.py for every scenario and reads the phase timings from the timing
+trace of the command. The results are written as JSON and can be
+compared against the results of an earlier run to find slowdowns:
+
+    python benchmarks/benchmark.py run --output results.json
+    python benchmarks/benchmark.py compare baseline.json results.json
+
+The stand-in tools are Python scripts with a shebang line,
+so the benchmark only runs on POSIX systems.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import platform
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+from argparse import ArgumentParser
+from datetime import datetime
+from time import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_ID = 'com.pytoapk.benchmark'
+TEMPLATE_PACKAGE = 'com.apython.python.apython_pyapp'
+# The formatting arguments of the benchmark app, as filled into the template.
+FILL_VALUES = {'appName': 'Benchmark App', 'appLogTag': 'Benchmark', 'appId': APP_ID}
+
+# Stand-in for the gradle wrapper, it writes an apk for every assemble task.
+GRADLEW_SCRIPT = '''#!{python}
+import os, sys
+for task in sys.argv[1:]:
+    if task.startswith('assemble'):
+        buildType = task[len('assemble'):].lower()
+        outputDir = os.path.join('app', 'build', 'outputs', 'apk', buildType)
+        if not os.path.isdir(outputDir):
+            os.makedirs(outputDir)
+        name = 'app-debug.apk' if buildType == 'debug' else 'app-' + buildType + '-unsigned.apk'
+        with open(os.path.join(outputDir, name), 'wb') as apk:
+            apk.write(os.urandom({apkSize}))
+        print('> Task :app:' + task)
+'''
+
+# Stand-in for adb. The connected devices are the files in the device directory,
+# a device finishes booting 'bootDelay' seconds after its file was created.
+ADB_SCRIPT = '''#!{python}
+import os, sys, time
+deviceDir = {deviceDir!r}
+bootDelay = {bootDelay!r}
+args = sys.argv[1:]
+device = None
+if args[:1] == ['-s']:
+    device, args = args[1], args[2:]
+devicePath = os.path.join(deviceDir, device or '')
+
+def isBooted():
+    try:
+        return time.time() - os.path.getmtime(devicePath) >= bootDelay
+    except OSError:
+        return False
+
+def runShellCommand(command):
+    if 'sys.boot_completed' in command:
+        return '1' if isBooted() else ''
+    if command.startswith('echo '):
+        return command[len('echo '):].replace('""', '')
+    if 'ro.build.version.sdk' in command:
+        return '29'
+    return None
+
+if args[0] == 'devices':
+    print('List of devices attached')
+    for name in sorted(os.listdir(deviceDir)):
+        # A device file can contain another state than 'device', e.g. 'offline'
+        with open(os.path.join(deviceDir, name)) as deviceFile:
+            print(name + '\\t' + (deviceFile.read().strip() or 'device'))
+    print('')
+elif args[0] == 'wait-for-device':
+    while not os.path.exists(devicePath):
+        time.sleep(0.01)
+elif args[0] == 'emu':
+    os.remove(devicePath)
+elif args[0] == 'install':
+    print('Performing Streamed Install')
+    print('Success')
+elif args[0] == 'shell' and len(args) > 1:
+    output = runShellCommand(' '.join(args[1:]))
+    if output is not None:
+        print(output)
+elif args[0] == 'shell':
+    for line in iter(sys.stdin.readline, ''):
+        for command in line.strip().split('; '):
+            output = runShellCommand(command)
+            if output is not None:
+                print(output)
+        sys.stdout.flush()
+'''
+
+# Stand-in for the emulator, it connects a device until it is killed through adb.
+EMULATOR_SCRIPT = '''#!{python}
+import os, sys, time
+port = sys.argv[sys.argv.index('-port') + 1]
+devicePath = os.path.join({deviceDir!r}, 'emulator-' + port)
+open(devicePath, 'w').close()
+while os.path.exists(devicePath):
+    time.sleep(0.05)
+'''
+
+MAIN_PY = '''import sys
+
+def main():
+    print('Hello from the benchmark app')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+'''
+
+
+class Benchmark(object):
+    """Generates the synthetic inputs of the benchmark and runs the scenarios."""
+    workDir = None
+    sizes = None
+    repeat = 3
+    templateFiles = 200
+    numDevices = 8
+    bootDelay = 0.5
+    apkSize = 1024 * 1024
+    precompile = True
+    seed = 0
+    sdkDir = None
+    deviceDir = None
+    poolDir = None
+    templateGit = None
+    templateDir = None
+    pinnedCommit = None
+    filledFiles = None
+
+    def __init__(self, workDir, sizes):
+        self.workDir = workDir
+        self.sizes = sizes
+        self.sdkDir = os.path.join(workDir, 'sdk')
+        self.deviceDir = os.path.join(workDir, 'devices')
+        self.poolDir = os.path.join(workDir, 'emulators')
+        self.templateGit = os.path.join(workDir, 'template.git')
+        self.templateDir = os.path.join(workDir, 'template')
+
+    @staticmethod
+    def writeScript(path, content):
+        """>>> writeScript(path, content)
+        Write an executable script to 'path'.
+        """
+        dirPath = os.path.dirname(path)
+        if not os.path.isdir(dirPath):
+            os.makedirs(dirPath)
+        with open(path, 'w') as scriptFile:
+            scriptFile.write(content)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+    @staticmethod
+    def generatePythonFile(rand, size):
+        """>>> generatePythonFile(rand, size) -> source code
+        Returns a valid Python module of about 'size' bytes
+        with docstrings, comments and functions.
+        """
+        parts = ['"""Generated module for the benchmark."""\n\n']
+        length = len(parts[0])
+        index = 0
+        while length < size:
+            part = ('# Helper number {index}\ndef function{index}(value):\n'
+                    '    """Returns the value scaled by {factor}."""\n'
+                    '    return value * {factor} + {offset}\n\n\n').format(
+                index=index, factor=rand.randint(1, 1000), offset=rand.randint(0, 1000))
+            parts.append(part)
+            length += len(part)
+            index += 1
+        return ''.join(parts)
+
+    def generateSourceTree(self, path, numFiles):
+        """>>> generateSourceTree(path, numFiles)
+        Generate a source tree with 'numFiles' files of assorted
+        sizes: Mostly small Python modules, some larger modules and
+        some binary data files, spread over nested packages.
+        """
+        rand = random.Random(self.seed + numFiles)
+        os.makedirs(path)
+        with open(os.path.join(path, 'main.py'), 'w') as mainFile:
+            mainFile.write(MAIN_PY)
+        with open(os.path.join(path, 'setup.cfg'), 'w') as configFile:
+            configFile.write('[android_app]\napp_name = {appName}\napp_tag = {appLogTag}\n'
+                             'app_id = {appId}\napp_num_version = 1\nmin_python_version = 2.7\n'
+                             'app_window_type = TERMINAL\napp_min_sdk = 9\n'.format(**FILL_VALUES))
+        for index in range(max(0, numFiles - 2)):
+            packagePath = os.path.join(path, 'pkg{0}'.format(index // 400),
+                                       'sub{0}'.format(index // 20 % 20))
+            if not os.path.isdir(packagePath):
+                os.makedirs(packagePath)
+                open(os.path.join(packagePath, '__init__.py'), 'w').close()
+            kind = rand.random()
+            if kind < 0.9:
+                size = rand.randint(200, 4 * 1024) if kind < 0.75 else \
+                    rand.randint(4 * 1024, 64 * 1024)
+                with open(os.path.join(packagePath, 'module{0}.py'.format(index)), 'w') as f:
+                    f.write(self.generatePythonFile(rand, size))
+            else:
+                with open(os.path.join(packagePath, 'data{0}.bin'.format(index)), 'wb') as f:
+                    f.write(os.urandom(rand.randint(1024, 256 * 1024)))
+
+    def generateTemplate(self):
+        """>>> generateTemplate()
+        Generate the template repository and publish it in a local bare
+        repository. The expected content of the template files after they
+        are filled is remembered in 'filledFiles'. The branch has a second
+        commit, which only adds a file, and the first is the pinned commit.
+        """
+        rand = random.Random(self.seed)
+        self.filledFiles = {}
+        templateDir = os.path.join(self.workDir, 'template-src')
+        mainDir = os.path.join(templateDir, 'app', 'src', 'main')
+        javaDir = os.path.join(mainDir, 'java', TEMPLATE_PACKAGE)
+        for path in [javaDir, os.path.join(mainDir, 'python'),
+                     os.path.join(mainDir, 'res', 'drawable-mdpi')]:
+            os.makedirs(path)
+        with open(os.path.join(mainDir, 'AndroidManifest.xml'), 'w') as manifest:
+            line = '<manifest package="{package}">'.format(package=TEMPLATE_PACKAGE)
+            # The columns of replace commands start at 1
+            start = line.index(TEMPLATE_PACKAGE) + 1
+            comment = ' <!-- REPLACE({start}, {end}): appId -->\n</manifest>\n'.format(
+                start=start, end=start + len(TEMPLATE_PACKAGE))
+            manifest.write(line + comment)
+            self.filledFiles['app/src/main/AndroidManifest.xml'] = \
+                line.replace(TEMPLATE_PACKAGE, FILL_VALUES['appId']) + comment
+        with open(os.path.join(mainDir, 'python', 'main.py'), 'w') as mainFile:
+            mainFile.write(MAIN_PY)
+        with open(os.path.join(mainDir, 'res', 'drawable-mdpi', 'app_launcher_icon.png'),
+                  'wb') as icon:
+            icon.write(os.urandom(2048))
+        for index in range(self.templateFiles):
+            lines = ['package {package};'.format(package=TEMPLATE_PACKAGE),
+                     'class Generated{index} {{'.format(index=index)]
+            filledLines = list(lines)
+            for lineIndex in range(rand.randint(20, 200)):
+                if index % 4 == 0 and lineIndex % 10 == 0:
+                    line = '    String name{0} = "placeholder";'.format(lineIndex)
+                    start = line.index('placeholder') + 1
+                    key = ['appName', 'appLogTag', 'appId'][lineIndex // 10 % 3]
+                    comment = ' // REPLACE({start}, {end}): {key}'.format(
+                        start=start, end=start + len('placeholder'), key=key)
+                    lines.append(line + comment)
+                    filledLines.append(line.replace('placeholder', FILL_VALUES[key]) + comment)
+                else:
+                    line = '    int value{0} = {1};'.format(lineIndex, rand.randint(0, 1000))
+                    lines.append(line)
+                    filledLines.append(line)
+            lines.append('}')
+            filledLines.append('}')
+            fileName = 'Generated{0}.java'.format(index)
+            with open(os.path.join(javaDir, fileName), 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            # The filler moves the java package directory to the app id
+            self.filledFiles['app/src/main/java/{package}/{name}'.format(
+                package=FILL_VALUES['appId'], name=fileName)] = '\n'.join(filledLines) + '\n'
+        self.writeScript(os.path.join(templateDir, 'gradlew'), GRADLEW_SCRIPT.format(
+            python=sys.executable, apkSize=self.apkSize))
+        gitEnv = dict(os.environ, GIT_AUTHOR_NAME='Benchmark', GIT_COMMITTER_NAME='Benchmark',
+                      GIT_AUTHOR_EMAIL='benchmark@localhost',
+                      GIT_COMMITTER_EMAIL='benchmark@localhost')
+        with open(os.devnull, 'w') as devNull:
+            for args in [['git', 'init', '-q', templateDir],
+                         ['git', '-C', templateDir, 'checkout', '-q', '-b', 'main'],
+                         ['git', '-C', templateDir, 'add', '-A'],
+                         ['git', '-C', templateDir, 'commit', '-q', '-m', 'Template']]:
+                subprocess.check_call(args, env=gitEnv, stdout=devNull)
+            self.pinnedCommit = getGitRevision(templateDir)
+            with open(os.path.join(templateDir, 'NOTES.md'), 'w') as notesFile:
+                notesFile.write('Generated by the benchmark.\n')
+            for args in [['git', '-C', templateDir, 'add', '-A'],
+                         ['git', '-C', templateDir, 'commit', '-q', '-m', 'Notes'],
+                         ['git', 'clone', '-q', '--bare', templateDir, self.templateGit]]:
+                subprocess.check_call(args, env=gitEnv, stdout=devNull)
+
+    def generateTools(self):
+        """>>> generateTools()
+        Generate the stand-in adb and emulator scripts in the sdk directory.
+        """
+        os.makedirs(self.deviceDir)
+        self.writeScript(os.path.join(self.sdkDir, 'platform-tools', 'adb'), ADB_SCRIPT.format(
+            python=sys.executable, deviceDir=self.deviceDir, bootDelay=self.bootDelay))
+        self.writeScript(os.path.join(self.sdkDir, 'tools', 'emulator'), EMULATOR_SCRIPT.format(
+            python=sys.executable, deviceDir=self.deviceDir))
+
+    def setDevices(self, devices):
+        """>>> setDevices(devices)
+        Connect exactly the given devices, which have already finished booting.
+        """
+        for name in os.listdir(self.deviceDir):
+            os.remove(os.path.join(self.deviceDir, name))
+        bootedTime = time() - self.bootDelay - 1
+        for name in devices:
+            path = os.path.join(self.deviceDir, name)
+            open(path, 'w').close()
+            os.utime(path, (bootedTime, bootedTime))
+
+    def runCommand(self, name, sourceDir, args):
+        """>>> runCommand(name, sourceDir, args) -> (wall time, phases)
+        Run build.py with the arguments and return its wall time
+        and the total wall time of each phase of its timing trace.
+        """
+        configPath = os.path.join(self.workDir, 'config.cfg')
+        with open(configPath, 'w') as configFile:
+            configFile.write('[General]\nlogLevel = warn\n[Paths]\ngitPath = git\n'
+                             'sdkPath = {sdk}\n[apk]\ntemplateGit = {git}\nsourceDir = {source}\n'
+                             'buildDebug = true\ntemplateCheckInterval = 86400\n[install]\n'
+                             'skipUnchanged = true\n[emulators]\navds = pool_a pool_b\n'
+                             'idleTimeout = 86400\nstateDir = {pool}\n'.format(
+                                 sdk=self.sdkDir, git=self.templateGit, source=sourceDir,
+                                 pool=self.poolDir))
+        tracePath = os.path.join(self.workDir, 'trace.json')
+        logPath = os.path.join(self.workDir, name + '.log')
+        command = [sys.executable, os.path.join(REPO_DIR, 'build.py'),
+                   '--configFile', configPath, '--logFile', logPath,
+                   '--buildDir', os.path.join(self.workDir, 'build'),
+                   '--outputDir', os.path.join(self.workDir, 'output'),
+                   '--templateDir', self.templateDir,
+                   '--traceFile', tracePath] + args
+        startTime = time()
+        with open(os.devnull, 'w') as devNull:
+            returnCode = subprocess.call(command, cwd=self.workDir, stdout=devNull,
+                                         stderr=subprocess.STDOUT)
+        duration = time() - startTime
+        if returnCode != 0:
+            raise RuntimeError('Scenario {name} failed, see {log}'.format(name=name, log=logPath))
+        with open(tracePath) as traceFile:
+            events = json.load(traceFile)['traceEvents']
+        phases = {}
+        for event in events:
+            phases[event['name']] = phases.get(event['name'], 0) + event['dur'] / 1e6
+        return duration, phases
+
+    def checkFilledTemplate(self, name):
+        """>>> checkFilledTemplate(name)
+        Check that the apk command filled the template files in
+        the build directory with the arguments of the benchmark app.
+        """
+        buildDir = os.path.join(self.workDir, 'build', 'apk')
+        for relPath, expected in sorted(self.filledFiles.items()):
+            with open(os.path.join(buildDir, relPath.replace('/', os.path.sep))) as filledFile:
+                if filledFile.read() != expected:
+                    raise RuntimeError('Scenario {name} filled {path} incorrectly'.format(
+                        name=name, path=relPath))
+
+    def loadPoolState(self):
+        """>>> loadPoolState() -> dict of avd name to emulator entry
+        Returns the state of the emulator pool.
+        """
+        statePath = os.path.join(self.poolDir, 'pool.json')
+        if not os.path.isfile(statePath):
+            return {}
+        with open(statePath) as stateFile:
+            return json.load(stateFile)
+
+    def savePoolState(self, state):
+        with open(os.path.join(self.poolDir, 'pool.json'), 'w') as stateFile:
+            json.dump(state, stateFile)
+
+    def getPoolScenarios(self, installArgs):
+        """>>> getPoolScenarios(installArgs) -> list of scenarios
+        Returns the scenarios of the emulator pool: Leasing a new
+        emulator, reusing it, recovering the lease of an exited install
+        command, restarting an emulator that does not respond and
+        stopping the pool. Each check verifies the state of the pool.
+        """
+        expected = {}
+
+        def checkPool(name, numEmulators, samePids):
+            state = self.loadPoolState()
+            pids = dict((avd, entry['pid']) for avd, entry in state.items())
+            if len(state) != numEmulators or \
+                    any(entry['leasedBy'] is not None for entry in state.values()) or \
+                    any(not isProcessAlive(pid) for pid in pids.values()) or \
+                    samePids is not None and (pids == expected.get('pids')) != samePids:
+                raise RuntimeError('Scenario {name} left the emulator pool in an unexpected '
+                                   'state: {state}'.format(name=name, state=state))
+            expected['pids'] = pids
+
+        def stopPool():
+            self.runCommand('pool-setup', None, ['emulators', 'stop'])
+            self.setDevices([])
+
+        def expireLeases():
+            state = self.loadPoolState()
+            deadProcess = subprocess.Popen([sys.executable, '-c', ''])
+            deadProcess.wait()
+            for entry in state.values():
+                entry['leasedBy'] = deadProcess.pid
+            self.savePoolState(state)
+
+        def hangEmulators():
+            state = self.loadPoolState()
+            for entry in state.values():
+                entry['started'] = 0  # The emulator has finished booting
+                with open(os.path.join(self.deviceDir, entry['device']), 'w') as deviceFile:
+                    deviceFile.write('offline')
+            self.savePoolState(state)
+
+        def startPool():
+            self.runCommand('pool-setup', None, ['emulators', 'start', 'pool_a'])
+            expected['pids'] = dict((avd, entry['pid'])
+                                    for avd, entry in self.loadPoolState().items())
+
+        def checkStopped(name, phases):
+            if len(self.loadPoolState()) != 0 or \
+                    any(isProcessAlive(pid) for pid in expected['pids'].values()):
+                raise RuntimeError('Scenario {name} did not stop the emulators of the pool'
+                                   .format(name=name))
+
+        return [
+            ('pool-lease-new', stopPool, installArgs,
+             lambda name, phases: checkPool(name, 1, None)),
+            ('pool-lease-reuse', lambda: None, installArgs,
+             lambda name, phases: checkPool(name, 1, True)),
+            ('pool-stale-lease', expireLeases, installArgs,
+             lambda name, phases: checkPool(name, 1, True)),
+            ('pool-restart', hangEmulators, installArgs,
+             lambda name, phases: checkPool(name, 1, False)),
+            ('pool-stop', startPool, ['emulators', 'stop'], checkStopped),
+        ]
+
+    def getTemplateScenarios(self, sourceArgs):
+        """>>> getTemplateScenarios(sourceArgs) -> list of scenarios
+        Returns the scenarios of the template checkout: Checking an
+        existing checkout for updates with 'git ls-remote' and cloning
+        it shallow, from a mirror and at a pinned commit.
+        """
+        checkoutDir = os.path.join(self.templateDir, 'apk')
+        gitDir = os.path.join(checkoutDir, '.git')
+        mirrorDir = os.path.join(self.workDir, 'template-mirror')
+        startTime = {}
+
+        def prepareCheckout():
+            if not os.path.isdir(gitDir):
+                self.runCommand('template-setup', sourceArgs[1], ['apk'] + sourceArgs)
+            startTime['value'] = time()
+
+        def checkFreshness(name, phases):
+            with open(os.path.join(gitDir, 'pytoapk-freshness.json')) as recordFile:
+                checked = json.load(recordFile)['checked']
+            fetchHeadPath = os.path.join(gitDir, 'FETCH_HEAD')
+            if checked < startTime['value'] or os.path.isfile(fetchHeadPath) and \
+                    os.path.getmtime(fetchHeadPath) >= startTime['value']:
+                raise RuntimeError('Scenario {name} did not check the unchanged template '
+                                   'without fetching'.format(name=name))
+
+        def removeCheckout():
+            shutil.rmtree(checkoutDir, ignore_errors=True)
+
+        def checkShallow(name, phases):
+            if not os.path.isfile(os.path.join(gitDir, 'shallow')):
+                raise RuntimeError('Scenario {name} did not create a shallow clone'
+                                   .format(name=name))
+
+        def checkMirror(name, phases):
+            if not os.path.isfile(os.path.join(mirrorDir, 'HEAD')) or not os.path.isfile(
+                    os.path.join(gitDir, 'objects', 'info', 'alternates')):
+                raise RuntimeError('Scenario {name} did not clone the template from the mirror'
+                                   .format(name=name))
+
+        def checkPinned(name, phases):
+            if getGitRevision(checkoutDir) != self.pinnedCommit:
+                raise RuntimeError('Scenario {name} did not check out the pinned commit'
+                                   .format(name=name))
+
+        return [
+            ('template-freshness', prepareCheckout,
+             ['apk', '--templateCheckInterval', '0'] + sourceArgs, checkFreshness),
+            ('template-shallow', removeCheckout,
+             ['apk', '--templateDepth', '1'] + sourceArgs, checkShallow),
+            ('template-mirror', removeCheckout,
+             ['apk', '--templateMirror', mirrorDir] + sourceArgs, checkMirror),
+            ('template-pinned', removeCheckout,
+             ['apk', '--templateRef', self.pinnedCommit] + sourceArgs, checkPinned),
+        ]
+
+    @staticmethod
+    def checkRebuilt(name, phases):
+        """>>> checkRebuilt(name, phases)
+        Check that the apk command updated the changed Python
+        sources and built the apk again, with Gradle or by repacking.
+        """
+        if 'python sources' not in phases or not ('gradle' in phases or 'repack' in phases):
+            raise RuntimeError('Scenario {name} did not rebuild the apk after the sources '
+                               'changed'.format(name=name))
+
+    def getScenarios(self, sourceDirs):
+        """>>> getScenarios(sourceDirs) -> list of (name, setup, build.py arguments, check)
+        Returns the scenarios of the benchmark. The setup function
+        is called before every run of the scenario and the check
+        function, if not None, with the phases of every run.
+        """
+        noSetup = lambda: None
+        scenarios = []
+        for size, sourceDir in sorted(sourceDirs.items()):
+            sourceArgs = ['--sourceDir', sourceDir]
+            scenarios.append(('apk-clean-{size}'.format(size=size), noSetup,
+                              ['apk', '--clean'] + sourceArgs, None))
+            scenarios.append(('apk-unchanged-{size}'.format(size=size), noSetup,
+                              ['apk'] + sourceArgs, None))
+
+            def touchSources(sourceDir=sourceDir):
+                sourcePaths = []
+                for dirPath, _, fileNames in os.walk(sourceDir):
+                    sourcePaths += [os.path.join(dirPath, fileName) for fileName in fileNames
+                                    if fileName.endswith('.py')]
+                rand = random.Random(self.seed)
+                for path in rand.sample(sorted(sourcePaths), max(1, len(sourcePaths) // 100)):
+                    with open(path, 'a') as sourceFile:
+                        sourceFile.write('\n# Changed at {0}\n'.format(time()))
+            scenarios.append(('apk-changed-{size}'.format(size=size), touchSources,
+                              ['apk'] + sourceArgs, self.checkRebuilt))
+            if self.precompile:
+                scenarios.append(('apk-precompile-{size}'.format(size=size), noSetup,
+                                  ['apk', '--clean', '--precompile', '--precompileInterpreters',
+                                   sys.executable] + sourceArgs, None))
+        apkPath = os.path.join(self.workDir, 'output', 'apk', 'app-debug.apk')
+        installArgs = ['install', '--apkPath', apkPath, '--package', APP_ID, '--force']
+        devices = ['device{0:02d}'.format(index) for index in range(self.numDevices)]
+        scenarios.append(('install-select', lambda: self.setDevices(['device00']),
+                          installArgs, None))
+        scenarios.append(('install-all-devices', lambda: self.setDevices(devices),
+                          installArgs + ['--allDevices'], None))
+        scenarios.append(('install-boot', lambda: self.setDevices([]),
+                          installArgs + ['--emulator', 'benchmark', '--device', 'emulator-5580'],
+                          None))
+        scenarios += self.getPoolScenarios(installArgs)
+        scenarios += self.getTemplateScenarios(['--sourceDir', sourceDirs[min(sourceDirs)]])
+        return scenarios
+
+    def run(self, scenarioFilter=None):
+        """>>> run(scenarioFilter) -> results
+        Generate the inputs and run every scenario 'repeat' times.
+        The results contain the median wall time of the command
+        and of every phase for each scenario.
+        """
+        print('Generating the benchmark inputs in {path}...'.format(path=self.workDir))
+        self.generateTemplate()
+        self.generateTools()
+        sourceDirs = {}
+        for size in self.sizes:
+            sourceDirs[size] = os.path.join(self.workDir, 'source-{size}'.format(size=size))
+            self.generateSourceTree(sourceDirs[size], size)
+        results = {}
+        try:
+            for name, setup, args, check in self.getScenarios(sourceDirs):
+                if scenarioFilter is not None and \
+                        not any(pattern in name for pattern in scenarioFilter):
+                    continue
+                durations = []
+                phases = {}
+                for _ in range(self.repeat):
+                    setup()
+                    duration, runPhases = self.runCommand(name, sourceDirs.get(
+                        self.sizes[0]), args)
+                    if args[0] == 'apk':
+                        self.checkFilledTemplate(name)
+                    if check is not None:
+                        check(name, runPhases)
+                    durations.append(duration)
+                    for phase, phaseDuration in runPhases.items():
+                        phases.setdefault(phase, []).append(phaseDuration)
+                results[name] = {
+                    'wall': median(durations),
+                    'phases': dict((phase, median(values)) for phase, values in phases.items()),
+                }
+                print('{name:<28} {wall:8.3f}s'.format(name=name, wall=results[name]['wall']))
+        finally:
+            self.setDevices([])  # Stop the stand-in emulators
+        return results
+
+
+def isProcessAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def getGitRevision(repoDir=REPO_DIR):
+    try:
+        with open(os.devnull, 'w') as devNull:
+            return subprocess.check_output(['git', '-C', repoDir, 'rev-parse', 'HEAD'],
+                                           stderr=devNull, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compareResults(baseline, current, threshold, minDelta):
+    """>>> compareResults(baseline, current, threshold, minDelta) -> (table lines, slowdowns)
+    Compare the wall times of the scenarios and phases. A time is a
+    slowdown if it grew by more than 'threshold' percent and by more
+    than 'minDelta' seconds, which filters out noise of short phases.
+    """
+    lines = ['{name:<48} {base:>10} {curr:>10} {change:>8}'.format(
+        name='Scenario / phase', base='Baseline', curr='Current', change='Change')]
+    slowdowns = []
+
+    def compare(name, baseTime, currentTime):
+        change = (currentTime - baseTime) / baseTime * 100 if baseTime > 0 else 0
+        isSlowdown = change > threshold and currentTime - baseTime > minDelta
+        if isSlowdown:
+            slowdowns.append(name)
+        lines.append('{name:<48} {base:>9.3f}s {curr:>9.3f}s {change:>+7.1f}%{flag}'.format(
+            name=name, base=baseTime, curr=currentTime, change=change,
+            flag='  SLOWER' if isSlowdown else ''))
+
+    for scenario, result in sorted(current['results'].items()):
+        baseResult = baseline['results'].get(scenario)
+        if baseResult is None:
+            lines.append('{name:<48} {missing:>10}'.format(name=scenario, missing='new'))
+            continue
+        compare(scenario, baseResult['wall'], result['wall'])
+        for phase, duration in sorted(result['phases'].items()):
+            if phase in baseResult['phases']:
+                compare('  ' + phase, baseResult['phases'][phase], duration)
+    return lines, slowdowns
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    subParsers = parser.add_subparsers(dest='action')
+    runParser = subParsers.add_parser('run', help='Run the benchmark.')
+    runParser.add_argument('--output', default='benchmark-results.json',
+                           help='The path of the JSON file to write the results to.')
+    runParser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000],
+                           help='The number of files in the generated source trees.')
+    runParser.add_argument('--repeat', type=int, default=3,
+                           help='How often every scenario is run, the median is reported.')
+    runParser.add_argument('--scenarios', nargs='+', metavar='NAME',
+                           help='Only run the scenarios whose name contains one of the names.')
+    runParser.add_argument('--devices', type=int, default=8,
+                           help='The number of stand-in devices to install on at the same time.')
+    runParser.add_argument('--bootDelay', type=float, default=0.5,
+                           help='The boot time of the stand-in emulator in seconds.')
+    runParser.add_argument('--noPrecompile', action='store_true',
+                           help='Skip the precompile scenarios.')
+    runParser.add_argument('--workDir', help='The directory for the generated inputs. '
+                                             'Defaults to a temporary directory.')
+    runParser.add_argument('--keep', action='store_true',
+                           help='Keep the generated inputs and build directories.')
+    compareParser = subParsers.add_parser(
+        'compare', help='Compare results against a baseline and exit with code 1 '
+                        'if something became slower.')
+    compareParser.add_argument('baseline', help='The results of the baseline run.')
+    compareParser.add_argument('current', help='The results to compare.')
+    compareParser.add_argument('--threshold', type=float, default=10,
+                               help='The increase in percent above which a time is '
+                                    'reported as a slowdown. Defaults to 10.')
+    compareParser.add_argument('--minDelta', type=float, default=0.05,
+                               help='The minimum increase in seconds for a slowdown, '
+                                    'so short phases don\'t report noise. Defaults to 0.05.')
+    args = parser.parse_args()
+
+    if args.action == 'compare':
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        with open(args.current) as currentFile:
+            current = json.load(currentFile)
+        lines, slowdowns = compareResults(baseline, current, args.threshold, args.minDelta)
+        print('\n'.join(lines))
+        if len(slowdowns) > 0:
+            print('{num} slowdown(s) of more than {threshold}%.'.format(
+                num=len(slowdowns), threshold=args.threshold))
+            return 1
+        print('No slowdowns of more than {threshold}%.'.format(threshold=args.threshold))
+        return 0
+    if args.action != 'run':
+        parser.print_help()
+        return 2
+
+    workDir = args.workDir or tempfile.mkdtemp(prefix='pytoapk-benchmark-')
+    workDir = os.path.abspath(workDir)
+    if os.path.exists(workDir) and len(os.listdir(workDir)) > 0:
+        print('The work directory {path} is not empty.'.format(path=workDir))
+        return 2
+    benchmark = Benchmark(workDir, args.sizes)
+    benchmark.repeat = max(1, args.repeat)
+    benchmark.numDevices = args.devices
+    benchmark.bootDelay = args.bootDelay
+    benchmark.precompile = not args.noPrecompile
+    try:
+        results = benchmark.run(args.scenarios)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workDir, ignore_errors=True)
+    output = {
+        'meta': {
+            'date': datetime.now().isoformat(),
+            'revision': getGitRevision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'sizes': args.sizes,
+            'repeat': benchmark.repeat,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as outputFile:
+        json.dump(output, outputFile, indent=2, sort_keys=True)
+    print('Wrote the results to ' + args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,17 +14,100 @@ import sys
 
 from argparse import ArgumentParser, REMAINDER
 from src.config import Config
+from src.utils.files import mkDirs, resolvePath
 
 
 class PyToApk(object):
     config = None
     commandArgs = None
+    profile = False
+    traceFile = None
 
     def __init__(self, cmdArgs):
         super(PyToApk, self).__init__()
         self.config = Config(os.path.dirname(os.path.realpath(__file__)))
         self.config.parseCmdArgs(cmdArgs)
         self.commandArgs = cmdArgs.commandArgs
+        self.profile = cmdArgs.profile
+        if cmdArgs.traceFile is not None:
+            self.traceFile = resolvePath(cmdArgs.traceFile, self.config.currDir)
+
+    def getReportDir(self):
+        """>>> getReportDir() -> path
+        Returns the directory for the profiling reports, which is
+        the directory of the log file or else the build directory.
+        """
+        logFilePath = self.config.logger.getLogFilePath()
+        if logFilePath is not None:
+            return os.path.dirname(os.path.abspath(logFilePath))
+        return self.config.buildDir
+
+    def runCommand(self, task, command):
+        """>>> runCommand(task, command) -> success
+        Run the command and write its timing trace. If profiling is
+        enabled, the command runs under cProfile and tracemalloc and
+        the reports are written next to the log file.
+        """
+        if not self.profile:
+            with self.config.tracer.phase(task):
+                return command.run(self.config, self.commandArgs)
+        import cProfile
+        import pstats
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        profiler = cProfile.Profile()
+        if tracemalloc is not None:
+            tracemalloc.start(25)
+        profiler.enable()
+        try:
+            with self.config.tracer.phase(task):
+                return command.run(self.config, self.commandArgs)
+        finally:
+            profiler.disable()
+            reportDir = self.getReportDir()
+            if mkDirs(reportDir):
+                basePath = os.path.join(reportDir, task + '-profile')
+                profiler.dump_stats(basePath + '.pstats')
+                with open(basePath + '.txt', 'w') as reportFile:
+                    stats = pstats.Stats(profiler, stream=reportFile)
+                    stats.sort_stats('cumulative').print_stats(50)
+                    stats.sort_stats('tottime').print_stats(50)
+                reports = [basePath + '.pstats', basePath + '.txt']
+                if tracemalloc is not None:
+                    snapshot = tracemalloc.take_snapshot()
+                    current, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    with open(basePath + '-memory.txt', 'w') as reportFile:
+                        reportFile.write('Current: {current} bytes, peak: {peak} bytes\n\n'
+                                         .format(current=current, peak=peak))
+                        for stat in snapshot.statistics('traceback')[:30]:
+                            reportFile.write(str(stat) + '\n')
+                            for line in stat.traceback.format():
+                                reportFile.write(line + '\n')
+                    reports.append(basePath + '-memory.txt')
+                self.config.logger.info('Wrote the profiling reports to:\n' + '\n'.join(reports))
+
+    def writeTrace(self, task):
+        """>>> writeTrace(task)
+        Write the timing trace of the command as a Chrome
+        trace and log a summary of the phases.
+        """
+        if len(self.config.tracer.getPhases()) == 0:
+            return
+        self.config.logger.info('Timing summary:\n' + self.config.tracer.getSummary())
+        tracePath = self.traceFile or os.path.join(self.config.buildDir,
+                                                   'trace-{task}.json'.format(task=task))
+        if not mkDirs(os.path.dirname(tracePath)):
+            return
+        try:
+            self.config.tracer.writeChromeTrace(tracePath)
+        except (IOError, OSError) as e:
+            self.config.logger.warn('Failed to write the timing trace to {path}: {msg}'
+                                    .format(path=tracePath, msg=str(e)))
+            return
+        self.config.logger.verbose('Wrote the timing trace to ' + tracePath)
 
     def executeTask(self, task):
         if not self.config.validateValues():
@@ -32,7 +115,7 @@ class PyToApk(object):
         command = getattr(getattr(__import__('src.commands.' + task), 'commands'), task)
         success = False
         try:
-            success = command.run(self.config, self.commandArgs)
+            success = self.runCommand(task, command)
         except KeyboardInterrupt:
             self.config.logger.error('Cancelling build due to interrupt.')
         except Exception as e:
@@ -42,6 +125,7 @@ class PyToApk(object):
             output = sys.stderr if output == sys.stdout else output
             traceback.print_exception(*sys.exc_info(), file=output)
         finally:
+            self.writeTrace(task)
             return success
 
 
@@ -60,6 +144,9 @@ if __name__ == '__main__':
                                                'w', 'error', 'e', 'none', 'n'],
                         help='Specify the log level. "none" means no output except the result. '
                              'Defaults to "info".')
+    parser.add_argument('--logFormat', choices=['text', 'json'],
+                        help='The format of the log output. "json" writes one JSON object with '
+                             'the time, level, stage and message per line. Defaults to "text".')
     parser.add_argument('--configFile', default='config.cfg',
                         help='The path to the config file. Defaults to the file '
                              '"config.cfg" in the current directory.')
@@ -80,6 +167,14 @@ if __name__ == '__main__':
     parser.add_argument('--avoidNetwork', action='store_true',
                         help='Specify if this program should avoid using the internet '
                              'if possible (e.g. to search for updates of templates).')
+    parser.add_argument('--traceFile',
+                        help='The path of the file to write the timing trace of the command '
+                             'to, in the Chrome trace event format. Defaults to the file '
+                             '"trace-<action>.json" in the build directory.')
+    parser.add_argument('--profile', action='store_true',
+                        help='If specified, the command is profiled with cProfile and '
+                             'tracemalloc and the reports are written next to the log file '
+                             '(or into the build directory).')
 
     args = parser.parse_args()
     pyToApk = PyToApk(args)
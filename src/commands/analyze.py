@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+
+import json
+import os
+
+from ..utils.argparser import SubCmdArgParser, ArgumentParserError, InfoActionProcessed
+from ..utils.files import mkDirs, replaceFile, resolvePath
+from ..utils.ignore import IgnoreMatcher
+from ..utils.imports import ImportGraph, ImportReport, getModuleName
+from ..utils.timing import tracedPhase
+
+
+class ImportAnalyzer(object):
+    config = None
+    sourceDir = None
+    entryPoint = 'main.py'
+    limit = 20
+    heavyShare = 0.1
+    jobs = None
+    reportFile = None
+
+    def __init__(self, config):
+        self.config = config
+        self.readConfig()
+
+    def readConfig(self):
+        apkSection = self.config.getSection('apk')
+        if apkSection is not None and apkSection.hasOption('sourceDir'):
+            self.sourceDir = apkSection.get('sourceDir', evaluatePath=True)
+        section = self.config.getSection('analyze')
+        if section is None:
+            return
+        if section.hasOption('sourceDir'):
+            self.sourceDir = section.get('sourceDir', evaluatePath=True)
+        if section.hasOption('entryPoint'):
+            self.entryPoint = section.get('entryPoint')
+        if section.hasOption('limit'):
+            self.limit = int(section.get('limit'))
+        if section.hasOption('heavyShare'):
+            self.heavyShare = float(section.get('heavyShare'))
+        if section.hasOption('jobs'):
+            self.jobs = int(section.get('jobs'))
+
+    def parseCmdArgs(self, args):
+        parser = SubCmdArgParser(
+            prog='build.py analyze',
+            description='Analyze the imports of the Python sources of an app without running '
+                        'them and report which modules are imported when the app starts.')
+        parser.add_argument('--sourceDir', help='The path to the directory that contains the '
+                                                'source code of your python program. Defaults '
+                                                'to the sourceDir of the apk command.')
+        parser.add_argument('--entryPoint',
+                            help='The path of the file that is executed when the app starts, '
+                                 'relative to the source directory. Defaults to main.py.')
+        parser.add_argument('--limit', type=int,
+                            help='The number of modules in the ranking of the most expensive '
+                                 'modules. Defaults to 20.')
+        parser.add_argument('--heavyShare', type=float,
+                            help='The share of the startup size above which a top level import '
+                                 'is reported as a candidate for lazy loading. Defaults to 0.1.')
+        parser.add_argument('--jobs', type=int,
+                            help='The number of processes used to parse the sources. '
+                                 'Defaults to the number of CPUs.')
+        parser.add_argument('--reportFile',
+                            help='If specified, the full report is also written to this path '
+                                 'as JSON.')
+        cmdArgs = parser.parse_args(args)
+        if 'sourceDir' in cmdArgs and cmdArgs.sourceDir is not None:
+            self.sourceDir = resolvePath(cmdArgs.sourceDir, self.config.currDir)
+        if 'entryPoint' in cmdArgs and cmdArgs.entryPoint is not None:
+            self.entryPoint = cmdArgs.entryPoint
+        if 'limit' in cmdArgs and cmdArgs.limit is not None:
+            self.limit = cmdArgs.limit
+        if 'heavyShare' in cmdArgs and cmdArgs.heavyShare is not None:
+            self.heavyShare = cmdArgs.heavyShare
+        if 'jobs' in cmdArgs and cmdArgs.jobs is not None:
+            self.jobs = cmdArgs.jobs
+        if 'reportFile' in cmdArgs and cmdArgs.reportFile is not None:
+            self.reportFile = resolvePath(cmdArgs.reportFile, self.config.currDir)
+
+    @tracedPhase('validate config')
+    def validateConfig(self):
+        if self.sourceDir is None:
+            self.config.logger.error('The path to the source directory was not specified!')
+            return False
+        if not os.path.isdir(self.sourceDir):
+            self.config.logger.error('The path to the source directory does not point to an '
+                                     'existing directory: ' + self.sourceDir)
+            return False
+        return True
+
+    @tracedPhase('import graph')
+    def scanImports(self, sources, cachePath):
+        """>>> scanImports(sources, cachePath) -> ImportGraph
+        Build the import graph of the (directory, ignore) pairs in 'sources'.
+        """
+        graph = ImportGraph.scan(sources, cachePath, self.jobs)
+        self.config.tracer.count('parsedFiles', graph.parsedFiles)
+        self.config.tracer.count('cachedFiles', graph.cachedFiles)
+        self.config.logger.verbose('Parsed {parsed} Python files, the imports of {cached} files '
+                                   'were cached.', parsed=graph.parsedFiles,
+                                   cached=graph.cachedFiles)
+        return graph
+
+    def getEntryModule(self, graph):
+        """>>> getEntryModule(graph) -> module name or None
+        Returns the name of the entry point module in the graph.
+        """
+        name = getModuleName(os.path.normpath(self.entryPoint).replace(os.sep, '/'))
+        if name is None or name not in graph.modules:
+            self.config.logger.error('The entry point {path} is not a Python file in the source '
+                                     'directory.'.format(path=self.entryPoint))
+            return None
+        return name
+
+    def analyze(self, sources, cachePath):
+        """>>> analyze(sources, cachePath) -> ImportReport or None
+        Build the import graph of the sources, log the report
+        for the entry point and write it to the report file.
+        """
+        graph = self.scanImports(sources, cachePath)
+        entryModule = self.getEntryModule(graph)
+        if entryModule is None:
+            return None
+        report = ImportReport(graph, entryModule, self.heavyShare)
+        self.config.logger.info('Import analysis of {entry}:\n{report}'.format(
+            entry=self.entryPoint, report=report.format(self.limit)))
+        if self.reportFile is not None:
+            if not mkDirs(os.path.dirname(self.reportFile)):
+                self.config.logger.error('Failed to create the directory for the report file ' +
+                                         self.reportFile)
+                return None
+            with open(self.reportFile + '.tmp', 'w') as reportFile:
+                json.dump(report.toJson(), reportFile, indent=2, sort_keys=True)
+            replaceFile(self.reportFile + '.tmp', self.reportFile)
+            self.config.logger.info('Wrote the import report to ' + self.reportFile)
+        return report
+
+    def run(self, cmdArgs):
+        try:
+            self.parseCmdArgs(cmdArgs)
+        except InfoActionProcessed:
+            return True
+        except ArgumentParserError as e:
+            return e.code == 0
+        if not self.validateConfig():
+            return False
+        matcher = IgnoreMatcher.fromFile(os.path.join(self.sourceDir, '.apkignore'),
+                                         IgnoreMatcher.DEFAULT_PATTERNS)
+        cachePath = os.path.join(self.config.buildDir, 'analyze', 'imports.json')
+        return self.analyze([(self.sourceDir, matcher.isIgnored)], cachePath) is not None
+
+
+def run(config, cmdArgs):
+    analyzer = ImportAnalyzer(config)
+    return analyzer.run(cmdArgs)
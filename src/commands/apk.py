@@ -1,37 +1,144 @@
 from __future__ import absolute_import
 
+import json
 import os
+import re
 import shutil
-import subprocess
+import zipfile
 from argparse import REMAINDER
+from time import time
 
+from .analyze import ImportAnalyzer
 from ..logger import Logger
 from ..utils import git
 from ..utils.apktemplate import ApkTemplateFiller
+from ..utils.artifacts import ArtifactCache, Fingerprint, hashFiles, hashTree
+from ..utils.bytecode import BytecodeCompiler, findInterpreters
 from ..utils.argparser import SubCmdArgParser, ArgumentParserError, InfoActionProcessed
-from ..utils.files import deleteDir, mkDirs, resolvePath
+from ..utils.files import STAGING_MODES, FileStager, deleteDir, mkDirs, replaceFile, \
+    resolvePath, syncDir
+from ..utils.ignore import IgnoreMatcher
+from ..utils.imports import TreeShaker
+from ..utils.process import GradleTaskParser, runProcess
+from ..utils.repack import alignAndSign, findBuildTool, findDebugKeystore, findEntryPrefix, \
+    rewriteApk
+from ..utils.strip import SourceStripper
+from ..utils.timing import tracedPhase
+from ..utils.watcher import createWatcher, waitForChanges
+from ..utils.wheelhouse import Wheelhouse, parseRequirements
+
+
+class BuildWorkspace(object):
+    """
+    A build directory for all build variants that fill the template identically.
+    'variants' is a list of the variant name (None for the app without variants)
+    and the build types to build for the variant.
+    """
+    buildDir = None
+    syncStateDir = None
+    templateFiller = None
+    variants = None
+    isFilled = False
+
+    def __init__(self, buildDir, syncStateDir, templateFiller):
+        self.buildDir = buildDir
+        self.syncStateDir = syncStateDir
+        self.templateFiller = templateFiller
+        self.variants = []
+
+    def getBuildTypes(self):
+        """>>> getBuildTypes() -> list of build types
+        Returns the build types of all variants in this workspace.
+        """
+        buildTypes = []
+        for _, variantBuildTypes in self.variants:
+            buildTypes += [buildType for buildType in variantBuildTypes
+                           if buildType not in buildTypes]
+        return buildTypes
 
 
 class ApkBuilder(object):
-    DEBUG_APK = 'app-debug.apk'
-    RELEASE_APK = 'app-release-unsigned.apk'
+    APK_NAMES = ['app-{type}.apk', 'app-{type}-unsigned.apk']
+    _VARIANT_NAME_REGEX = re.compile(r'\A[A-Za-z0-9_.-]+\Z')
+    _BUILD_TYPE_REGEX = re.compile(r'\A[A-Za-z][A-Za-z0-9_]*\Z')
     apkSubPath = os.path.join('app', 'build', 'outputs', 'apk')
     pythonSubPath = os.path.join('app', 'src', 'main', 'python')
+    # Paths in the build directory that are not part of the template
+    # and must survive the synchronization with the template.
+    WORKSPACE_PRESERVED_PATHS = ['.gradle', 'build', 'app/build', 'app/.externalNativeBuild',
+                                 'app/.cxx', 'local.properties']
+    # Changes the fingerprints of all builds, so no artifacts of
+    # builds with an incompatible version of this tool are reused.
+    ARTIFACT_CACHE_VERSION = 1
+    # Configures the directory of the local Gradle build cache.
+    GRADLE_INIT_SCRIPT = """// Generated by PyToApk, changes will be overwritten.
+settingsEvaluated {{ settings ->
+    settings.buildCache {{
+        local {{
+            enabled = true
+            directory = new File('{cacheDir}')
+        }}
+    }}
+}}
+"""
+
+    # The stages of the build pipeline that can be skipped in watch mode.
+    STAGE_TEMPLATE = 'template'
+    STAGE_SOURCES = 'sources'
 
     config = None
     apkBuildDir = None
+    apkSyncStateDir = None
+    apkVariantsDir = None
     apkTemplateDir = None
     apkOutputDir = None
     templateGit = None
+    templateCheckInterval = 3600
+    templateRef = None
+    templateDepth = None
+    templateMirror = None
     sourceDir = None
     sourceConfig = None
     buildDebug = False
+    cleanBuild = False
+    syncChecksum = True
+    stagingMode = 'auto'
     doInstall = False
     installArgs = None
+    fillJobs = None
+    excludePatterns = None
+    stripSources = None
+    precompile = False
+    precompileInterpreters = None
+    precompileJobs = None
+    watch = False
+    watchDelay = 0.5
+    watchPolling = False
+    gradleBuildCache = True
+    gradleCacheDir = None
+    gradleConfigurationCache = True
+    gradleParallel = True
+    artifactCache = True
+    artifactCacheDir = None
+    artifactCacheSize = 20
+    fastRepack = True
+    analyzeImports = False
+    treeShake = None
+    keepModules = None
+    keepFiles = None
+    wheelhouse = None
+    wheelCacheDir = None
+    vendoredWheels = None
+    templateFiller = None
+    variants = None
+    buildTypes = None
+    workspaces = None
 
     def __init__(self, config):
         self.config = config
         self.apkBuildDir = os.path.join(config.buildDir, 'apk')
+        self.apkSyncStateDir = os.path.join(config.buildDir, 'apk-sync')
+        self.apkVariantsDir = os.path.join(config.buildDir, 'apk-variants')
         self.apkTemplateDir = os.path.join(config.templateDir, 'apk')
         self.apkOutputDir = os.path.join(config.outputDir, 'apk')
         self.readConfig()
@@ -44,19 +151,82 @@ class ApkBuilder(object):
             return
         if section.hasOption('templateGit'):
             self.templateGit = section.get('templateGit')
+        if section.hasOption('templateRef'):
+            self.templateRef = section.get('templateRef')
+        if section.hasOption('templateDepth'):
+            self.templateDepth = int(section.get('templateDepth'))
+        if section.hasOption('templateMirror'):
+            self.templateMirror = section.get('templateMirror', evaluatePath=True)
+        if section.hasOption('templateCheckInterval'):
+            self.templateCheckInterval = float(section.get('templateCheckInterval'))
         if section.hasOption('sourceDir'):
             self.sourceDir = section.get('sourceDir', evaluatePath=True)
         if section.hasOption('sourceConfig'):
             self.sourceConfig = section.get('sourceConfig', evaluatePath=True)
         if not self.buildDebug and section.hasOption('buildDebug'):
             self.buildDebug = section.getBoolean('buildDebug')
+        if not self.cleanBuild and section.hasOption('cleanBuild'):
+            self.cleanBuild = section.getBoolean('cleanBuild')
+        if section.hasOption('syncChecksum'):
+            self.syncChecksum = section.getBoolean('syncChecksum')
+        if section.hasOption('stagingMode'):
+            self.stagingMode = section.get('stagingMode')
+        if section.hasOption('fillJobs'):
+            self.fillJobs = int(section.get('fillJobs'))
         if not self.doInstall and section.hasOption('install'):
             self.doInstall = section.getBoolean('install')
+        if not self.precompile and section.hasOption('precompile'):
+            self.precompile = section.getBoolean('precompile')
+        if section.hasOption('precompileInterpreters'):
+            self.precompileInterpreters = section.get('precompileInterpreters').split()
+        if section.hasOption('precompileJobs'):
+            self.precompileJobs = int(section.get('precompileJobs'))
+        if section.hasOption('watchDelay'):
+            self.watchDelay = float(section.get('watchDelay'))
+        if not self.watchPolling and section.hasOption('watchPolling'):
+            self.watchPolling = section.getBoolean('watchPolling')
+        if section.hasOption('gradleBuildCache'):
+            self.gradleBuildCache = section.getBoolean('gradleBuildCache')
+        if section.hasOption('gradleCacheDir'):
+            self.gradleCacheDir = section.get('gradleCacheDir', evaluatePath=True)
+        if section.hasOption('gradleConfigurationCache'):
+            self.gradleConfigurationCache = section.getBoolean('gradleConfigurationCache')
+        if section.hasOption('gradleParallel'):
+            self.gradleParallel = section.getBoolean('gradleParallel')
+        if section.hasOption('artifactCache'):
+            self.artifactCache = section.getBoolean('artifactCache')
+        if section.hasOption('artifactCacheDir'):
+            self.artifactCacheDir = section.get('artifactCacheDir', evaluatePath=True)
+        if section.hasOption('artifactCacheSize'):
+            self.artifactCacheSize = int(section.get('artifactCacheSize'))
+        if section.hasOption('wheelhouse'):
+            self.wheelhouse = [section.get('wheelhouse', evaluatePath=True)]
+        if section.hasOption('wheelCacheDir'):
+            self.wheelCacheDir = section.get('wheelCacheDir', evaluatePath=True)
+        if section.hasOption('fastRepack'):
+            self.fastRepack = section.getBoolean('fastRepack')
+        if not self.analyzeImports and section.hasOption('analyzeImports'):
+            self.analyzeImports = section.getBoolean('analyzeImports')
+        if section.hasOption('treeShake'):
+            self.treeShake = section.getBoolean('treeShake')
 
     def parseCommandArgs(self, args):
         parser = SubCmdArgParser(prog='build.py apk')  # TODO: Description
         parser.add_argument('--templateGit', help='The url to the git file of repository that '
                                                   'provides the template for the app.')
+        parser.add_argument('--templateRef',
+                            help='A tag or commit of the template repository to use instead of '
+                                 'the newest commit of the main branch.')
+        parser.add_argument('--templateDepth', type=int,
+                            help='If specified, the template is cloned with a history of only '
+                                 'this many commits.')
+        parser.add_argument('--templateMirror',
+                            help='The path to a bare mirror of the template repository that can '
+                                 'be shared between multiple template directories. It is created '
+                                 'if it does not exist and the template is cloned from it.')
+        parser.add_argument('--templateCheckInterval', type=float,
+                            help='The number of seconds after which the template is checked '
+                                 'for updates again. Defaults to 3600, 0 checks on every build.')
         parser.add_argument('--sourceDir', help='The path to the directory that '
                                                 'contains the source code of your python program.')
         parser.add_argument('--sourceConfig',
@@ -69,22 +239,151 @@ class ApkBuilder(object):
                                  'signed with a debug key and will not be optimized '
                                  '(see https://developer.android.com/studio/build/'
                                  'building-cmdline.html#DebugMode).')
+        parser.add_argument('--variants', nargs='+', metavar='NAME',
+                            help='The build variants to build, as defined by the android_app:NAME '
+                                 'sections of the app configuration. Defaults to all variants.')
+        parser.add_argument('--buildTypes', nargs='+', metavar='TYPE',
+                            help='The build types to build for every variant, e.g. debug and '
+                                 'release. Overwrites --buildDebug and the build_types of the app '
+                                 'configuration.')
+        parser.add_argument('--clean', action='store_true', default=self.cleanBuild,
+                            help='If specified, the build directory is deleted before the build, '
+                                 'instead of incrementally updating it from the last build.')
+        parser.add_argument('--stagingMode', choices=STAGING_MODES,
+                            help='How files are staged into the build directory: As copy-on-write '
+                                 'clones (reflink), as hard links (hardlink, only for the '
+                                 'template), as copies (copy) or the first that works (auto, the '
+                                 'default).')
+        parser.add_argument('--exclude', nargs='+', metavar='PATTERN',
+                            help='Patterns in the syntax of a .gitignore file of files and '
+                                 'directories in the source directory that should not be '
+                                 'packaged into the apk. They are applied after the exclude '
+                                 'patterns from the app configuration and the .apkignore file.')
+        parser.add_argument('--strip', nargs='+', choices=['docstrings', 'comments'],
+                            help='Remove docstrings and / or comments from the packaged Python '
+                                 'sources. Overwrites the strip_sources app configuration.')
+        parser.add_argument('--precompile', action='store_true', default=self.precompile,
+                            help='If specified, the Python sources are compiled to bytecode for '
+                                 'every Python interpreter found on the PATH that matches the '
+                                 'minimum Python version of the app, before the apk is build.')
+        parser.add_argument('--precompileInterpreters', nargs='+',
+                            help='The Python interpreters to compile the sources for, '
+                                 'instead of searching them on the PATH.')
+        parser.add_argument('--precompileJobs', type=int,
+                            help='The number of processes used to compile the sources for each '
+                                 'interpreter. Defaults to the number of CPUs.')
+        parser.add_argument('--watch', action='store_true',
+                            help='If specified, the apk is build and then rebuild every time a '
+                                 'file in the source directory or the app configuration changes, '
+                                 'until the command is interrupted.')
+        parser.add_argument('--watchDelay', type=float, default=self.watchDelay,
+                            help='The time in seconds without any further changes to wait for '
+                                 'before a rebuild is started in watch mode. Defaults to 0.5.')
+        parser.add_argument('--watchPolling', action='store_true', default=self.watchPolling,
+                            help='If specified, the watch mode polls for changes instead of '
+                                 'using the change notifications of the operating system.')
+        parser.add_argument('--gradleCacheDir',
+                            help='The directory of the local Gradle build cache, which is shared '
+                                 'by all apps and workspaces that use it. Defaults to the '
+                                 'directory "gradle-cache" in the template directory.')
+        parser.add_argument('--noGradleCache', action='store_true',
+                            help='If specified, the Gradle build cache and configuration '
+                                 'cache are not used.')
+        parser.add_argument('--noArtifactCache', action='store_true',
+                            help='If specified, the apks of an earlier build with identical '
+                                 'inputs are not reused from the artifact cache.')
+        parser.add_argument('--wheelhouse', nargs='+', metavar='DIR',
+                            help='Directories with pure-Python wheels (as written by "pip wheel" '
+                                 'or in the layout of a simple index) from which the requirements '
+                                 'of the app are packaged into the apk.')
+        parser.add_argument('--noFastRepack', action='store_true',
+                            help='If specified, Gradle is always used to build the apk, even if '
+                                 'only the Python sources of a debug apk changed.')
+        parser.add_argument('--analyzeImports', action='store_true',
+                            default=self.analyzeImports,
+                            help='If specified, the imports of the packaged Python sources are '
+                                 'analyzed and the modules that are imported when the app '
+                                 'starts are reported, see "build.py analyze".')
+        parser.add_argument('--treeShake', action='store_true',
+                            help='If specified, only the Python modules that the entry point of '
+                                 'the app can import are packaged. Overwrites the tree_shake app '
+                                 'configuration.')
+        parser.add_argument('--keepModules', nargs='+', metavar='NAME',
+                            help='Patterns of the names of modules that are packaged with '
+                                 '--treeShake, e.g. modules that are imported dynamically. They '
+                                 'are added to the keep_modules of the app configuration.')
+        parser.add_argument('--keepFiles', nargs='+', metavar='PATTERN',
+                            help='Patterns in the syntax of a .gitignore file of files that are '
+                                 'packaged with --treeShake, e.g. data files of unused packages. '
+                                 'They are added to the keep_files of the app configuration.')
         parser.add_argument('--install', nargs=REMAINDER,
                             help='If specified, the install command will be '
                                  'executed after the build command with the arguments provided.')
         cmdArgs = parser.parse_args(args)
         if 'templateGit' in cmdArgs and cmdArgs.templateGit is not None:
             self.templateGit = cmdArgs.templateGit
+        if 'templateRef' in cmdArgs and cmdArgs.templateRef is not None:
+            self.templateRef = cmdArgs.templateRef
+        if 'templateDepth' in cmdArgs and cmdArgs.templateDepth is not None:
+            self.templateDepth = cmdArgs.templateDepth
+        if 'templateMirror' in cmdArgs and cmdArgs.templateMirror is not None:
+            self.templateMirror = resolvePath(cmdArgs.templateMirror, self.config.currDir)
+        if 'templateCheckInterval' in cmdArgs and cmdArgs.templateCheckInterval is not None:
+            self.templateCheckInterval = cmdArgs.templateCheckInterval
         if 'sourceDir' in cmdArgs and cmdArgs.sourceDir is not None:
             self.sourceDir = resolvePath(cmdArgs.sourceDir, self.config.currDir)
         if 'sourceConfig' in cmdArgs and cmdArgs.sourceConfig is not None:
             self.sourceConfig = resolvePath(cmdArgs.sourceConfig, self.config.currDir)
         if 'buildDebug' in cmdArgs and cmdArgs.buildDebug is not None:
             self.buildDebug = cmdArgs.buildDebug
+        if 'variants' in cmdArgs and cmdArgs.variants is not None:
+            self.variants = cmdArgs.variants
+        if 'buildTypes' in cmdArgs and cmdArgs.buildTypes is not None:
+            self.buildTypes = cmdArgs.buildTypes
+        if 'clean' in cmdArgs and cmdArgs.clean is not None:
+            self.cleanBuild = cmdArgs.clean
+        if 'stagingMode' in cmdArgs and cmdArgs.stagingMode is not None:
+            self.stagingMode = cmdArgs.stagingMode
+        if 'exclude' in cmdArgs and cmdArgs.exclude is not None:
+            self.excludePatterns = cmdArgs.exclude
+        if 'strip' in cmdArgs and cmdArgs.strip is not None:
+            self.stripSources = cmdArgs.strip
+        if 'precompile' in cmdArgs and cmdArgs.precompile is not None:
+            self.precompile = cmdArgs.precompile
+        if 'precompileInterpreters' in cmdArgs and cmdArgs.precompileInterpreters is not None:
+            self.precompileInterpreters = cmdArgs.precompileInterpreters
+        if 'precompileJobs' in cmdArgs and cmdArgs.precompileJobs is not None:
+            self.precompileJobs = cmdArgs.precompileJobs
+        if 'watch' in cmdArgs and cmdArgs.watch:
+            self.watch = True
+        if 'watchDelay' in cmdArgs and cmdArgs.watchDelay is not None:
+            self.watchDelay = cmdArgs.watchDelay
+        if 'watchPolling' in cmdArgs and cmdArgs.watchPolling is not None:
+            self.watchPolling = cmdArgs.watchPolling
+        if 'gradleCacheDir' in cmdArgs and cmdArgs.gradleCacheDir is not None:
+            self.gradleCacheDir = resolvePath(cmdArgs.gradleCacheDir, self.config.currDir)
+        if 'noGradleCache' in cmdArgs and cmdArgs.noGradleCache:
+            self.gradleBuildCache = self.gradleConfigurationCache = False
+        if 'noArtifactCache' in cmdArgs and cmdArgs.noArtifactCache:
+            self.artifactCache = False
+        if 'wheelhouse' in cmdArgs and cmdArgs.wheelhouse is not None:
+            self.wheelhouse = [resolvePath(path, self.config.currDir)
+                               for path in cmdArgs.wheelhouse]
+        if 'noFastRepack' in cmdArgs and cmdArgs.noFastRepack:
+            self.fastRepack = False
+        if 'analyzeImports' in cmdArgs and cmdArgs.analyzeImports is not None:
+            self.analyzeImports = cmdArgs.analyzeImports
+        if 'treeShake' in cmdArgs and cmdArgs.treeShake:
+            self.treeShake = True
+        if 'keepModules' in cmdArgs and cmdArgs.keepModules is not None:
+            self.keepModules = cmdArgs.keepModules
+        if 'keepFiles' in cmdArgs and cmdArgs.keepFiles is not None:
+            self.keepFiles = cmdArgs.keepFiles
         if 'install' in cmdArgs and cmdArgs.install is not None:
             self.doInstall = True
             self.installArgs = cmdArgs.install
 
+    @tracedPhase('validate config')
     def validateConfig(self):
         valid = True
         if self.config.sdkPath is None:
@@ -102,6 +401,10 @@ class ApkBuilder(object):
             valid = False
             self.config.logger.error('The path to the source directory of your python program '
                                      'does not point to an existing directory: ' + self.sourceDir)
+        if self.stagingMode not in STAGING_MODES:
+            valid = False
+            self.config.logger.error('Invalid staging mode "{mode}", expected one of {modes}.'
+                                     .format(mode=self.stagingMode, modes=', '.join(STAGING_MODES)))
         if self.sourceConfig is None:
             if self.sourceDir is not None:
                 self.sourceConfig = os.path.join(self.sourceDir, 'setup.cfg')
@@ -114,51 +417,881 @@ class ApkBuilder(object):
                                      .format(path=self.sourceConfig))
         return valid
 
+    @tracedPhase('template check')
     def ensureTemplate(self, allowUpdate=True):
         self.config.logger.info('Checking template from {path}...'.format(path=self.templateGit))
         if git.isInitalized(self.apkTemplateDir):
-            return (not allowUpdate) or git.update(self.config.gitPath,
-                                                   self.apkTemplateDir, self.config.logger)
-        return git.initialize(self.config.gitPath, self.templateGit,
-                              self.apkTemplateDir, self.config.logger)
+            return (not allowUpdate) or git.update(
+                self.config.gitPath, self.apkTemplateDir, self.config.logger,
+                maxAge=self.templateCheckInterval, ref=self.templateRef,
+                depth=self.templateDepth, mirrorDir=self.templateMirror, repoUrl=self.templateGit)
+        return git.initialize(self.config.gitPath, self.templateGit, self.apkTemplateDir,
+                              self.config.logger, ref=self.templateRef, depth=self.templateDepth,
+                              mirrorDir=self.templateMirror)
+
+    @tracedPhase('clean workspace')
+    def cleanWorkspace(self):
+        """>>> cleanWorkspace() -> success
+        Delete the build directory and the synchronization
+        state, so the next build starts from scratch.
+        """
+        self.config.logger.info('Cleaning the build directory {path}...'
+                                .format(path=self.apkBuildDir))
+        if not (deleteDir(self.apkBuildDir) and deleteDir(self.apkSyncStateDir) and
+                deleteDir(self.apkVariantsDir)):
+            self.config.logger.error('Failed to delete the contents of the specified build '
+                                     'directory "{dir}"!'.format(dir=self.apkBuildDir))
+            return False
+        return True
+
+    def syncWorkspace(self, srcDir, destDir, stateName, ignore=None, preserve=(),
+                      copyFunction=None, allowHardlinks=False):
+        """>>> syncWorkspace(srcDir, destDir, stateName, ignore, preserve, copyFunction,
+        allowHardlinks) -> success
+        Incrementally update 'destDir' in the build directory so it
+        matches 'srcDir'. The state of the synchronization is stored
+        under 'stateName' in the synchronization state directory.
+        Without a 'copyFunction', the files are staged with the
+        configured staging mode and hard links are only used if
+        'allowHardlinks' is True.
+        """
+        statePath = os.path.join(self.apkSyncStateDir, stateName + '.json')
+        stager = None
+        if copyFunction is None:
+            copyFunction = stager = FileStager(self.stagingMode, allowHardlinks)
+        try:
+            result = syncDir(srcDir, destDir, statePath, ignore=ignore, preserve=preserve,
+                             checksum=self.syncChecksum, copyFunction=copyFunction)
+        except (IOError, OSError) as e:
+            self.config.logger.error('Failed to synchronize {src} with {dest}: {msg}'
+                                     .format(src=srcDir, dest=destDir, msg=str(e)))
+            return False
+        self.config.logger.info('Synchronized {path}: {result}'.format(path=srcDir, result=result))
+        self.config.tracer.count('copiedFiles', result.copiedFiles)
+        self.config.tracer.count('copiedBytes', result.copiedBytes)
+        self.config.tracer.count('unchangedFiles', result.unchangedFiles)
+        self.config.tracer.count('removedFiles', result.removedFiles)
+        if stager is not None and result.copiedFiles > 0:
+            self.config.logger.info('Staged the files of {path}: {stager}',
+                                    path=srcDir, stager=stager)
+            self.config.tracer.count('reflinkedFiles', stager.reflinkedFiles)
+            self.config.tracer.count('hardlinkedFiles', stager.linkedFiles)
+            self.config.tracer.count('sharedBytes', stager.sharedBytes)
+            self.config.tracer.count('newDiskBytes', stager.copiedBytes)
+        return True
+
+    @tracedPhase('load variants')
+    def loadVariants(self):
+        """>>> loadVariants() -> success
+        Load the app configuration of every selected build variant
+        and group the variants that fill the template identically
+        into workspaces, which are only filled and build once.
+        """
+        names = [None]
+        definedNames = [] if self.sourceConfig is None \
+            else ApkTemplateFiller.getVariantNames(self.sourceConfig)
+        if self.variants is not None:
+            unknownNames = [name for name in self.variants if name not in definedNames]
+            if len(unknownNames) > 0:
+                self.config.logger.error('The variants {names} are not defined in the app '
+                                         'configuration.'.format(names=', '.join(unknownNames)))
+                return False
+            names = self.variants
+        elif len(definedNames) > 0:
+            names = definedNames
+        defaultBuildTypes = ['debug' if self.buildDebug else 'release']
+        workspaces = []
+        for name in names:
+            if name is not None and self._VARIANT_NAME_REGEX.search(name) is None:
+                self.config.logger.error('Invalid variant name "{name}": Only letters, digits, '
+                                         '".", "-" and "_" are allowed.'.format(name=name))
+                return False
+            if name is None:
+                buildDir = os.path.join(self.config.buildDir, 'apk')
+                syncStateDir = os.path.join(self.config.buildDir, 'apk-sync')
+            else:
+                buildDir = os.path.join(self.apkVariantsDir, name)
+                syncStateDir = os.path.join(self.config.buildDir, 'apk-sync', 'variants', name)
+            filler = ApkTemplateFiller(self.apkTemplateDir, buildDir,
+                                       self.config.logger, self.fillJobs)
+            if self.sourceConfig is not None and \
+                    not filler.loadConfigFile(self.sourceConfig, name):
+                return False
+            buildTypes = self.buildTypes or filler.buildTypes or defaultBuildTypes
+            for buildType in buildTypes:
+                if self._BUILD_TYPE_REGEX.search(buildType) is None:
+                    self.config.logger.error('Invalid build type: {type}'.format(type=buildType))
+                    return False
+            for workspace in workspaces:
+                if workspace.templateFiller.formatArgs == filler.formatArgs and \
+                        workspace.templateFiller.appIcon == filler.appIcon and \
+                        workspace.templateFiller.appManifestTemplate == \
+                        filler.appManifestTemplate:
+                    break
+            else:
+                workspace = BuildWorkspace(buildDir, syncStateDir, filler)
+                workspaces.append(workspace)
+            workspace.variants.append((name, buildTypes))
+        if names != [None]:
+            self.config.logger.info('Building the variants {names} in {num} workspace(s).'
+                                    .format(names=', '.join(names), num=len(workspaces)))
+        self.workspaces = workspaces
+        self.vendoredWheels = None
+        if self.wheelhouse and not self.vendorRequirements():
+            return False
+        return True
 
+    @tracedPhase('resolve requirements')
+    def vendorRequirements(self):
+        """>>> vendorRequirements() -> success
+        Resolve the requirements of the app against the wheelhouse and
+        extract the matching wheels into the wheel cache. The vendored
+        requirements are removed from the requirements that the app
+        installs itself, and dependencies of the wheels that are not
+        in the wheelhouse are added to them. The Python sources are
+        shared by all workspaces, so every workspace gets the wheels
+        for the requirements of all workspaces.
+        """
+        requirements = []
+        for workspace in self.workspaces:
+            parsed, invalid = parseRequirements(
+                (workspace.templateFiller.formatArgs or {}).get('requirements') or '')
+            for text in invalid:
+                self.config.logger.warn('Not vendoring the requirement "{req}": Only project '
+                                        'names with version specifiers are supported.'
+                                        .format(req=text))
+            requirements += parsed
+        if len(requirements) == 0:
+            return True
+        minPyVersion = (self.workspaces[0].templateFiller.formatArgs or {}).get('minPyVersion')
+        wheelhouse = Wheelhouse(
+            self.wheelhouse, self.wheelCacheDir or os.path.join(self.config.templateDir,
+                                                                'wheel-cache'),
+            self.config.logger, self.fillJobs)
+        wheels, unresolved = wheelhouse.resolve(requirements, minPyVersion or None)
+        paths = wheelhouse.extract(wheels)
+        if paths is None:
+            return False
+        self.vendoredWheels = list(zip(wheels, paths))
+        self.config.tracer.count('vendoredWheels', len(wheels))
+        vendoredKeys = set(wheel.key for wheel in wheels)
+        topLevelKeys = set(requirement.key for requirement in requirements)
+        dependencies = [requirement.name + ','.join(
+            operator + version for operator, version in requirement.specifiers)
+            for requirement in unresolved if requirement.key not in topLevelKeys]
+        for workspace in self.workspaces:
+            formatArgs = workspace.templateFiller.formatArgs
+            if formatArgs is None or not formatArgs.get('requirements'):
+                continue
+            remaining = []
+            for text in formatArgs['requirements'].split():
+                parsed = parseRequirements(text)[0]
+                if len(parsed) == 0 or parsed[0].key not in vendoredKeys:
+                    remaining.append(text)
+            formatArgs['requirements'] = ' '.join(remaining + dependencies)
+        self.config.logger.info('Vendoring {num} wheels: {names}'.format(
+            num=len(wheels), names=', '.join('{name} {version}'.format(
+                name=wheel.name, version=wheel.version) for wheel in wheels) or 'none'))
+        if len(unresolved) > 0:
+            self.config.logger.info('The app installs {reqs} itself.'.format(
+                reqs=', '.join(requirement.text for requirement in unresolved)))
+        return True
+
+    def useWorkspace(self, workspace):
+        """>>> useWorkspace(workspace)
+        Direct all following build steps to the given workspace.
+        """
+        self.apkBuildDir = workspace.buildDir
+        self.apkSyncStateDir = workspace.syncStateDir
+        self.templateFiller = workspace.templateFiller
+
+    @tracedPhase('fill template')
     def fillTemplate(self):
-        self.config.logger.info('Copying template to build directory...')
-        shutil.copytree(self.apkTemplateDir, self.apkBuildDir,
-                        ignore=lambda src, names: ['.git'])
-        apkTemplateFiller = ApkTemplateFiller(self.apkBuildDir, self.config.logger)
-        if self.sourceConfig is not None:
-            if not apkTemplateFiller.loadConfigFile(self.sourceConfig):
+        apkTemplateFiller = self.templateFiller
+        apkTemplateFiller.loadFillPlan(os.path.join(self.config.buildDir, 'template-plans'),
+                                       git.readRef(self.apkTemplateDir, 'HEAD'))
+        self.config.logger.info('Updating the template in the build directory...')
+        ownedFiles = apkTemplateFiller.getOwnedFiles()
+        ownedBuildFiles = [apkTemplateFiller.getBuildPath(path) for path in ownedFiles]
+        packageDirs = apkTemplateFiller.getPackageDirs()
+        pythonSubPath = self.pythonSubPath.replace(os.path.sep, '/')
+        ignoredPaths = set(['.git', pythonSubPath] + ownedFiles)
+        preservedPaths = self.WORKSPACE_PRESERVED_PATHS + [pythonSubPath] + ownedBuildFiles
+        if packageDirs is not None:
+            ignoredPaths.add(packageDirs[0])
+            preservedPaths.append(packageDirs[1])
+        if not self.syncWorkspace(self.apkTemplateDir, self.apkBuildDir, 'template',
+                                  ignore=lambda path, isDir: path in ignoredPaths,
+                                  preserve=preservedPaths, allowHardlinks=True):
+            return False
+        if packageDirs is not None:
+            prefix = packageDirs[0] + '/'
+            ownedPackageFiles = set(path[len(prefix):] for path in ownedFiles
+                                    if path.startswith(prefix))
+            if not self.syncWorkspace(
+                    os.path.join(self.apkTemplateDir, packageDirs[0]),
+                    os.path.join(self.apkBuildDir, packageDirs[1]), 'template-package',
+                    ignore=lambda path, isDir: path in ownedPackageFiles,
+                    preserve=ownedPackageFiles, allowHardlinks=True):
                 return False
         self.config.logger.info('Filling template...')
         return apkTemplateFiller.fillTemplate(self.config.sdkPath)
 
+    def getSourceIgnoreMatcher(self):
+        """>>> getSourceIgnoreMatcher() -> IgnoreMatcher
+        Create the matcher for the files in the source directory
+        that should not be packaged, from the default patterns,
+        the app configuration, the .apkignore file in the source
+        directory and the command line.
+        """
+        patterns = []
+        filler = self.templateFiller
+        if filler is None or filler.useDefaultExcludes:
+            patterns += IgnoreMatcher.DEFAULT_PATTERNS
+        if filler is not None and filler.excludePatterns is not None:
+            patterns += filler.excludePatterns
+        matcher = IgnoreMatcher.fromFile(os.path.join(self.sourceDir, '.apkignore'), patterns)
+        for pattern in self.excludePatterns or []:
+            matcher.addPattern(pattern)
+        return matcher
+
+    def getStripOptions(self):
+        """>>> getStripOptions() -> list of 'docstrings' and 'comments'
+        Returns what should be removed from the packaged Python sources.
+        """
+        if self.stripSources is not None:
+            return self.stripSources
+        if self.templateFiller is None:
+            return []
+        return [option for option, enabled in [
+            ('docstrings', self.templateFiller.stripDocstrings),
+            ('comments', self.templateFiller.stripComments)] if enabled]
+
+    def getTreeShakeOptions(self):
+        """>>> getTreeShakeOptions() -> (enabled, keep module patterns, keep file patterns)
+        Returns whether only the modules needed by the entry point are
+        packaged, and which modules and files are packaged in any case.
+        """
+        filler = self.templateFiller
+        enabled = self.treeShake if self.treeShake is not None \
+            else filler is not None and filler.treeShake
+        keepModules = ((filler.keepModules if filler is not None else None) or []) + \
+            (self.keepModules or [])
+        keepFiles = ((filler.keepFiles if filler is not None else None) or []) + \
+            (self.keepFiles or [])
+        return enabled, keepModules, keepFiles
+
+    @tracedPhase('tree shake')
+    def createTreeShaker(self, matcher):
+        """>>> createTreeShaker(matcher) -> TreeShaker or None
+        Select the files of the source directory that are not excluded by
+        the matcher and are needed by the entry point of the app.
+        """
+        _, keepModules, keepFiles = self.getTreeShakeOptions()
+        analyzer = ImportAnalyzer(self.config)
+        graph = analyzer.scanImports([(self.sourceDir, matcher.isIgnored)],
+                                     os.path.join(self.apkSyncStateDir, 'imports.json'))
+        entryModule = analyzer.getEntryModule(graph)
+        if entryModule is None:
+            return None
+        treeShaker = TreeShaker(graph, self.sourceDir, matcher.isIgnored, entryModule,
+                                keepModules, keepFiles)
+        for pattern in treeShaker.unmatchedPatterns:
+            self.config.logger.warn('No module matches the keep_modules pattern ' + pattern)
+        for relPath in treeShaker.getUnparsedModules():
+            self.config.logger.warn('Failed to parse {path}, the modules it imports are only '
+                                    'packaged if they are listed in keep_modules.'
+                                    .format(path=relPath))
+        for name in sorted(treeShaker.removedModules):
+            self.config.logger.verbose('Not packaging the unused module ' + name)
+        for relPath in sorted(treeShaker.removedDataFiles):
+            self.config.logger.verbose('Not packaging the data file of an unused package ' +
+                                       relPath)
+        self.config.tracer.count('shakenFiles', treeShaker.totalFiles - treeShaker.keptFiles)
+        self.config.tracer.count('shakenBytes', treeShaker.totalBytes - treeShaker.keptBytes)
+        self.config.logger.info(
+            'Tree shaking kept {kept} of {total} modules and removed {data} data files of unused '
+            'packages: {before} bytes before, {after} bytes after ({saved:.1%} smaller).'.format(
+                kept=len(treeShaker.keptModules), total=len(graph.modules),
+                data=len(treeShaker.removedDataFiles), before=treeShaker.totalBytes,
+                after=treeShaker.keptBytes,
+                saved=1 - float(treeShaker.keptBytes) / (treeShaker.totalBytes or 1)))
+        return treeShaker
+
+    def getVendoredNames(self):
+        """>>> getVendoredNames() -> list of sets of names
+        Returns the names of the top level files and directories of every
+        vendored wheel, without the names that exist in the source
+        directory, because the sources are never overwritten by a wheel.
+        """
+        if not self.vendoredWheels:
+            return []
+        sourceNames = set(os.listdir(self.sourceDir))
+        vendoredNames = []
+        for wheel, path in self.vendoredWheels:
+            names = set(os.listdir(path))
+            for name in sorted(names & sourceNames):
+                self.config.logger.warn('The source directory contains {name}, which shadows '
+                                        'the file from the {wheel} wheel.'
+                                        .format(name=name, wheel=wheel.name))
+            vendoredNames.append(names - sourceNames)
+        return vendoredNames
+
+    def isPreservedPythonPath(self, relPath, vendoredNames=()):
+        """>>> isPreservedPythonPath(relPath, vendoredNames) -> boolean
+        Returns True if the path in the packaged Python sources is not
+        removed by a synchronization, because it is compiled bytecode or
+        belongs to one of the top level names in 'vendoredNames'.
+        """
+        return (self.precompile and BytecodeCompiler.isBytecodePath(relPath)) or \
+            relPath.split('/')[0] in vendoredNames
+
+    @tracedPhase('vendor wheels')
+    def stageVendoredWheels(self):
+        """>>> stageVendoredWheels() -> success
+        Update the content of the vendored wheels in the packaged Python sources.
+        """
+        pythonSourceDest = os.path.join(self.apkBuildDir, self.pythonSubPath)
+        for (wheel, path), names in zip(self.vendoredWheels, self.getVendoredNames()):
+            if not self.syncWorkspace(
+                    path, pythonSourceDest, 'vendor-' + wheel.key,
+                    ignore=lambda relPath, isDir, names=names: relPath.split('/')[0] not in names,
+                    preserve=lambda relPath, names=names: relPath.split('/')[0] not in names or
+                    self.isPreservedPythonPath(relPath),
+                    allowHardlinks=True):
+                return False
+        return True
+
+    @tracedPhase('python sources')
     def copyPythonSources(self):
         pythonSourceDest = os.path.join(self.apkBuildDir, self.pythonSubPath)
-        self.config.logger.info('Cleaning examplePython sources from the template from {path}...'
-                                .format(path=pythonSourceDest))
-        shutil.rmtree(pythonSourceDest)
-        self.config.logger.info('Copying Python sources from {path}...'.format(path=self.sourceDir))
-        shutil.copytree(self.sourceDir, pythonSourceDest)
+        self.config.logger.info('Updating Python sources from {path}...'.format(
+            path=self.sourceDir))
+        vendoredNames = set()
+        for names in self.getVendoredNames():
+            vendoredNames.update(names)
+        matcher = self.getSourceIgnoreMatcher()
+        treeShaker = None
+        if self.getTreeShakeOptions()[0]:
+            treeShaker = self.createTreeShaker(matcher)
+            if treeShaker is None:
+                return False
+        excluded = {'files': 0, 'dirs': 0, 'bytes': 0}
+
+        def ignoreSourceFile(path, isDir):
+            if not matcher.isIgnored(path, isDir):
+                return treeShaker is not None and treeShaker.isRemoved(path, isDir)
+            if isDir:
+                excluded['dirs'] += 1
+            else:
+                excluded['files'] += 1
+                excluded['bytes'] += os.path.getsize(os.path.join(self.sourceDir, path))
+            return True
+
+        stripOptions = self.getStripOptions()
+        stripper = SourceStripper('docstrings' in stripOptions, 'comments' in stripOptions) \
+            if stripOptions else None
+        stateName = '-'.join(['python'] + sorted(stripOptions or []))
+        if not self.syncWorkspace(self.sourceDir, pythonSourceDest, stateName,
+                                  ignore=ignoreSourceFile,
+                                  preserve=lambda path: self.isPreservedPythonPath(
+                                      path, vendoredNames),
+                                  copyFunction=stripper):
+            return False
+        self.config.tracer.count('excludedFiles', excluded['files'])
+        self.config.tracer.count('excludedBytes', excluded['bytes'])
+        self.config.logger.info('Excluded {files} files ({size} bytes) and {dirs} directories '
+                                'from the Python sources.'.format(
+                                    files=excluded['files'], size=excluded['bytes'],
+                                    dirs=excluded['dirs']))
+        if stripper is not None:
+            self.config.logger.info('Stripping {what} from the updated Python sources saved '
+                                    '{size} bytes.'.format(what=' and '.join(stripOptions),
+                                                           size=stripper.savedBytes))
+        return True
+
+    def getPackagedSources(self):
+        """>>> getPackagedSources() -> list of (directory, ignore)
+        Returns the directories whose Python files are packaged, the source
+        directory and the vendored wheels, with a function that is called
+        with a relative path and whether it is a directory and returns
+        True if the path is not packaged from that directory.
+        """
+        sources = [(self.sourceDir, self.getSourceIgnoreMatcher().isIgnored)]
+        for (wheel, path), names in zip(self.vendoredWheels or [], self.getVendoredNames()):
+            sources.append((path, lambda relPath, isDir, names=names:
+                            relPath.split('/')[0] not in names))
+        return sources
+
+    def reportImports(self):
+        """>>> reportImports() -> success
+        Analyze the imports of the packaged Python sources and
+        report the modules that are imported when the app starts.
+        """
+        analyzer = ImportAnalyzer(self.config)
+        return analyzer.analyze(self.getPackagedSources(),
+                                os.path.join(self.apkSyncStateDir, 'imports.json')) is not None
+
+    @tracedPhase('precompile')
+    def precompileSources(self):
+        """>>> precompileSources() -> success
+        Compile the Python sources in the build directory to bytecode
+        for all target interpreters. Fails if any source contains
+        a syntax error.
+        """
+        minPyVersion = None
+        if self.templateFiller is not None and self.templateFiller.formatArgs is not None:
+            minPyVersion = self.templateFiller.formatArgs.get('minPyVersion')
+        interpreters = []
+        for interpreter in findInterpreters(minPyVersion, self.precompileInterpreters,
+                                            self.config.logger):
+            if interpreter.usesHashBasedPyc():
+                interpreters.append(interpreter)
+            else:
+                # The pyc files of older interpreters are validated with the modification
+                # time of the source, which changes when the app extracts the sources.
+                self.config.logger.warn('Not precompiling the Python sources for {name}: Only '
+                                        'Python 3.7 and newer can validate bytecode files by '
+                                        'the hash of the source.'.format(name=interpreter.name))
+        if len(interpreters) == 0:
+            self.config.logger.warn('Not precompiling the Python sources: No suitable Python '
+                                    'interpreter found for the minimal Python version {version}.'
+                                    .format(version=minPyVersion or 'of the app'))
+            return True
+        self.config.logger.info('Precompiling Python sources for {names}...'.format(
+            names=', '.join(interpreter.name for interpreter in interpreters)))
+        compiler = BytecodeCompiler(interpreters, os.path.join(self.config.buildDir, 'pycache'),
+                                    os.path.join(self.apkSyncStateDir, 'bytecode.json'),
+                                    self.config.logger, self.precompileJobs)
+        if not compiler.compileDir(os.path.join(self.apkBuildDir, self.pythonSubPath)):
+            self.config.logger.error('Precompiling the Python sources failed!')
+            return False
         return True
 
-    def build(self, debug=False):
+    def getApkPath(self, buildType):
+        """>>> getApkPath(buildType) -> path or None
+        Returns the path to the apk of the build type generated by Gradle.
+        """
+        for nameFormat in self.APK_NAMES:
+            apkPath = os.path.join(self.apkBuildDir, self.apkSubPath, buildType,
+                                   nameFormat.format(type=buildType))
+            if os.path.exists(apkPath):
+                return apkPath
+        return None
+
+    def getGradleArgs(self):
+        """>>> getGradleArgs() -> list of arguments or None
+        Returns the Gradle arguments that enable the configured caches
+        and parallel task execution. The directory of the build cache
+        is set by a generated init script, which is only rewritten if
+        it changed, so it does not invalidate the configuration cache.
+        """
+        args = []
+        if self.gradleBuildCache:
+            cacheDir = self.gradleCacheDir or os.path.join(self.config.templateDir,
+                                                           'gradle-cache')
+            initScript = self.GRADLE_INIT_SCRIPT.format(
+                cacheDir=os.path.abspath(cacheDir).replace('\\', '/').replace("'", "\\'"))
+            initScriptPath = os.path.join(self.config.buildDir, 'gradle-init.gradle')
+            try:
+                with open(initScriptPath) as initScriptFile:
+                    changed = initScriptFile.read() != initScript
+            except (IOError, OSError):
+                changed = True
+            if not mkDirs(cacheDir):
+                self.config.logger.error('Failed to create the Gradle build cache directory {path}'
+                                         .format(path=cacheDir))
+                return None
+            if changed:
+                with open(initScriptPath, 'w') as initScriptFile:
+                    initScriptFile.write(initScript)
+            args += ['--init-script', initScriptPath, '-Dorg.gradle.caching=true']
+        if self.gradleConfigurationCache:
+            # The property was called org.gradle.unsafe.configuration-cache before Gradle 7.6
+            args += ['-Dorg.gradle.configuration-cache=true',
+                     '-Dorg.gradle.unsafe.configuration-cache=true',
+                     '-Dorg.gradle.configuration-cache.problems=warn',
+                     '-Dorg.gradle.unsafe.configuration-cache-problems=warn']
+        if self.gradleParallel:
+            args.append('-Dorg.gradle.parallel=true')
+        return args
+
+    @tracedPhase('gradle')
+    def build(self, buildTypes):
+        """>>> build(buildTypes) -> dict of build type to apk path or None
+        Build the apks of all build types with a single Gradle call.
+        """
         self.config.logger.info('Building apk...')
-        self.config.logger.verbose('debug = ' + str(debug))
+        self.config.logger.verbose('buildTypes = ' + ', '.join(buildTypes))
         gradleScript = 'gradlew.bat' if os.name == 'nt' else 'gradlew'
-        cmd = 'assembleDebug' if debug else 'assembleRelease'
-        args = [os.path.join(self.apkBuildDir, gradleScript), cmd]
+        args = [os.path.join(self.apkBuildDir, gradleScript)]
+        args += ['assemble' + buildType[0].upper() + buildType[1:] for buildType in buildTypes]
+        args.append('--console=plain')  # Print the task headers for the task report
+        gradleArgs = self.getGradleArgs()
+        if gradleArgs is None:
+            return None
+        args += gradleArgs
         if self.config.logger.getLogPriority() == Logger.PRIORITY_VERBOSE:
             args += ['--info', '--stacktrace']
-        self.config.logger.verbose('Calling ' + subprocess.list2cmdline(args))
-        if not subprocess.call(args, cwd=self.apkBuildDir) == 0:
-            self.config.logger.error('Generating the apk failed!')
+        taskParser = GradleTaskParser()
+        result = runProcess(args, self.config.logger, cwd=self.apkBuildDir, parsers=[taskParser],
+                            outputPriority=Logger.PRIORITY_INFO)
+        for outcome, count in taskParser.getOutcomeCounts().items():
+            self.config.tracer.count('tasks' + outcome.title().replace('-', ''), count)
+        if taskParser.configurationCache is not None:
+            self.config.tracer.count('configurationCache' + taskParser.configurationCache.title())
+        if not result.success:
+            self.config.logger.error('Generating the apk failed! The last lines of the Gradle '
+                                     'output were:\n' + result.getTail())
             return None
-        apkPath = os.path.join(self.apkBuildDir, self.apkSubPath,
-                               'debug' if debug else 'release', self.DEBUG_APK if debug else self.RELEASE_APK)
-        if not os.path.exists(apkPath):
+        self.config.logger.info('Gradle finished in {time:.1f}s, {report}',
+                                time=result.duration, report=taskParser.getReport())
+        apkPaths = {}
+        for buildType in buildTypes:
+            apkPaths[buildType] = self.getApkPath(buildType)
+            if apkPaths[buildType] is None:
+                self.config.logger.error('Gradle did not generate the {type} apk.'
+                                         .format(type=buildType))
+                return None
+            self.config.tracer.count('apkBytes', os.path.getsize(apkPaths[buildType]))
+        return apkPaths
+
+    @tracedPhase('copy output')
+    def copyApkToOutput(self, apkPath, variant):
+        """>>> copyApkToOutput(apkPath, variant) -> path
+        Copy the apk into the output directory of the variant
+        and return the path of the copy, or of the original
+        apk if it could not be copied.
+        """
+        outputDir = self.apkOutputDir if variant is None \
+            else os.path.join(self.apkOutputDir, variant)
+        outputApkPath = None
+        if mkDirs(outputDir):
+            shutil.copy(apkPath, outputDir)
+            outputApkPath = os.path.join(outputDir, os.path.basename(apkPath))
+        if outputApkPath is None or not os.path.exists(outputApkPath):
+            self.config.logger.warn('Failed to copy the generated apk to the output directory.')
+            outputApkPath = apkPath
+        return outputApkPath
+
+    @tracedPhase('fingerprint')
+    def getSourcesFingerprint(self):
+        """>>> getSourcesFingerprint() -> hex digest
+        Returns a fingerprint of the packaged Python sources and of
+        the options that change them. The hashes of the source files
+        are cached, so only changed files are read.
+        """
+        matcher = self.getSourceIgnoreMatcher()
+        fingerprint = Fingerprint()
+        fingerprint.addValue('sources', hashTree(
+            self.sourceDir, ignore=matcher.isIgnored,
+            statePath=os.path.join(self.config.buildDir, 'source-hashes.json')))
+        fingerprint.addValue('strip', sorted(self.getStripOptions()))
+        fingerprint.addValue('treeShake', list(self.getTreeShakeOptions()) + [
+            ImportAnalyzer(self.config).entryPoint])
+        fingerprint.addValue('precompile', [self.precompile, self.precompileInterpreters])
+        fingerprint.addValue('vendored', [wheel.sha256 for wheel, _ in self.vendoredWheels or []])
+        return fingerprint.hexdigest()
+
+    def getWorkspaceFingerprint(self, workspace, sourcesFingerprint):
+        """>>> getWorkspaceFingerprint(workspace, sourcesFingerprint) -> hex digest
+        Returns the fingerprint of all inputs of the build of the workspace.
+        """
+        filler = workspace.templateFiller
+        fingerprint = Fingerprint()
+        fingerprint.addValue('version', self.ARTIFACT_CACHE_VERSION)
+        fingerprint.addValue('template', git.readRef(self.apkTemplateDir, 'HEAD'))
+        fingerprint.addValue('formatArgs', filler.formatArgs)
+        fingerprint.addFile('icon', filler.appIcon)
+        fingerprint.addFile('manifest', filler.appManifestTemplate)
+        fingerprint.addValue('buildTypes', workspace.getBuildTypes())
+        fingerprint.addValue('sdk', self.config.sdkPath)
+        fingerprint.addValue('sources', sourcesFingerprint)
+        return fingerprint.hexdigest()
+
+    def hashPackagedSources(self):
+        """>>> hashPackagedSources() -> dict of relative path to hex digest
+        Returns the hashes of the Python files in the build directory.
+        """
+        return hashFiles(os.path.join(self.apkBuildDir, self.pythonSubPath),
+                         statePath=os.path.join(self.apkSyncStateDir, 'packaged-hashes.json'))
+
+    def loadRepackState(self):
+        """>>> loadRepackState() -> state or None
+        Load the state of the last build that the apks can be repacked from.
+        """
+        try:
+            with open(os.path.join(self.apkSyncStateDir, 'repack.json')) as stateFile:
+                return json.load(stateFile)
+        except (IOError, OSError, ValueError):
             return None
-        return apkPath
+
+    def saveRepackState(self, state):
+        """>>> saveRepackState(state)
+        Save the state of the last build, or delete it if 'state' is None.
+        """
+        statePath = os.path.join(self.apkSyncStateDir, 'repack.json')
+        if state is None:
+            if os.path.exists(statePath):
+                os.remove(statePath)
+            return
+        if mkDirs(self.apkSyncStateDir):
+            with open(statePath + '.tmp', 'w') as stateFile:
+                json.dump(state, stateFile, indent=2, sort_keys=True)
+            replaceFile(statePath + '.tmp', statePath)
+
+    @tracedPhase('repack state')
+    def recordRepackState(self, repackKey, apkPaths):
+        """>>> recordRepackState(repackKey, apkPaths)
+        Remember which Python files were packaged into the apks build by
+        Gradle and where, so later builds can replace them in the apks.
+        """
+        files = self.hashPackagedSources()
+        state = None
+        try:
+            packaged = findEntryPrefix(list(apkPaths.values())[0], files.keys()) \
+                if len(files) > 0 else None
+        except (IOError, OSError, zipfile.BadZipfile) as e:
+            self.config.logger.verbose('Failed to read the entries of the apk: {error}', error=e)
+            packaged = None
+        if packaged is None:
+            self.config.logger.verbose('The Python sources were not found in the apk, '
+                                       'the apk can not be repacked without Gradle.')
+        else:
+            prefix, packagedPaths = packaged
+            state = {
+                'key': repackKey, 'prefix': prefix, 'apks': apkPaths,
+                'files': dict((relPath, files[relPath]) for relPath in packagedPaths),
+                'unpackaged': sorted(relPath for relPath in files if relPath not in packagedPaths),
+            }
+        self.saveRepackState(state)
+
+    @tracedPhase('repack')
+    def repackApks(self, repackKey):
+        """>>> repackApks(repackKey) -> dict of build type to apk path or None
+        Update the Python sources in the debug apks of the last build
+        without Gradle, if nothing but the content of packaged Python
+        files changed since then. Returns None if Gradle has to be used.
+        """
+        state = self.loadRepackState()
+        if state is None:
+            self.config.logger.verbose('The apk can not be repacked: There is no apk of an '
+                                       'earlier Gradle build with the same Python files.')
+            return None
+        if state['key'] != repackKey:
+            self.config.logger.verbose('The apk can not be repacked: The template or the app '
+                                       'configuration changed since the last Gradle build.')
+            return None
+        if not all(os.path.isfile(path) for path in state['apks'].values()):
+            return None
+        files = self.hashPackagedSources()
+        added = [relPath for relPath in files
+                 if relPath not in state['files'] and relPath not in state['unpackaged']]
+        if len(added) > 0:
+            self.config.logger.verbose('The apk can not be repacked: {num} Python files were '
+                                       'added.', num=len(added))
+            return None
+        changed = [relPath for relPath, fileHash in files.items()
+                   if relPath in state['files'] and state['files'][relPath] != fileHash]
+        removed = [relPath for relPath in state['files'] if relPath not in files]
+        if len(changed) == 0 and len(removed) == 0:
+            self.config.logger.info('The Python sources in the apk are up to date.')
+            return state['apks']
+        zipalignPath = findBuildTool(self.config.sdkPath, 'zipalign')
+        apksignerPath = findBuildTool(self.config.sdkPath, 'apksigner')
+        keystorePath = findDebugKeystore()
+        if zipalignPath is None or apksignerPath is None or keystorePath is None:
+            self.config.logger.verbose('The apk can not be repacked: zipalign, apksigner or the '
+                                       'debug keystore was not found.')
+            return None
+        self.config.logger.info('Repacking the apk with {changed} changed and {removed} removed '
+                                'Python files...', changed=len(changed), removed=len(removed))
+        pythonDir = os.path.join(self.apkBuildDir, self.pythonSubPath)
+        replacements = dict((state['prefix'] + relPath, os.path.join(pythonDir, relPath))
+                            for relPath in changed)
+        removals = set(state['prefix'] + relPath for relPath in removed)
+        for apkPath in state['apks'].values():
+            unsignedPath = apkPath + '.unsigned'
+            try:
+                rewriteApk(apkPath, unsignedPath, replacements, removals)
+                success = alignAndSign(unsignedPath, apkPath, zipalignPath, apksignerPath,
+                                       keystorePath, self.config.logger)
+            except (IOError, OSError, zipfile.BadZipfile) as e:
+                self.config.logger.warn('Failed to repack the apk {path}: {msg}'
+                                        .format(path=apkPath, msg=str(e)))
+                success = False
+            finally:
+                if os.path.exists(unsignedPath):
+                    os.remove(unsignedPath)
+            if not success:
+                # The apks might not match the state anymore
+                self.saveRepackState(None)
+                return None
+            self.config.tracer.count('apkBytes', os.path.getsize(apkPath))
+        self.config.tracer.count('repackedFiles', len(changed))
+        self.config.tracer.count('removedFiles', len(removed))
+        state['files'] = dict((relPath, files[relPath]) for relPath in state['files']
+                              if relPath in files)
+        self.saveRepackState(state)
+        return state['apks']
+
+    def buildWorkspace(self, workspace, stages, sharedPythonDir):
+        """>>> buildWorkspace(workspace, stages, sharedPythonDir) -> dict of build type to apk path
+        or None
+        Fill the template and update the Python sources of the workspace
+        and build its apks. If 'sharedPythonDir' is given, the prepared
+        Python sources are copied from there. Debug apks are repacked
+        without Gradle if only the Python sources changed.
+        """
+        self.useWorkspace(workspace)
+        if self.STAGE_TEMPLATE in stages or not workspace.isFilled:
+            if not self.fillTemplate():
+                return None
+            workspace.isFilled = True
+        if self.STAGE_SOURCES in stages:
+            if sharedPythonDir is None:
+                if not self.copyPythonSources():
+                    return None
+                if self.vendoredWheels and not self.stageVendoredWheels():
+                    return None
+                if self.precompile and not self.precompileSources():
+                    return None
+                if self.analyzeImports and not self.reportImports():
+                    return None
+            else:
+                with self.config.tracer.phase('share python sources'):
+                    if not self.syncWorkspace(
+                            sharedPythonDir, os.path.join(self.apkBuildDir, self.pythonSubPath),
+                            'python-shared'):
+                        return None
+        buildTypes = workspace.getBuildTypes()
+        repackKey = None
+        if self.fastRepack and buildTypes == ['debug']:
+            repackKey = self.getWorkspaceFingerprint(workspace, None)
+            apkPaths = self.repackApks(repackKey)
+            if apkPaths is not None:
+                return apkPaths
+        apkPaths = self.build(buildTypes)
+        if apkPaths is not None and repackKey is not None:
+            self.recordRepackState(repackKey, apkPaths)
+        return apkPaths
+
+    def buildApp(self, stages=(STAGE_TEMPLATE, STAGE_SOURCES)):
+        """>>> buildApp(stages) -> success
+        Run the build pipeline for all build variants and install
+        the apks, if requested. The template is only filled and the
+        Python sources are only updated if the corresponding stage is
+        in 'stages'. The Python sources are only prepared in the first
+        workspace that is build and copied from there into all other
+        workspaces. If the artifact cache contains the apks of an
+        earlier build with identical inputs, they are reused instead.
+        """
+        if (self.workspaces is None or self.STAGE_TEMPLATE in stages) and \
+                not self.loadVariants():
+            return False
+        artifactCache = sourcesFingerprint = None
+        if self.artifactCache:
+            artifactCache = ArtifactCache(
+                self.artifactCacheDir or os.path.join(self.config.templateDir, 'artifact-cache'),
+                self.config.logger, self.artifactCacheSize)
+            self.useWorkspace(self.workspaces[0])
+            sourcesFingerprint = self.getSourcesFingerprint()
+        sharedPythonDir = None
+        outputApkPaths = []
+        installTargets = []
+        for workspace in self.workspaces:
+            apkPaths = cacheKey = None
+            if artifactCache is not None:
+                cacheKey = self.getWorkspaceFingerprint(workspace, sourcesFingerprint)
+                if not self.cleanBuild:
+                    with self.config.tracer.phase('artifact cache'):
+                        apkPaths = artifactCache.lookup(cacheKey)
+                self.config.tracer.count('artifactCacheMisses' if apkPaths is None
+                                         else 'artifactCacheHits')
+                self.config.logger.info('Artifact cache {result} for {key}{action}'.format(
+                    result='miss' if apkPaths is None else 'hit', key=cacheKey[:12],
+                    action='' if apkPaths is None else ', reusing the apks of an identical build.'))
+            if apkPaths is None:
+                apkPaths = self.buildWorkspace(workspace, stages, sharedPythonDir)
+                if apkPaths is None:
+                    return False
+                sharedPythonDir = os.path.join(workspace.buildDir, self.pythonSubPath)
+                if artifactCache is not None:
+                    with self.config.tracer.phase('artifact cache'):
+                        artifactCache.store(cacheKey, apkPaths)
+            appId = (workspace.templateFiller.formatArgs or {}).get('appId')
+            for variant, buildTypes in workspace.variants:
+                variantApkPaths = [self.copyApkToOutput(apkPaths[buildType], variant)
+                                   for buildType in buildTypes]
+                outputApkPaths += variantApkPaths
+                # Only one build type of a variant can be installed at the same time
+                installTargets.append((variantApkPaths[0], appId))
+        self.useWorkspace(self.workspaces[0])
+        for outputApkPath in outputApkPaths:
+            self.config.logger.info('The apk was successfully build and is stored at:\n{path}'
+                                    .format(path=outputApkPath))
+        if self.doInstall:
+            from .install import run as run_install
+            for apkPath, appId in installTargets:
+                installArgs = ['--apkPath', apkPath]
+                if appId is not None:
+                    installArgs += ['--package', appId]
+                if not run_install(self.config, installArgs + (self.installArgs or [])):
+                    return False
+        return True
+
+    def getWatchedConfigFiles(self):
+        """>>> getWatchedConfigFiles() -> list of paths
+        Returns the paths to the configuration, icon and
+        manifest template files of the app.
+        """
+        paths = [self.sourceConfig]
+        for workspace in self.workspaces or []:
+            paths += [workspace.templateFiller.appIcon,
+                      workspace.templateFiller.appManifestTemplate]
+        return sorted(set(os.path.abspath(path) for path in paths if path is not None))
+
+    def watchSources(self):
+        """>>> watchSources() -> success
+        Watch the source directory and the configuration files of
+        the app and rebuild the apk after every change, until the
+        command is interrupted. Only the stages of the pipeline that
+        are affected by the changed files are executed again.
+        """
+        configFiles = self.getWatchedConfigFiles()
+        watcher = createWatcher([self.sourceDir] + configFiles, self.config.logger,
+                                usePolling=self.watchPolling)
+        self.config.logger.info('Watching {path} for changes using {watcher}, press Ctrl+C to '
+                                'stop...'.format(path=self.sourceDir,
+                                                 watcher=type(watcher).__name__))
+        try:
+            while True:
+                changeTime, changes = waitForChanges(watcher, self.watchDelay)
+                configChanged = any(path in configFiles for path in changes)
+                stages = [self.STAGE_SOURCES]
+                if configChanged:
+                    stages.insert(0, self.STAGE_TEMPLATE)
+                self.config.logger.info('Detected {num} changed path(s), rebuilding {stages}...'
+                                        .format(num=len(changes), stages=', '.join(stages)))
+                for path in sorted(changes):
+                    self.config.logger.verbose('Changed: ' + path)
+                startTime = time()
+                success = self.buildApp(stages)
+                endTime = time()
+                self.config.logger.info(
+                    'Rebuild {result} in {duration:.2f}s ({latency:.2f}s after the first change).'
+                    .format(result='succeeded' if success else 'failed',
+                            duration=endTime - startTime, latency=endTime - changeTime))
+                if configChanged and self.getWatchedConfigFiles() != configFiles:
+                    watcher.close()
+                    configFiles = self.getWatchedConfigFiles()
+                    watcher = createWatcher([self.sourceDir] + configFiles, self.config.logger,
+                                            usePolling=self.watchPolling)
+        except KeyboardInterrupt:
+            self.config.logger.info('Stopped watching for changes.')
+        finally:
+            watcher.close()
+        return True
 
     def run(self, cmdArgs):
         try:
@@ -169,33 +1302,14 @@ class ApkBuilder(object):
             return e.code == 0
         if not self.validateConfig():
             return False
-        if not deleteDir(self.apkBuildDir):
-            self.config.logger.error('Failed to delete the contents of the specified build '
-                                     'directory "{dir}"!'.format(dir=self.apkBuildDir))
+        if self.cleanBuild and not self.cleanWorkspace():
             return False
         if not self.ensureTemplate(not self.config.avoidNetwork):
             return False
-        if not self.fillTemplate():
-            return False
-        if not self.copyPythonSources():
-            return False
-        apkPath = self.build(self.buildDebug)
-        if apkPath is None:
-            return False
-        outputApkPath = None
-        if mkDirs(self.apkOutputDir):
-            shutil.copy(apkPath, self.apkOutputDir)
-            outputApkPath = os.path.join(self.apkOutputDir, os.path.basename(apkPath))
-            deleteDir(self.apkBuildDir)
-        if outputApkPath is None or not os.path.exists(outputApkPath):
-            self.config.logger.warn('Failed to copy the generated apk to the output directory.')
-            outputApkPath = apkPath
-        self.config.logger.info('The apk was successfully build and is stored at:\n{path}'
-                                .format(path=outputApkPath))
-        if self.doInstall:
-            from .install import run as run_install
-            return run_install(self.config, self.installArgs)
-        return True
+        success = self.buildApp()
+        if self.watch:
+            return self.watchSources()
+        return success
 
 
 def run(config, cmdArgs):
@@ -0,0 +1,257 @@
+from __future__ import absolute_import
+
+import copy
+import os
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from time import time
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+from .apk import ApkBuilder
+from ..logger import Logger
+from ..utils.argparser import SubCmdArgParser, ArgumentParserError, InfoActionProcessed
+from ..utils.files import mkDirs, resolvePath
+
+
+class BatchApp(object):
+    """An app from the batch manifest."""
+    name = None
+    sourceDir = None
+    sourceConfig = None
+    buildDebug = None
+    install = None
+    extraArgs = None
+    success = False
+    duration = 0
+    logPath = None
+
+    def __init__(self, name):
+        self.name = name
+        self.extraArgs = []
+
+
+class BatchBuilder(object):
+    config = None
+    manifestPath = None
+    jobs = None
+    cpusPerBuild = 2
+    memoryPerBuild = 2048  # In MB
+    selectedApps = None
+    batchBuildDir = None
+
+    def __init__(self, config):
+        self.config = config
+        self.batchBuildDir = os.path.join(config.buildDir, 'batch')
+        self.readConfig()
+
+    def readConfig(self):
+        section = self.config.getSection('batch')
+        if section is None:
+            return
+        if section.hasOption('manifest'):
+            self.manifestPath = section.get('manifest', evaluatePath=True)
+        if section.hasOption('jobs'):
+            self.jobs = int(section.get('jobs'))
+        if section.hasOption('cpusPerBuild'):
+            self.cpusPerBuild = int(section.get('cpusPerBuild'))
+        if section.hasOption('memoryPerBuild'):
+            self.memoryPerBuild = int(section.get('memoryPerBuild'))
+
+    def parseCmdArgs(self, args):
+        parser = SubCmdArgParser(
+            prog='build.py batch',
+            description='Build multiple apps listed in a manifest file concurrently. Every '
+                        'section of the manifest describes one app with the options sourceDir, '
+                        'sourceConfig, buildDebug, install (the device to install the app on or '
+                        '"true" to install it on the default device) and args (additional '
+                        'arguments for the apk command).')
+        parser.add_argument('--manifest', help='The path to the manifest file.')
+        parser.add_argument('--jobs', type=int,
+                            help='The maximum number of apps that are build at the same time. '
+                                 'Defaults to a value based on the number of CPUs and the '
+                                 'available memory.')
+        parser.add_argument('--apps', nargs='+', help='Only build the apps with these names.')
+        cmdArgs = parser.parse_args(args)
+        if 'manifest' in cmdArgs and cmdArgs.manifest is not None:
+            self.manifestPath = resolvePath(cmdArgs.manifest, self.config.currDir)
+        if 'jobs' in cmdArgs and cmdArgs.jobs is not None:
+            self.jobs = cmdArgs.jobs
+        if 'apps' in cmdArgs and cmdArgs.apps is not None:
+            self.selectedApps = cmdArgs.apps
+
+    def loadManifest(self):
+        """>>> loadManifest() -> list of BatchApp or None
+        Read the apps from the manifest file.
+        """
+        if self.manifestPath is None:
+            self.config.logger.error('The path to the batch manifest was not specified!')
+            return None
+        parser = RawConfigParser()
+        if self.manifestPath not in parser.read(self.manifestPath):
+            self.config.logger.error('Failed to read the batch manifest from {path}'
+                                     .format(path=self.manifestPath))
+            return None
+        manifestDir = os.path.dirname(self.manifestPath)
+        apps = []
+        for name in parser.sections():
+            if self.selectedApps is not None and name not in self.selectedApps:
+                continue
+            app = BatchApp(name)
+            if not parser.has_option(name, 'sourceDir'):
+                self.config.logger.error('The app {name} in the batch manifest has no sourceDir!'
+                                         .format(name=name))
+                return None
+            app.sourceDir = resolvePath(parser.get(name, 'sourceDir'), manifestDir)
+            if parser.has_option(name, 'sourceConfig'):
+                app.sourceConfig = resolvePath(parser.get(name, 'sourceConfig'), manifestDir)
+            if parser.has_option(name, 'buildDebug'):
+                app.buildDebug = parser.getboolean(name, 'buildDebug')
+            if parser.has_option(name, 'install'):
+                app.install = parser.get(name, 'install').strip()
+            if parser.has_option(name, 'args'):
+                app.extraArgs = parser.get(name, 'args').split()
+            apps.append(app)
+        for name in self.selectedApps or []:
+            if name not in [app.name for app in apps]:
+                self.config.logger.warn('The app {name} is not in the batch manifest.'
+                                        .format(name=name))
+        return apps
+
+    @staticmethod
+    def getAvailableMemory():
+        """>>> getAvailableMemory() -> megabytes or None
+        Returns the amount of memory that is available
+        for new processes in megabytes, if it is known.
+        """
+        try:
+            with open('/proc/meminfo') as memInfo:
+                for line in memInfo:
+                    if line.startswith('MemAvailable:'):
+                        return int(line.split()[1]) // 1024
+        except (IOError, OSError, ValueError):
+            pass
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // (1024 * 1024)
+        except (AttributeError, ValueError, OSError):
+            return None
+
+    def getConcurrency(self, numApps):
+        """>>> getConcurrency(numApps) -> number of jobs
+        Returns the number of apps to build at the same time.
+        """
+        if self.jobs is not None:
+            return max(1, min(self.jobs, numApps))
+        jobs = max(1, cpu_count() // max(1, self.cpusPerBuild))
+        availableMemory = self.getAvailableMemory()
+        if availableMemory is not None:
+            jobs = min(jobs, max(1, availableMemory // max(1, self.memoryPerBuild)))
+        return max(1, min(jobs, numApps))
+
+    def createAppConfig(self, app):
+        """>>> createAppConfig(app) -> Config
+        Create a copy of the configuration with a separate
+        build directory, output directory and log file.
+        """
+        appConfig = copy.copy(self.config)
+        appConfig.buildDir = os.path.join(self.batchBuildDir, app.name)
+        appConfig.outputDir = os.path.join(self.config.outputDir, app.name)
+        appConfig.avoidNetwork = True  # The template was already updated for the whole batch
+        appConfig.logger = Logger()
+        appConfig.logger.setPriority(self.config.logger.getLogPriority())
+        appConfig.logger.setFormat(self.config.logger.getFormat())
+        appConfig.logger.setStageSource(self.config.logger.getStageSource())
+        app.logPath = os.path.join(self.batchBuildDir, app.name + '.log')
+        appConfig.logger.setLogFile(app.logPath)
+        return appConfig
+
+    def buildApp(self, app):
+        """>>> buildApp(app) -> app
+        Build the app in its own workspace and
+        record the result and the duration.
+        """
+        startTime = time()
+        appConfig = self.createAppConfig(app)
+        self.config.logger.info('Building {name}...'.format(name=app.name))
+        try:
+            apkBuilder = ApkBuilder(appConfig)
+            apkBuilder.sourceDir = app.sourceDir
+            apkBuilder.sourceConfig = app.sourceConfig
+            if app.buildDebug is not None:
+                apkBuilder.buildDebug = app.buildDebug
+            if app.install is not None and app.install.lower() not in ['false', 'no', '0']:
+                apkBuilder.doInstall = True
+                apkBuilder.installArgs = [] if app.install.lower() in ['true', 'yes', '1'] \
+                    else ['--device', app.install]
+            app.success = apkBuilder.run(app.extraArgs)
+        except Exception as e:
+            import traceback
+            appConfig.logger.error('Caught exception: ' + str(e))
+            traceback.print_exc(file=appConfig.logger.getOutput())
+            app.success = False
+        finally:
+            appConfig.logger.closeLogFile()
+        app.duration = time() - startTime
+        self.config.logger.info('Building {name} {result} after {duration:.1f}s.'.format(
+            name=app.name, result='succeeded' if app.success else 'FAILED',
+            duration=app.duration))
+        return app
+
+    def printSummary(self, apps, duration):
+        """>>> printSummary(apps, duration)
+        Print a table with the result and duration of every build.
+        """
+        nameWidth = max([len('App')] + [len(app.name) for app in apps])
+        lines = ['{name:<{width}}  {result:<7}  {duration:>9}  Log'.format(
+            name='App', width=nameWidth, result='Result', duration='Duration')]
+        for app in sorted(apps, key=lambda app: app.name):
+            lines.append('{name:<{width}}  {result:<7}  {duration:>8.1f}s  {log}'.format(
+                name=app.name, width=nameWidth, result='OK' if app.success else 'FAILED',
+                duration=app.duration, log=app.logPath))
+        numFailed = len([app for app in apps if not app.success])
+        lines.append('{num} apps build in {duration:.1f}s, {failed} failed.'.format(
+            num=len(apps), duration=duration, failed=numFailed))
+        self.config.logger.info('Batch summary:\n' + '\n'.join(lines))
+
+    def run(self, cmdArgs):
+        try:
+            self.parseCmdArgs(cmdArgs)
+        except InfoActionProcessed:
+            return True
+        except ArgumentParserError as e:
+            return e.code == 0
+        apps = self.loadManifest()
+        if apps is None:
+            return False
+        if len(apps) == 0:
+            self.config.logger.warn('There are no apps to build in the batch manifest.')
+            return True
+        if not mkDirs(self.batchBuildDir):
+            self.config.logger.error('Failed to create the batch build directory {path}'
+                                     .format(path=self.batchBuildDir))
+            return False
+        templateBuilder = ApkBuilder(self.config)
+        if templateBuilder.templateGit is None:
+            self.config.logger.error('The url to the template repository git file '
+                                     'was not specified!')
+            return False
+        if not templateBuilder.ensureTemplate(not self.config.avoidNetwork):
+            return False
+        jobs = self.getConcurrency(len(apps))
+        self.config.logger.info('Building {num} apps with {jobs} concurrent builds...'
+                                .format(num=len(apps), jobs=jobs))
+        startTime = time()
+        pool = ThreadPool(jobs)
+        try:
+            apps = pool.map(self.buildApp, apps)
+        finally:
+            pool.close()
+        self.printSummary(apps, time() - startTime)
+        return all(app.success for app in apps)
+
+
+def run(config, cmdArgs):
+    batchBuilder = BatchBuilder(config)
+    return batchBuilder.run(cmdArgs)
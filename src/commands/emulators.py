@@ -0,0 +1,77 @@
+from __future__ import absolute_import
+
+from time import time
+
+from .install import ADBHandler
+from ..utils.argparser import SubCmdArgParser, ArgumentParserError, InfoActionProcessed
+
+
+class EmulatorPoolManager(object):
+    config = None
+    action = None
+    avds = None
+
+    def __init__(self, config):
+        self.config = config
+
+    def parseCmdArgs(self, args):
+        parser = SubCmdArgParser(
+            prog='build.py emulators',
+            description='Manage the pool of emulators configured in the emulators section of '
+                        'the config file, which the install command keeps running and reuses.')
+        parser.add_argument('action', choices=['status', 'start', 'stop', 'stopIdle'],
+                            help='"status" lists the running emulators of the pool, "start" '
+                                 'starts the emulators, "stop" stops all emulators that are not '
+                                 'in use and "stopIdle" only the ones that were idle for longer '
+                                 'than the idle timeout.')
+        parser.add_argument('avds', nargs='*',
+                            help='The AVDs to start or stop. Defaults to all AVDs of the pool.')
+        cmdArgs = parser.parse_args(args)
+        self.action = cmdArgs.action
+        if len(cmdArgs.avds) > 0:
+            self.avds = cmdArgs.avds
+
+    def printStatus(self, pool):
+        status = pool.getStatus()
+        if len(status) == 0:
+            self.config.logger.info('No emulator of the pool is running.')
+            return
+        lines = ['{avd:<24}  {device:<14}  {state:<16}  Idle'.format(
+            avd='AVD', device='Device', state='State')]
+        for avd, entry in sorted(status.items()):
+            state = 'idle' if entry['leasedBy'] is None \
+                else 'leased by {pid}'.format(pid=entry['leasedBy'])
+            idleTime = '-' if entry['leasedBy'] is not None \
+                else '{time:.0f}s'.format(time=time() - entry['lastUsed'])
+            lines.append('{avd:<24}  {device:<14}  {state:<16}  {idle}'.format(
+                avd=avd, device=entry['device'], state=state, idle=idleTime))
+        self.config.logger.info('Emulator pool:\n' + '\n'.join(lines))
+
+    def run(self, cmdArgs):
+        try:
+            self.parseCmdArgs(cmdArgs)
+        except InfoActionProcessed:
+            return True
+        except ArgumentParserError as e:
+            return e.code == 0
+        adbHandler = ADBHandler(self.config)
+        if not adbHandler.findSdkTools():
+            return False
+        pool = adbHandler.createEmulatorPool()
+        if pool is None:
+            self.config.logger.error('No emulators are configured in the emulators section of '
+                                     'the config file.')
+            return False
+        if self.action == 'start':
+            started = pool.start(self.avds)
+            self.config.logger.info('Started {num} emulator(s).'.format(num=len(started)))
+        elif self.action in ['stop', 'stopIdle']:
+            stopped = pool.shutdown(self.avds, idleOnly=self.action == 'stopIdle')
+            self.config.logger.info('Stopped {num} emulator(s).'.format(num=stopped))
+        self.printStatus(pool)
+        return True
+
+
+def run(config, cmdArgs):
+    poolManager = EmulatorPoolManager(config)
+    return poolManager.run(cmdArgs)
@@ -1,12 +1,20 @@
 from __future__ import absolute_import
 
 import os
+import re
 import subprocess
 import sys
-from time import sleep
+from fnmatch import fnmatch
+from multiprocessing.pool import ThreadPool
+from time import time
 
+from ..utils.adb import EMULATOR_PORTS, findFreeEmulatorPort, waitForBoot
 from ..utils.argparser import SubCmdArgParser, InfoActionProcessed, ArgumentParserError
-from ..utils.files import resolvePath
+from ..utils.emulatorpool import EmulatorPool
+from ..utils.files import fileDigest, resolvePath
+from ..utils.process import runProcess
+from ..utils.repack import findBuildTool
+from ..utils.timing import tracedPhase
 
 
 class ADBHandler(object):
@@ -17,12 +25,34 @@ class ADBHandler(object):
     emulator = None
     preferEmulator = False
     device = None
+    allDevices = False
+    devicePatterns = None
+    jobs = 8
+    bootTimeout = 180
+    emulatorProcess = None
+    emulatorDevice = None
+    emulatorPool = None
+    poolAvds = None
+    poolIdleTimeout = 900
+    poolSnapshots = True
+    poolStateDir = None
+    packageName = None
+    skipUnchanged = True
+    apkHash = None
+    # The directory on the device where the hashes of installed apks are
+    # stored for devices that can't hash the installed apk themselves.
+    DEVICE_HASH_DIR = '/data/local/tmp/pytoapk'
+    _PACKAGE_REGEX = re.compile(r'\A[a-zA-Z_][a-zA-Z0-9_]*(\.[a-zA-Z_][a-zA-Z0-9_]*)*\Z')
+    _BADGING_PACKAGE_REGEX = re.compile(r"^package: name='([^']+)'", re.MULTILINE)
 
     def __init__(self, config):
         self.config = config
         self.readConfig()
 
-    def verifyArguments(self):
+    def findSdkTools(self):
+        """>>> findSdkTools() -> success
+        Find the adb and emulator executables in the sdk.
+        """
         valid = True
         if self.config.sdkPath is None:
             self.config.logger.error('The path to the sdk directory was not specified!')
@@ -41,6 +71,10 @@ class ADBHandler(object):
                 self.config.logger.error('Failed to find the emulator executable in {path}'
                                          .format(path=self.emulatorPath))
                 valid = False
+        return valid
+
+    def verifyArguments(self):
+        valid = self.findSdkTools()
         if self.apkPath is None:
             self.apkPath = self.getNewestGeneratedApk()
         if self.apkPath is None:
@@ -66,6 +100,42 @@ class ADBHandler(object):
             self.apkPath = section.get('apkPath', evaluatePath=True)
         if section.hasOption('device'):
             self.device = section.get('device')
+        if not self.allDevices and section.hasOption('allDevices'):
+            self.allDevices = section.getBoolean('allDevices')
+        if section.hasOption('devices'):
+            self.devicePatterns = section.get('devices').split()
+        if section.hasOption('jobs'):
+            self.jobs = int(section.get('jobs'))
+        if section.hasOption('skipUnchanged'):
+            self.skipUnchanged = section.getBoolean('skipUnchanged')
+        if section.hasOption('bootTimeout'):
+            self.bootTimeout = float(section.get('bootTimeout'))
+        self.readPoolConfig()
+
+    def readPoolConfig(self):
+        section = self.config.getSection('emulators')
+        if section is None:
+            return
+        if section.hasOption('avds'):
+            self.poolAvds = section.get('avds').split()
+        if section.hasOption('idleTimeout'):
+            self.poolIdleTimeout = float(section.get('idleTimeout'))
+        if section.hasOption('snapshots'):
+            self.poolSnapshots = section.getBoolean('snapshots')
+        if section.hasOption('stateDir'):
+            self.poolStateDir = section.get('stateDir', evaluatePath=True)
+
+    def createEmulatorPool(self):
+        """>>> createEmulatorPool() -> EmulatorPool or None
+        Create the pool of the emulators configured in
+        the emulators section, if there are any.
+        """
+        if not self.poolAvds:
+            return None
+        stateDir = self.poolStateDir or os.path.join(self.config.buildDir, 'emulators')
+        return EmulatorPool(stateDir, self.emulatorPath, self.adbPath, self.config.logger,
+                            self.poolAvds, self.poolIdleTimeout, self.poolSnapshots,
+                            self.bootTimeout)
 
     def parseCmdArgs(self, args):
         parser = SubCmdArgParser(prog='build.py install')  # TODO: Description
@@ -85,15 +155,45 @@ class ADBHandler(object):
                             default=self.preferEmulator,
                             help='If specified and --device is not specified, the install command '
                                  'will prefer an emulator as the installation target.')
+        parser.add_argument('--allDevices', action='store_true', default=self.allDevices,
+                            help='If specified, the apk is installed on all connected devices '
+                                 'and running emulators at the same time.')
+        parser.add_argument('--devices', nargs='+', metavar='PATTERN',
+                            help='Install the apk on all connected devices whose name matches '
+                                 'one of the patterns (e.g. "emulator-*"), at the same time.')
+        parser.add_argument('--jobs', type=int,
+                            help='The maximum number of devices to install the apk on at the '
+                                 'same time, when installing on multiple devices. Defaults to 8.')
+        parser.add_argument('--bootTimeout', type=float,
+                            help='The number of seconds to wait for a device to connect and '
+                                 'finish booting. Defaults to 180.')
+        parser.add_argument('--package',
+                            help='The package name of the app in the apk. Only needed if the '
+                                 'aapt tool of the sdk build tools is not installed.')
+        parser.add_argument('--force', action='store_true',
+                            help='If specified, the apk is installed even if the identical apk '
+                                 'is already installed on the device.')
         cmdArgs = parser.parse_args(args)
         if 'emulator' in cmdArgs and cmdArgs.emulator is not None:
             self.emulator = cmdArgs.emulator
         if 'device' in cmdArgs and cmdArgs.device is not None:
-            self.device = cmdArgs.sourceDir
+            self.device = cmdArgs.device
         if 'apkPath' in cmdArgs and cmdArgs.apkPath is not None:
             self.apkPath = resolvePath(cmdArgs.apkPath, self.config.currDir)
         if 'preferEmulator' in cmdArgs and cmdArgs.preferEmulator is not None:
             self.preferEmulator = cmdArgs.preferEmulator
+        if 'allDevices' in cmdArgs and cmdArgs.allDevices is not None:
+            self.allDevices = cmdArgs.allDevices
+        if 'devices' in cmdArgs and cmdArgs.devices is not None:
+            self.devicePatterns = cmdArgs.devices
+        if 'jobs' in cmdArgs and cmdArgs.jobs is not None:
+            self.jobs = cmdArgs.jobs
+        if 'bootTimeout' in cmdArgs and cmdArgs.bootTimeout is not None:
+            self.bootTimeout = cmdArgs.bootTimeout
+        if 'package' in cmdArgs and cmdArgs.package is not None:
+            self.packageName = cmdArgs.package
+        if 'force' in cmdArgs and cmdArgs.force:
+            self.skipUnchanged = False
 
     def getNewestGeneratedApk(self):
         apkOutputDir = os.path.join(self.config.outputDir, 'apk')
@@ -111,6 +211,7 @@ class ADBHandler(object):
                 return newestApk
         return None
 
+    @tracedPhase('find devices')
     def getConnectedDevices(self):
         args = [self.adbPath, 'devices']
         self.config.logger.verbose('Calling ' + subprocess.list2cmdline(args))
@@ -127,51 +228,48 @@ class ADBHandler(object):
                 devices.append(content[0])
         return devices
 
-    def startEmulator(self):
+    @tracedPhase('start emulator')
+    def startEmulator(self, devices=()):
+        """>>> startEmulator(devices) -> device name or None
+        Start the emulator on a free console port, so its
+        device name is known without parsing its output.
+        'devices' are the names of the connected devices.
+        If the requested device is an emulator, its port is used.
+        """
         if self.emulator is None:
             self.config.logger.error('No emulator to start was specified.')
             return None
-        args = [self.emulatorPath, '-avd', self.emulator.replace(' ', '_')]
+        ports = EMULATOR_PORTS
+        if self.device is not None and self.device.startswith('emulator-') and \
+                self.device[len('emulator-'):].isdigit():
+            ports = [int(self.device[len('emulator-'):])]
+        port = findFreeEmulatorPort(devices, ports)
+        if port is None:
+            self.config.logger.error('Failed to find a free port for emulator {name}'
+                                     .format(name=self.emulator))
+            return None
+        args = [self.emulatorPath, '-avd', self.emulator.replace(' ', '_'),
+                '-port', str(port)]
         self.config.logger.info('Starting emulator {name}...'.format(name=self.emulator))
         self.config.logger.verbose('Calling ' + subprocess.list2cmdline(args))
-        emulatorProcess = subprocess.Popen(args, stdout=subprocess.PIPE)
-        self.config.logger.info('Waiting for emulator {name}...'.format(name=self.emulator))
-        for line in iter(emulatorProcess.stdout.readline, ''):
-            start = line.find('emulator-')
-            end = start + len('emulator-')
-            if start == -1 or len(line) < end:
-                continue
-            if line[end].isdigit():
-                while len(line) > end and line[end].isdigit():
-                    end += 1
-                return line[start:end]
-        self.config.logger.error('Failed to start emulator {name}'.format(name=self.emulator))
-        return None
+        try:
+            with open(os.devnull, 'w') as devNull:
+                self.emulatorProcess = subprocess.Popen(args, stdout=devNull)
+        except OSError as e:
+            self.config.logger.error('Failed to start emulator {name}: {msg}'
+                                     .format(name=self.emulator, msg=str(e)))
+            return None
+        self.emulatorDevice = 'emulator-{port}'.format(port=port)
+        return self.emulatorDevice
 
+    @tracedPhase('wait for boot')
     def ensureDeviceOnline(self, device):
         self.config.logger.info('Waiting for device {name} to come online...'.format(name=device))
-        args = [self.adbPath, '-s', device, 'wait-for-device']
-        self.config.logger.verbose('Calling ' + subprocess.list2cmdline(args))
-        if not subprocess.call(args) == 0:
-            self.config.logger.error('Failed to wait for online state of device {name}'
-                                     .format(name=device))
-            return False
-        args = [self.adbPath, '-s', device, 'shell', 'getprop', 'sys.boot_completed']
-        try:
-            numTries = 0
-            while subprocess.check_output(args)[0] != '1':
-                sleep(1)
-                numTries += 1
-                if numTries > 3 * 60:
-                    self.config.logger.error('Boot time out: Device {name} took too long to boot!'
-                                             .format(name=device))
-                    return False
-        except subprocess.CalledProcessError as e:
-            self.config.logger.error('Failed to call "{cmd}": {msg}'
-                                     .format(cmd=subprocess.list2cmdline(args), msg=str(e)))
-            return False
-        return True
+        emulatorProcess = self.emulatorProcess if device == self.emulatorDevice else None
+        return waitForBoot(self.adbPath, device, self.config.logger, self.bootTimeout,
+                           emulatorProcess)
 
+    @tracedPhase('install apk')
     def install(self, cmdArgs):
         try:
             self.parseCmdArgs(cmdArgs)
@@ -181,12 +279,37 @@ class ADBHandler(object):
             return e.code == 0
         if not self.verifyArguments():
             return False
+        self.emulatorPool = self.createEmulatorPool()
+        if self.emulatorPool is not None:
+            self.emulatorPool.shutdown(idleOnly=True)
+        if self.skipUnchanged:
+            if self.packageName is None:
+                self.packageName = self.getApkPackage()
+            if self.packageName is not None and \
+                    self._PACKAGE_REGEX.search(self.packageName) is None:
+                self.config.logger.error('Invalid package name: ' + self.packageName)
+                return False
+            with self.config.tracer.phase('hash apk'):
+                self.apkHash = fileDigest(self.apkPath, algorithm='sha256')
         devices = self.getConnectedDevices()
         if devices is None:
             self.config.logger.error('Failed to detect connected devices!')
             return False
+        if self.allDevices or self.devicePatterns is not None:
+            targets = [device for device in devices if self.devicePatterns is None or
+                       any(fnmatch(device, pattern) for pattern in self.devicePatterns)]
+            if len(targets) == 0:
+                self.config.logger.error('None of the connected devices matches the patterns: '
+                                         '{patterns}'.format(
+                                             patterns=' '.join(self.devicePatterns or ['*'])))
+                return False
+            return self.installOnDevices(targets)
+        if self.device is None and self.emulatorPool is not None and \
+                (self.emulator is None or self.emulator.replace(' ', '_') in self.poolAvds) and \
+                (self.preferEmulator or all(device.startswith('emulator-') for device in devices)):
+            return self.installOnPoolEmulator()
         if len(devices) == 0 or self.device is not None and self.device not in devices:
-            device = self.startEmulator()
+            device = self.startEmulator(devices)
             if device is None:
                 return False
             elif self.device is not None and device != self.device:
@@ -200,8 +323,9 @@ class ADBHandler(object):
             physicalDevices = [device for device in devices
                                if not device.startswith('emulator')]
             if len(physicalDevices) > 1:
-                self.config.logger.error('Multiple devices are connected, '
-                                         'but no device name was specified.')
+                self.config.logger.error('Multiple devices are connected, but no device name '
+                                         'was specified. Use --allDevices to install the apk '
+                                         'on all of them.')
                 return False
             elif len(physicalDevices) == 1 and not (len(devices) == 2 and self.preferEmulator):
                 installTarget = physicalDevices[0]
@@ -212,28 +336,193 @@ class ADBHandler(object):
                     return False
                 installTarget = [device for device in devices
                                  if device not in physicalDevices][0]
-        if not self.ensureDeviceOnline(installTarget):
-            return False
-        args = [self.adbPath, '-s', installTarget, 'install', '-rtd', self.apkPath]
-        self.config.logger.info('Installing apk {path} on device {name}'
-                                .format(path=self.apkPath, name=installTarget))
+        return self.installOnDevice(installTarget)[0]
+
+    def findBuildTool(self, name):
+        """>>> findBuildTool(name) -> path or None
+        Returns the path to the tool in the newest
+        installed version of the sdk build tools.
+        """
+        return findBuildTool(self.config.sdkPath, name)
+
+    @tracedPhase('read package name')
+    def getApkPackage(self):
+        """>>> getApkPackage() -> package name or None
+        Read the package name of the app from the apk with aapt.
+        """
+        aaptPath = self.findBuildTool('aapt')
+        if aaptPath is None:
+            self.config.logger.warn('Failed to find aapt in the sdk build tools, the apk will be '
+                                    'installed even if it is unchanged. Use --package to specify '
+                                    'the package name of the app.')
+            return None
+        args = [aaptPath, 'dump', 'badging', self.apkPath]
         self.config.logger.verbose('Calling ' + subprocess.list2cmdline(args))
         try:
             output = subprocess.check_output(args, universal_newlines=True)
-            if 'Success' in output:
-                self.config.logger.verbose(output)
-                return True
-            if 'Failure' in output:
-                self.config.logger.error([line for line in output.split(b'\n')
-                                          if 'Failure' in line][0])
-            else:
-                self.config.logger.error(output)
-        except subprocess.CalledProcessError as e:
-            self.config.logger.error('Command "{cmd}" failed on device {name}: {msg}'.format(
-                cmd=subprocess.list2cmdline(args), name=installTarget, msg=str(e)))
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.config.logger.warn('Failed to read the package name from the apk: ' + str(e))
+            return None
+        match = self._BADGING_PACKAGE_REGEX.search(output)
+        return None if match is None else match.group(1)
+
+    @tracedPhase('query device')
+    def queryDevice(self, device):
+        """>>> queryDevice(device) -> (sdk version, installed apk hash or None, can hash)
+        Query the Android sdk version of the device and the sha256 hash
+        of the installed apk of the package with a single shell call.
+        If the device can't hash the installed apk, the hash stored
+        on the device at the last installation is returned instead.
+        """
+        command = 'getprop ro.build.version.sdk; '
+        if self.packageName is not None:
+            command += ('p=$(pm path {package} 2>/dev/null | head -n 1); p=${{p#package:}}; '
+                        'if [ -n "$p" ]; then sha256sum "$p" 2>/dev/null || echo "nosum $p"; '
+                        'cat {dir}/{package}.sha256 2>/dev/null; fi; true').format(
+                package=self.packageName, dir=self.DEVICE_HASH_DIR)
+        args = [self.adbPath, '-s', device, 'shell', command]
+        self.config.logger.verbose('Calling ' + subprocess.list2cmdline(args))
+        try:
+            lines = subprocess.check_output(args, universal_newlines=True).splitlines()
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.config.logger.warn('Failed to query device {name}: {msg}'
+                                    .format(name=device, msg=str(e)))
+            return 0, None, False
+        lines = [line.strip() for line in lines]
+        sdkVersion = int(lines[0]) if len(lines) > 0 and lines[0].isdigit() else 0
+        if len(lines) < 2 or lines[1] == '':
+            return sdkVersion, None, True
+        installed = lines[1].split(None, 1)
+        if installed[0] != 'nosum':
+            return sdkVersion, installed[0], True
+        stored = lines[2].split(None, 1) if len(lines) > 2 else []
+        if len(stored) == 2 and len(installed) == 2 and stored[1] == installed[1]:
+            return sdkVersion, stored[0], False
+        return sdkVersion, None, False
+
+    @tracedPhase('store apk hash')
+    def storeInstalledHash(self, device):
+        """>>> storeInstalledHash(device)
+        Store the hash of the installed apk on the device,
+        together with the path of the installed apk.
+        """
+        command = ('p=$(pm path {package} 2>/dev/null | head -n 1); p=${{p#package:}}; '
+                   'mkdir -p {dir} && echo "{hash} $p" > {dir}/{package}.sha256').format(
+            package=self.packageName, dir=self.DEVICE_HASH_DIR, hash=self.apkHash)
+        args = [self.adbPath, '-s', device, 'shell', command]
+        if not runProcess(args, self.config.logger).success:
+            self.config.logger.warn('Failed to store the hash of the installed apk on device '
+                                    '{name}'.format(name=device))
+
+    def getInstallMode(self, sdkVersion):
+        """>>> getInstallMode(sdkVersion) -> (name, adb install arguments)
+        Returns the fastest install mode supported by the Android version.
+        Incremental installs need the v4 signature (.idsig) of the apk,
+        streamed installs need the cmd service of Android 7 (API 24).
+        """
+        if sdkVersion >= 30 and os.path.isfile(self.apkPath + '.idsig'):
+            return 'incremental', ['--incremental']
+        if sdkVersion >= 24:
+            return 'streamed', ['--streaming']
+        return 'legacy', ['--no-streaming']
+
+    def installOnPoolEmulator(self):
+        """>>> installOnPoolEmulator() -> success
+        Lease an emulator from the pool, install the apk
+        on it and return it to the pool afterwards.
+        """
+        avd = None if self.emulator is None else self.emulator.replace(' ', '_')
+        with self.config.tracer.phase('lease emulator'):
+            device, process = self.emulatorPool.lease(avd)
+        if device is None:
+            return False
+        self.emulatorProcess, self.emulatorDevice = process, device
+        try:
+            return self.installOnDevice(device)[0]
+        finally:
+            self.emulatorPool.release(device)
+
+    def installOnDevice(self, device):
+        """>>> installOnDevice(device) -> (success, message)
+        Wait for the device to come online and install the apk on it,
+        unless the identical apk is already installed. Returns whether
+        the installation succeeded and a short description of the result.
+        """
+        if not self.ensureDeviceOnline(device):
+            return False, 'The device did not come online'
+        sdkVersion, installedHash, canHash = self.queryDevice(device)
+        if self.apkHash is not None and installedHash == self.apkHash:
+            self.config.logger.info('The apk {path} is already installed on device {name}, '
+                                    'skipping the installation.'
+                                    .format(path=self.apkPath, name=device))
+            return True, 'Unchanged'
+        modeName, modeArgs = self.getInstallMode(sdkVersion)
+        args = [self.adbPath, '-s', device, 'install', '-rtd'] + modeArgs + [self.apkPath]
+        self.config.logger.info('Installing apk {path} on device {name}'
+                                .format(path=self.apkPath, name=device))
+        startTime = time()
+        with self.config.tracer.phase('adb install'):
+            result = runProcess(args, self.config.logger)
+            success = result.success and any('Success' in line for line in result.tail)
+            if success:
+                self.config.tracer.count('transferredBytes', os.path.getsize(self.apkPath))
+        if success:
+            duration = time() - startTime
+            size = os.path.getsize(self.apkPath)
+            message = 'Transferred {size} bytes in {duration:.2f}s ({mode})'.format(
+                size=size, duration=duration, mode=modeName)
+            self.config.logger.info('Installed apk on device {name}: {message}, {rate:.1f} '
+                                    'MB/s'.format(name=device, message=message,
+                                                  rate=size / max(duration, 0.001) / 1e6))
+            if self.apkHash is not None and self.packageName is not None and not canHash:
+                self.storeInstalledHash(device)
+            return True, message
+        failures = [line.strip() for line in result.tail if 'Failure' in line]
+        if len(failures) > 0:
+            message = failures[0]
+        elif result.success:
+            message = result.getTail().strip()
+        else:
+            message = 'adb exited with code {code}'.format(code=result.returnCode)
+        self.config.logger.error('Command "{cmd}" failed on device {name}: {msg}'.format(
+            cmd=subprocess.list2cmdline(args), name=device, msg=message))
         self.config.logger.error('Failed to install apk {path} on device {name}'
-                                 .format(path=self.apkPath, name=installTarget))
-        return False
+                                 .format(path=self.apkPath, name=device))
+        return False, message
+
+    def installOnDevices(self, devices):
+        """>>> installOnDevices(devices) -> success
+        Install the apk on all devices at the same time, using at most
+        'jobs' concurrent installations, and print a table with the
+        result and duration of the installation on every device.
+        """
+        def timedInstall(device):
+            startTime = time()
+            success, message = self.installOnDevice(device)
+            return device, success, message, time() - startTime
+
+        jobs = max(1, min(self.jobs, len(devices)))
+        self.config.logger.info('Installing apk {path} on {num} devices with {jobs} concurrent '
+                                'installations...'.format(path=self.apkPath, num=len(devices),
+                                                          jobs=jobs))
+        startTime = time()
+        pool = ThreadPool(jobs)
+        try:
+            results = pool.map(timedInstall, devices)
+        finally:
+            pool.close()
+        nameWidth = max([len('Device')] + [len(device) for device in devices])
+        lines = ['{name:<{width}}  {result:<7}  {duration:>9}  Message'.format(
+            name='Device', width=nameWidth, result='Result', duration='Duration')]
+        for device, success, message, duration in results:
+            lines.append('{name:<{width}}  {result:<7}  {duration:>8.1f}s  {message}'.format(
+                name=device, width=nameWidth, result='OK' if success else 'FAILED',
+                duration=duration, message=message))
+        numFailed = len([result for result in results if not result[1]])
+        lines.append('Installed on {num} devices in {duration:.1f}s, {failed} failed.'.format(
+            num=len(devices), duration=time() - startTime, failed=numFailed))
+        self.config.logger.info('Install summary:\n' + '\n'.join(lines))
+        return numFailed == 0
 
 
 def run(config, cmdArgs):
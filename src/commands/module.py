@@ -1 +1,445 @@
+from __future__ import absolute_import
 
+import json
+import os
+import zipfile
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+from ..utils.argparser import SubCmdArgParser, ArgumentParserError, InfoActionProcessed
+from ..utils.files import mkDirs, replaceFile, resolvePath, syncDir
+from ..utils.ignore import IgnoreMatcher
+from ..utils.native import CPP_EXTENSIONS, TOOLCHAINS, CompileScheduler, CompileUnit, \
+    NdkToolchain, ObjectCache, createToolchain
+from ..utils.process import runProcess
+from ..utils.timing import tracedPhase
+
+
+class Extension(object):
+    """A C or C++ extension of the module, from an android_extension:<name> section."""
+    name = None
+    sources = None
+    includeDirs = None
+    defineMacros = None
+    libraries = None
+    libraryDirs = None
+    extraCompileArgs = None
+    extraLinkArgs = None
+
+    def __init__(self, name):
+        self.name = name
+        self.sources = []
+        self.includeDirs = []
+        self.defineMacros = []
+        self.libraries = []
+        self.libraryDirs = []
+        self.extraCompileArgs = []
+        self.extraLinkArgs = []
+
+    def getLibraryPath(self):
+        """>>> getLibraryPath() -> relative path
+        Returns the path of the shared library in the module, separated by '/'.
+        """
+        return self.name.replace('.', '/') + '.so'
+
+
+class ModuleBuilder(object):
+    # Sources of the extensions and build files, which are not packaged.
+    NATIVE_PATTERNS = ['*.c', '*.h', '*.cpp', '*.cc', '*.cxx', '*.c++', '*.hpp', '*.hh',
+                       '*.o', '*.so', '*.d', 'build/', '/setup.py', '/setup.cfg',
+                       '/pyproject.toml']
+
+    config = None
+    moduleBuildDir = None
+    moduleOutputDir = None
+    sourceDir = None
+    sourceConfig = None
+    moduleName = None
+    excludePatterns = None
+    toolchain = 'ndk'
+    abis = None
+    apiLevel = 21
+    pythonInclude = None
+    pythonLibDir = None
+    pythonLib = None
+    jobs = None
+    objectCache = True
+    objectCacheDir = None
+    extensions = None
+
+    def __init__(self, config):
+        self.config = config
+        self.moduleBuildDir = os.path.join(config.buildDir, 'module')
+        self.moduleOutputDir = os.path.join(config.outputDir, 'module')
+        self.abis = sorted(NdkToolchain.TARGETS.keys())
+        self.readConfig()
+
+    def readConfig(self):
+        section = self.config.getSection('module')
+        if section is None:
+            return
+        if section.hasOption('sourceDir'):
+            self.sourceDir = section.get('sourceDir', evaluatePath=True)
+        if section.hasOption('toolchain'):
+            self.toolchain = section.get('toolchain')
+        if section.hasOption('abis'):
+            self.abis = section.get('abis').split()
+        if section.hasOption('apiLevel'):
+            self.apiLevel = int(section.get('apiLevel'))
+        if section.hasOption('pythonInclude'):
+            self.pythonInclude = section.get('pythonInclude', evaluatePath=True)
+        if section.hasOption('pythonLibDir'):
+            self.pythonLibDir = section.get('pythonLibDir', evaluatePath=True)
+        if section.hasOption('pythonLib'):
+            self.pythonLib = section.get('pythonLib')
+        if section.hasOption('jobs'):
+            self.jobs = int(section.get('jobs'))
+        if section.hasOption('objectCache'):
+            self.objectCache = section.getBoolean('objectCache')
+        if section.hasOption('objectCacheDir'):
+            self.objectCacheDir = section.get('objectCacheDir', evaluatePath=True)
+
+    def parseCmdArgs(self, args):
+        parser = SubCmdArgParser(
+            prog='build.py module',
+            description='Package a Python module for Android and compile its C and C++ '
+                        'extensions for the Android ABIs.')
+        parser.add_argument('--sourceDir', help='The path to the directory of the module.')
+        parser.add_argument('--sourceConfig',
+                            help='The path to the file that contains the configuration of the '
+                                 'module and its extensions. Defaults to setup.cfg in the '
+                                 'sourceDir.')
+        parser.add_argument('--toolchain', choices=sorted(TOOLCHAINS.keys()),
+                            help='The toolchain to compile the extensions with. "ndk" (the '
+                                 'default) uses the Android NDK at ndkPath, "host" uses the C '
+                                 'compiler of this system and only serves to test the build.')
+        parser.add_argument('--abis', nargs='+', choices=sorted(NdkToolchain.TARGETS.keys()),
+                            help='The ABIs to compile the extensions for. Defaults to all.')
+        parser.add_argument('--apiLevel', type=int,
+                            help='The minimum Android API level to compile for. Defaults to 21.')
+        parser.add_argument('--pythonInclude',
+                            help='The directory of the Python headers for Android.')
+        parser.add_argument('--pythonLibDir',
+                            help='The directory of the Python library to link against. '
+                                 '"{abi}" is replaced by the ABI.')
+        parser.add_argument('--pythonLib',
+                            help='The name of the Python library to link against, '
+                                 'e.g. python3.8.')
+        parser.add_argument('--jobs', type=int,
+                            help='The number of files compiled at the same time. '
+                                 'Defaults to the number of CPUs.')
+        parser.add_argument('--noObjectCache', action='store_true',
+                            help='If specified, the object files of earlier builds are '
+                                 'not reused and every source is compiled.')
+        cmdArgs = parser.parse_args(args)
+        if 'sourceDir' in cmdArgs and cmdArgs.sourceDir is not None:
+            self.sourceDir = resolvePath(cmdArgs.sourceDir, self.config.currDir)
+        if 'sourceConfig' in cmdArgs and cmdArgs.sourceConfig is not None:
+            self.sourceConfig = resolvePath(cmdArgs.sourceConfig, self.config.currDir)
+        if 'toolchain' in cmdArgs and cmdArgs.toolchain is not None:
+            self.toolchain = cmdArgs.toolchain
+        if 'abis' in cmdArgs and cmdArgs.abis is not None:
+            self.abis = cmdArgs.abis
+        if 'apiLevel' in cmdArgs and cmdArgs.apiLevel is not None:
+            self.apiLevel = cmdArgs.apiLevel
+        if 'pythonInclude' in cmdArgs and cmdArgs.pythonInclude is not None:
+            self.pythonInclude = resolvePath(cmdArgs.pythonInclude, self.config.currDir)
+        if 'pythonLibDir' in cmdArgs and cmdArgs.pythonLibDir is not None:
+            self.pythonLibDir = resolvePath(cmdArgs.pythonLibDir, self.config.currDir)
+        if 'pythonLib' in cmdArgs and cmdArgs.pythonLib is not None:
+            self.pythonLib = cmdArgs.pythonLib
+        if 'jobs' in cmdArgs and cmdArgs.jobs is not None:
+            self.jobs = cmdArgs.jobs
+        if 'noObjectCache' in cmdArgs and cmdArgs.noObjectCache:
+            self.objectCache = False
+
+    @tracedPhase('validate config')
+    def validateConfig(self):
+        valid = True
+        if self.sourceDir is None:
+            valid = False
+            self.config.logger.error('The path to the source directory of the module '
+                                     'was not specified!')
+        elif not os.path.isdir(self.sourceDir):
+            valid = False
+            self.config.logger.error('The path to the source directory of the module does not '
+                                     'point to an existing directory: ' + self.sourceDir)
+        elif self.sourceConfig is None:
+            self.sourceConfig = os.path.join(self.sourceDir, 'setup.cfg')
+            if not os.path.isfile(self.sourceConfig):
+                self.sourceConfig = None
+        if self.toolchain not in TOOLCHAINS:
+            valid = False
+            self.config.logger.error('Unknown toolchain "{name}", expected one of {names}.'
+                                     .format(name=self.toolchain,
+                                             names=', '.join(sorted(TOOLCHAINS.keys()))))
+        elif self.toolchain == 'ndk':
+            if self.config.ndkPath is None:
+                valid = False
+                self.config.logger.error('The path to the ndk directory was not specified!')
+            unknownAbis = [abi for abi in self.abis if abi not in NdkToolchain.TARGETS]
+            if len(unknownAbis) > 0:
+                valid = False
+                self.config.logger.error('Unknown ABIs: ' + ', '.join(unknownAbis))
+        return valid
+
+    @tracedPhase('load config')
+    def loadModuleConfig(self):
+        """>>> loadModuleConfig() -> success
+        Load the name of the module and its extensions from the
+        android_module and android_extension:<name> sections
+        of the module configuration.
+        """
+        self.moduleName = os.path.basename(os.path.normpath(self.sourceDir))
+        self.extensions = []
+        if self.sourceConfig is None:
+            return True
+        parser = RawConfigParser()
+        if self.sourceConfig not in parser.read(self.sourceConfig):
+            self.config.logger.error('Failed to read the module config from {path}'
+                                     .format(path=self.sourceConfig))
+            return False
+        if parser.has_section('android_module'):
+            if parser.has_option('android_module', 'name'):
+                self.moduleName = parser.get('android_module', 'name')
+            if parser.has_option('android_module', 'exclude'):
+                self.excludePatterns = parser.get('android_module', 'exclude').splitlines()
+        for section in parser.sections():
+            if not section.startswith('android_extension:'):
+                continue
+            extension = Extension(section.split(':', 1)[1].strip())
+
+            def getList(option):
+                if not parser.has_option(section, option):
+                    return []
+                return parser.get(section, option).split()
+
+            extension.sources = [resolvePath(path, self.sourceDir) for path in getList('sources')]
+            extension.includeDirs = [resolvePath(path, self.sourceDir)
+                                     for path in getList('include_dirs')]
+            extension.libraryDirs = [resolvePath(path, self.sourceDir)
+                                     for path in getList('library_dirs')]
+            extension.defineMacros = getList('define_macros')
+            extension.libraries = getList('libraries')
+            extension.extraCompileArgs = getList('extra_compile_args')
+            extension.extraLinkArgs = getList('extra_link_args')
+            missing = [path for path in extension.sources if not os.path.isfile(path)]
+            if len(extension.sources) == 0 or len(missing) > 0:
+                self.config.logger.error('The extension {name} has {problem}.'.format(
+                    name=extension.name, problem='no sources' if len(missing) == 0
+                    else 'missing sources: ' + ', '.join(missing)))
+                return False
+            self.extensions.append(extension)
+        return True
+
+    def getCompileFlags(self, extension, toolchain):
+        """>>> getCompileFlags(extension, toolchain) -> list of flags
+        Returns the flags to compile the sources of the extension with.
+        """
+        includeDirs = extension.includeDirs + (
+            [self.pythonInclude] if self.pythonInclude is not None
+            else toolchain.getPythonIncludeDirs())
+        return ['-I' + path for path in includeDirs] + \
+            ['-D' + macro for macro in extension.defineMacros] + extension.extraCompileArgs
+
+    def getLinkFlags(self, extension, toolchain):
+        """>>> getLinkFlags(extension, toolchain) -> list of flags
+        Returns the flags to link the extension with.
+        """
+        flags = ['-L' + path for path in extension.libraryDirs]
+        if self.pythonLibDir is not None:
+            flags.append('-L' + self.pythonLibDir.replace('{abi}', toolchain.abi))
+        flags += ['-l' + library for library in extension.libraries]
+        if self.pythonLib is not None:
+            flags.append('-l' + self.pythonLib)
+        return flags + extension.extraLinkArgs
+
+    @tracedPhase('compile')
+    def compileExtensions(self, toolchains):
+        """>>> compileExtensions(toolchains) -> dict of (abi, extension name) to units or None
+        Compile the sources of all extensions for all toolchains at once.
+        """
+        unitsByTarget = {}
+        for toolchain in toolchains:
+            for extension in self.extensions:
+                flags = self.getCompileFlags(extension, toolchain)
+                unitsByTarget[(toolchain.abi, extension.name)] = [CompileUnit(
+                    toolchain, 'c++' if os.path.splitext(path)[1].lower() in CPP_EXTENSIONS
+                    else 'c', path, flags) for path in extension.sources]
+        cache = None
+        if self.objectCache:
+            cache = ObjectCache(self.objectCacheDir or os.path.join(self.config.templateDir,
+                                                                    'object-cache'))
+        scheduler = CompileScheduler(os.path.join(self.moduleBuildDir, 'objects'), cache,
+                                     self.config.logger, self.jobs)
+        units = [unit for targetUnits in unitsByTarget.values() for unit in targetUnits]
+        success = scheduler.compile(units)
+        self.config.tracer.count('compiledObjects', scheduler.compiledUnits)
+        self.config.tracer.count('cachedObjects', scheduler.cachedUnits)
+        self.config.logger.info('Compiled {compiled} of {num} sources, {cached} were reused from '
+                                'the object cache.'.format(compiled=scheduler.compiledUnits,
+                                                           num=len(units),
+                                                           cached=scheduler.cachedUnits))
+        return unitsByTarget if success else None
+
+    def _loadLinkState(self):
+        try:
+            with open(os.path.join(self.moduleBuildDir, 'link-state.json')) as stateFile:
+                return json.load(stateFile)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    @tracedPhase('link')
+    def linkExtensions(self, toolchains, unitsByTarget):
+        """>>> linkExtensions(toolchains, unitsByTarget) -> success
+        Link the shared library of every extension for every toolchain into
+        the staging directory of the ABI. A library is only linked again if
+        its objects or its link arguments changed since it was linked.
+        """
+        oldState = self._loadLinkState()
+        newState = {}
+        jobs = []
+        for toolchain in toolchains:
+            for extension in self.extensions:
+                units = unitsByTarget[(toolchain.abi, extension.name)]
+                libraryPath = os.path.join(self.getStagingDir(toolchain.abi),
+                                           *extension.getLibraryPath().split('/'))
+                language = 'c++' if any(unit.language == 'c++' for unit in units) else 'c'
+                args = toolchain.getLinkArgs(language, [unit.objectPath for unit in units],
+                                             libraryPath, self.getLinkFlags(extension, toolchain))
+                signature = [args] + [[os.path.getsize(unit.objectPath),
+                                       os.path.getmtime(unit.objectPath)] for unit in units]
+                newState[libraryPath] = signature
+                if oldState.get(libraryPath) == json.loads(json.dumps(signature)) and \
+                        os.path.isfile(libraryPath):
+                    continue
+                jobs.append((toolchain.abi, extension.name, libraryPath, args))
+
+        def link(job):
+            abi, name, libraryPath, args = job
+            if not mkDirs(os.path.dirname(libraryPath)):
+                self.config.logger.error('Failed to create the directory ' +
+                                         os.path.dirname(libraryPath))
+                return False
+            self.config.logger.info('Linking {name} for {abi}', name=name, abi=abi)
+            result = runProcess(args, self.config.logger)
+            if not result.success:
+                self.config.logger.error('Failed to link {name} for {abi}:\n{output}'.format(
+                    name=name, abi=abi, output=result.getTail()))
+            return result.success
+
+        numJobs = min(self.jobs or cpu_count(), len(jobs))
+        if numJobs > 1:
+            pool = ThreadPool(numJobs)
+            try:
+                results = pool.map(link, jobs)
+            finally:
+                pool.close()
+        else:
+            results = [link(job) for job in jobs]
+        self.config.tracer.count('linkedLibraries', sum(results))
+        if not all(results):
+            return False
+        if mkDirs(self.moduleBuildDir):
+            statePath = os.path.join(self.moduleBuildDir, 'link-state.json')
+            with open(statePath + '.tmp', 'w') as stateFile:
+                json.dump(newState, stateFile)
+            replaceFile(statePath + '.tmp', statePath)
+        return True
+
+    def getStagingDir(self, abi):
+        """>>> getStagingDir(abi) -> path
+        Returns the directory in which the module is assembled for the ABI.
+        """
+        return os.path.join(self.moduleBuildDir, 'stage', abi)
+
+    @tracedPhase('python sources')
+    def stagePythonSources(self, abi):
+        """>>> stagePythonSources(abi) -> success
+        Update the Python files of the module in the staging
+        directory of the ABI. The sources of the extensions
+        and the compiled libraries are not copied.
+        """
+        matcher = IgnoreMatcher.fromFile(os.path.join(self.sourceDir, '.apkignore'),
+                                         IgnoreMatcher.DEFAULT_PATTERNS + self.NATIVE_PATTERNS +
+                                         (self.excludePatterns or []))
+        libraryPaths = set(extension.getLibraryPath() for extension in self.extensions)
+        try:
+            result = syncDir(self.sourceDir, self.getStagingDir(abi),
+                             os.path.join(self.moduleBuildDir, 'sync', abi + '.json'),
+                             ignore=matcher.isIgnored, preserve=lambda path: path in libraryPaths,
+                             checksum=True)
+        except (IOError, OSError) as e:
+            self.config.logger.error('Failed to copy the Python files of the module: ' + str(e))
+            return False
+        self.config.logger.verbose('Synchronized the Python files for {abi}: {result}',
+                                   abi=abi, result=result)
+        self.config.tracer.count('copiedFiles', result.copiedFiles)
+        return True
+
+    @tracedPhase('package')
+    def packageModule(self, abi):
+        """>>> packageModule(abi) -> path or None
+        Pack the staging directory of the ABI into a zip archive in the output directory.
+        """
+        if not mkDirs(self.moduleOutputDir):
+            self.config.logger.error('Failed to create the output directory ' +
+                                     self.moduleOutputDir)
+            return None
+        outputPath = os.path.join(self.moduleOutputDir, '{name}-{abi}.zip'.format(
+            name=self.moduleName, abi=abi))
+        stagingDir = self.getStagingDir(abi)
+        with zipfile.ZipFile(outputPath + '.tmp', 'w', zipfile.ZIP_DEFLATED) as archive:
+            for dirPath, dirNames, fileNames in os.walk(stagingDir):
+                dirNames.sort()
+                for fileName in sorted(fileNames):
+                    path = os.path.join(dirPath, fileName)
+                    archive.write(path, os.path.relpath(path, stagingDir).replace(os.path.sep, '/'))
+        replaceFile(outputPath + '.tmp', outputPath)
+        return outputPath
+
+    def run(self, cmdArgs):
+        try:
+            self.parseCmdArgs(cmdArgs)
+        except InfoActionProcessed:
+            return True
+        except ArgumentParserError as e:
+            return e.code == 0
+        if not self.validateConfig() or not self.loadModuleConfig():
+            return False
+        abis = ['host'] if self.toolchain == 'host' else self.abis
+        toolchains = [createToolchain(self.toolchain, abi, self.config.ndkPath, self.apiLevel)
+                      for abi in abis]
+        if len(self.extensions) > 0:
+            missing = [toolchain.abi for toolchain in toolchains if not toolchain.isAvailable()]
+            if len(missing) > 0:
+                self.config.logger.error('The compilers of the {name} toolchain for {abis} were '
+                                         'not found.'.format(name=self.toolchain,
+                                                             abis=', '.join(missing)))
+                return False
+        self.config.logger.info('Building the module {name} with {num} extension(s) for {abis}...'
+                                .format(name=self.moduleName, num=len(self.extensions),
+                                        abis=', '.join(abis)))
+        for abi in abis:
+            if not self.stagePythonSources(abi):
+                return False
+        if len(self.extensions) > 0:
+            unitsByTarget = self.compileExtensions(toolchains)
+            if unitsByTarget is None or not self.linkExtensions(toolchains, unitsByTarget):
+                return False
+        for abi in abis:
+            outputPath = self.packageModule(abi)
+            if outputPath is None:
+                return False
+            self.config.logger.info('The module was successfully build for {abi} and is stored '
+                                    'at:\n{path}'.format(abi=abi, path=outputPath))
+        return True
+
+
+def run(config, cmdArgs):
+    moduleBuilder = ModuleBuilder(config)
+    return moduleBuilder.run(cmdArgs)
@@ -8,6 +8,7 @@ except ImportError:
     from configparser import RawConfigParser
 from .logger import Logger
 from .utils.files import resolvePath
+from .utils.timing import Tracer
 
 
 class Config(object):
@@ -55,6 +56,7 @@ class Config(object):
 
     _parser = None
     logger = Logger()
+    tracer = Tracer()
     currDir = None
     avoidNetwork = False
     buildDir = None
@@ -66,6 +68,7 @@ class Config(object):
 
     def __init__(self, currDir):
         self.currDir = currDir
+        self.logger.setStageSource(self.tracer.getCurrentPhase)
 
     def loadConfigFile(self, configPath, configureLogging=True):
         """>>> loadConfigFile(configPath, configureLogging) -> success
@@ -186,7 +189,7 @@ class Config(object):
         given command line arguments and from any configuration
         file specified by the arguments.
         """
-        cmdHasLevel = cmdHasFile = False
+        cmdHasLevel = cmdHasFile = cmdHasFormat = False
         if cmdArgs is not None:
             if 'logFile' in cmdArgs and cmdArgs.logFile is not None:
                 if self.logger.setLogFile(resolvePath(cmdArgs.logFile, self.currDir)):
@@ -194,6 +197,9 @@ class Config(object):
             if 'logLevel' in cmdArgs and cmdArgs.logLevel is not None:
                 if self._parseLogLevel(cmdArgs.logLevel):
                     cmdHasLevel = True
+            if 'logFormat' in cmdArgs and cmdArgs.logFormat is not None:
+                if self._parseLogFormat(cmdArgs.logFormat):
+                    cmdHasFormat = True
         if not self._loadConfigFile(cmdArgs.configFile):
             return
         if not cmdHasFile and self._parser.has_option('Paths', 'logFile'):
@@ -201,6 +207,20 @@ class Config(object):
             self.logger.setLogFile(logFile)
         if not cmdHasLevel and self._parser.has_option('General', 'logLevel'):
             self._parseLogLevel(self._parser.get('General', 'logLevel'))
+        if not cmdHasFormat and self._parser.has_option('General', 'logFormat'):
+            self._parseLogFormat(self._parser.get('General', 'logFormat'))
+
+    def _parseLogFormat(self, logFormat):
+        """>>> _parseLogFormat(logFormat) -> success
+        Parse and set the output format of the logger.
+        """
+        try:
+            self.logger.setFormat(logFormat.strip().lower())
+        except ValueError:
+            self.logger.warn('Failed to parse invalid log format "{format}"'
+                             .format(format=logFormat))
+            return False
+        return True
 
     def _parseLogLevel(self, logLevel):
         """>>> _parseLogLevel(logLevel) -> success
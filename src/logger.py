@@ -1,11 +1,23 @@
-from os.path import isdir
+import atexit
+import json
 import sys
+import threading
+from os.path import isdir
+from time import time
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 
 class Logger(object):
     """
     A logging utility implementing five different log levels as well
-    as the ability to log to a file, if one is specified.
+    as the ability to log to a file, if one is specified. Messages to
+    a log file are written by a background thread, which flushes the
+    file whenever it has nothing else to write. Messages can be
+    written as text or as JSON lines with a timestamp and the stage.
     """
 
     PRIORITY_VERBOSE = 0
@@ -20,9 +32,44 @@ class Logger(object):
         '[ERROR] ',
         '',
     ]
+    _priorityNames = ['verbose', 'info', 'warn', 'error', 'none']
+    FORMAT_TEXT = 'text'
+    FORMAT_JSON = 'json'
+    QUEUE_SIZE = 1024
 
     _priority = PRIORITY_INFO
+    _format = FORMAT_TEXT
     _logFile = None
+    _queue = None
+    _writer = None
+    _stageSource = None
+    _flushAtExit = False
+
+    @staticmethod
+    def _writeQueue(logFile, queue):
+        """>>> _writeQueue(logFile, queue)
+        Write the lines from the queue to the log file until None
+        is received. The file is flushed when the queue is empty.
+        If writing fails, the error is reported once on stderr and
+        the queue is still drained, so the logging threads never block.
+        """
+        failed = False
+        while True:
+            line = queue.get()
+            try:
+                if line is not None:
+                    logFile.write(line)
+                if line is None or queue.empty():
+                    logFile.flush()
+            except (IOError, OSError, ValueError) as error:
+                if not failed:
+                    failed = True
+                    sys.stderr.write('Failed to write to the log file {path}: {error}\n'.format(
+                        path=logFile.name, error=error))
+            finally:
+                queue.task_done()
+            if line is None:
+                return
 
     def setLogFile(self, path):
         """>>> setLogFile(path) -> success
@@ -33,7 +80,19 @@ class Logger(object):
             self.warn('Failed to create the log file at {path}: The path points to an '
                       'existing directory!'.format(path=path))
             return False
-        self._logFile = open(path, 'w')
+        self.closeLogFile()
+        if sys.version_info[0] < 3:
+            self._logFile = open(path, 'w')
+        else:
+            self._logFile = open(path, 'w', encoding='utf-8')
+        self._queue = Queue(self.QUEUE_SIZE)
+        self._writer = threading.Thread(target=self._writeQueue,
+                                        args=(self._logFile, self._queue))
+        self._writer.daemon = True
+        self._writer.start()
+        if not self._flushAtExit:
+            atexit.register(self.flush)
+            self._flushAtExit = True
         return True
 
     def closeLogFile(self):
@@ -41,17 +100,69 @@ class Logger(object):
         Closes the current log file, if one was set.
         """
         if self._logFile is not None:
+            self._queue.put(None)
+            self._writer.join()
+            try:
+                self._logFile.close()
+            except (IOError, OSError, ValueError):
+                pass
+            self._logFile = self._queue = self._writer = None
+
+    def flush(self):
+        """>>> flush()
+        Wait until all messages are written and flush the output.
+        """
+        if self._logFile is None:
+            sys.stdout.flush()
+            return
+        self._queue.join()
+        try:
             self._logFile.flush()
-            self._logFile.close()
-            self._logFile = None
+        except (IOError, OSError, ValueError):
+            pass  # The writer thread already reported the error
+
+    def getLogFilePath(self):
+        """>>> getLogFilePath() -> path or None
+        Returns the path of the current log file, if one was set.
+        """
+        return None if self._logFile is None else self._logFile.name
 
     def getOutput(self):
         """>>> getOutput() -> output
         Returns the current output of this logger. Might be a file
-        object or stdout.
+        object or stdout. All pending messages are written before.
         """
+        self.flush()
         return sys.stdout if self._logFile is None else self._logFile
 
+    def setFormat(self, outputFormat):
+        """>>> setFormat(outputFormat)
+        Setts the output format of this logger. Raises ValueError
+        if the value is not one of the FORMAT_* values.
+        """
+        if outputFormat not in [self.FORMAT_TEXT, self.FORMAT_JSON]:
+            raise ValueError()
+        self._format = outputFormat
+
+    def getFormat(self):
+        """>>> getFormat() -> outputFormat
+        Returns the current output format of this logger.
+        """
+        return self._format
+
+    def setStageSource(self, stageSource):
+        """>>> setStageSource(stageSource)
+        Set the function that returns the name of the
+        current stage, which is added to JSON messages.
+        """
+        self._stageSource = stageSource
+
+    def getStageSource(self):
+        """>>> getStageSource() -> stageSource
+        Returns the function that returns the name of the current stage.
+        """
+        return self._stageSource
+
     def setPriority(self, priority):
         """>>> setPriority(priority)
         Setts the current log level of this logger. Raises
@@ -67,54 +178,91 @@ class Logger(object):
         """
         return self._priority
 
-    def write(self, msg, isError=False):
-        """>>> write(msg, isError)
-        Writes 'msg' to the output of this logger, bypassing
-        the priority check. If 'isError' is True and the current
-        output of this logger is stdout, stderr will be used instead.
+    def isEnabled(self, priority):
+        """>>> isEnabled(priority) -> boolean
+        Returns True if messages with the given priority are logged.
+        """
+        return self._priority <= priority
+
+    def _formatLine(self, levelName, prefix, msg):
+        """>>> _formatLine(levelName, prefix, msg) -> line
+        Format the message in the current output format.
+        """
+        if self._format == self.FORMAT_JSON:
+            record = {'time': round(time(), 3), 'level': levelName, 'message': msg}
+            stage = None if self._stageSource is None else self._stageSource()
+            if stage is not None:
+                record['stage'] = stage
+            return json.dumps(record, sort_keys=True)
+        return prefix + msg
+
+    def _output(self, line, isError):
+        """>>> _output(line, isError)
+        Write the line to the output of this logger. Lines for
+        the log file are queued for the background writer, but
+        errors are written immediately.
         """
         if self._logFile is None:
             if isError:
-                sys.stderr.write(msg + '\n')
+                sys.stderr.write(line + '\n')
                 sys.stderr.flush()
             else:
-                print(msg)
+                print(line)
                 sys.stdout.flush()
         else:
-            self._logFile.write(msg + '\n')
-            self._logFile.flush()
+            self._queue.put(line + '\n')
+            if isError:
+                self.flush()
+
+    def write(self, msg, isError=False):
+        """>>> write(msg, isError)
+        Writes 'msg' to the output of this logger, bypassing
+        the priority check. If 'isError' is True and the current
+        output of this logger is stdout, stderr will be used instead.
+        """
+        self._output(self._formatLine('output', '', msg), isError)
 
-    def _log(self, priority, msg):
-        """>>> _log(priority, msg)
+    def _log(self, priority, msg, args, kwargs):
+        """>>> _log(priority, msg, args, kwargs)
         Write 'msg' to the current output of this logger,
         if the given 'priority' is higher or equal than the
-        current log level. Also, a prefix indicating the
-        priority of the message is added.
+        current log level. If there are 'args' or 'kwargs',
+        the message is formatted with them first. Also, a prefix
+        indicating the priority of the message is added.
         """
         if self._priority <= priority:
-            msg = self._priorityPrefix[priority] + str(msg)
-            self.write(msg, isError=priority == self.PRIORITY_ERROR)
+            msg = msg.format(*args, **kwargs) if args or kwargs else str(msg)
+            self._output(self._formatLine(self._priorityNames[priority],
+                                          self._priorityPrefix[priority], msg),
+                         isError=priority == self.PRIORITY_ERROR)
+
+    def log(self, priority, msg, *args, **kwargs):
+        """>>> log(priority, msg, *args, **kwargs)
+        Write the message with the given priority to the loggers output.
+        """
+        self._log(priority, msg, args, kwargs)
 
-    def verbose(self, msg):
-        """>>> verbose(msg)
-        Write the verbose message to the loggers output.
+    def verbose(self, msg, *args, **kwargs):
+        """>>> verbose(msg, *args, **kwargs)
+        Write the verbose message to the loggers output. The
+        message is only formatted with the arguments if it is logged.
         """
-        self._log(self.PRIORITY_VERBOSE, msg)
+        self._log(self.PRIORITY_VERBOSE, msg, args, kwargs)
 
-    def info(self, msg):
-        """>>> info(msg)
+    def info(self, msg, *args, **kwargs):
+        """>>> info(msg, *args, **kwargs)
         Write the info message to the loggers output.
         """
-        self._log(self.PRIORITY_INFO, msg)
+        self._log(self.PRIORITY_INFO, msg, args, kwargs)
 
-    def warn(self, msg):
-        """>>> warn(msg)
+    def warn(self, msg, *args, **kwargs):
+        """>>> warn(msg, *args, **kwargs)
         Write the warn message to the loggers output.
         """
-        self._log(self.PRIORITY_WARN, msg)
+        self._log(self.PRIORITY_WARN, msg, args, kwargs)
 
-    def error(self, msg):
-        """>>> error(msg)
+    def error(self, msg, *args, **kwargs):
+        """>>> error(msg, *args, **kwargs)
         Write the error message to the loggers output.
         """
-        self._log(self.PRIORITY_ERROR, msg)
+        self._log(self.PRIORITY_ERROR, msg, args, kwargs)
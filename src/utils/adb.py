@@ -0,0 +1,242 @@
+"""
+Helpers for Android devices and emulators. Waiting for a device to
+finish booting uses one long-lived adb shell session per device
+instead of a new process per check.
+"""
+
+import os
+import socket
+import subprocess
+import threading
+from time import sleep, time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+
+# The console ports of emulators, the device name of an emulator is emulator-<port>.
+EMULATOR_PORTS = range(5554, 5682, 2)
+
+
+def isPortFree(port):
+    """>>> isPortFree(port) -> boolean
+    Returns True if nothing is listening on the local port.
+    """
+    testSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        testSocket.bind(('127.0.0.1', port))
+        return True
+    except socket.error:
+        return False
+    finally:
+        testSocket.close()
+
+
+def findFreeEmulatorPort(devices=(), ports=EMULATOR_PORTS):
+    """>>> findFreeEmulatorPort(devices, ports) -> port or None
+    Returns the first of the emulator console ports that is not used by
+    one of the connected devices and where the console and adb port are free.
+    """
+    for port in ports:
+        if 'emulator-{port}'.format(port=port) not in devices and \
+                isPortFree(port) and isPortFree(port + 1):
+            return port
+    return None
+
+
+class ShellSession(object):
+    """
+    A long-lived 'adb shell' process on a device, that executes
+    commands one after another and returns their output.
+    On devices without shell protocol support the shell runs in a
+    pseudo terminal, which echoes the commands and prints prompts, so
+    the output of each command is framed by a start and an end marker.
+    """
+    _MARKER_PREFIX = '__PYTOAPK_'
+    adbPath = None
+    device = None
+    _process = None
+    _lines = None
+    _numCommands = 0
+
+    def __init__(self, adbPath, device):
+        self.adbPath = adbPath
+        self.device = device
+
+    def _readLines(self, process, lines):
+        for line in iter(process.stdout.readline, ''):
+            lines.put(line)
+        lines.put(None)
+
+    def supportsShellProtocol(self):
+        """>>> supportsShellProtocol() -> boolean
+        Returns True if adb and the device support the shell protocol,
+        which allows to start a shell without a pseudo terminal.
+        """
+        try:
+            with open(os.devnull, 'w') as devNull:
+                features = subprocess.check_output(
+                    [self.adbPath, '-s', self.device, 'features'], stderr=devNull,
+                    universal_newlines=True)
+        except (subprocess.CalledProcessError, OSError):
+            return False
+        return 'shell_v2' in features.replace(',', '\n').split()
+
+    def start(self):
+        """>>> start()
+        Start the shell process on the device.
+        """
+        args = [self.adbPath, '-s', self.device, 'shell']
+        if self.supportsShellProtocol():
+            args.append('-T')
+        self._lines = Queue()
+        self._process = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            universal_newlines=True)
+        reader = threading.Thread(target=self._readLines, args=(self._process, self._lines))
+        reader.daemon = True
+        reader.start()
+
+    def run(self, command, timeout):
+        """>>> run(command, timeout) -> output or None
+        Execute the command in the shell and return its output. Returns
+        None if the shell exited or did not answer within 'timeout' seconds.
+        Only the output between the start and the end marker is returned, a
+        prompt may precede the start marker. The markers are split by empty
+        quotes in the command, so the echoed command never contains them.
+        """
+        if self._process is None or self._process.poll() is not None:
+            return None
+        self._numCommands += 1
+        startMarker = '{prefix}START_{num}__'.format(
+            prefix=self._MARKER_PREFIX, num=self._numCommands)
+        endMarker = '{prefix}END_{num}__'.format(
+            prefix=self._MARKER_PREFIX, num=self._numCommands)
+        try:
+            self._process.stdin.write('echo {start}; {command}; echo {end}\n'.format(
+                start=startMarker.replace('_', '_""', 1), command=command,
+                end=endMarker.replace('_', '_""', 1)))
+            self._process.stdin.flush()
+        except (IOError, OSError):
+            return None
+        output = None
+        deadline = time() + timeout
+        while True:
+            try:
+                line = self._lines.get(timeout=max(0, deadline - time()))
+            except Empty:
+                return None
+            if line is None:
+                return None
+            line = line.rstrip('\r\n')
+            if output is None:
+                if line.endswith(startMarker):
+                    output = []
+            elif endMarker in line:
+                output.append(line[:line.index(endMarker)])
+                return ''.join(output)
+            else:
+                output.append(line + '\n')
+
+    def close(self):
+        """>>> close()
+        Stop the shell process.
+        """
+        if self._process is None:
+            return
+        if self._process.poll() is None:
+            try:
+                self._process.stdin.close()
+            except (IOError, OSError):
+                pass
+            try:
+                self._process.kill()
+            except OSError:
+                pass
+        self._process.wait()
+        self._process = None
+
+
+def _waitForProcess(process, deadline, minDelay, maxDelay):
+    """>>> _waitForProcess(process, deadline, minDelay, maxDelay) -> exit code or None
+    Wait for the process to exit, checking with an increasing delay.
+    Returns None if the process did not exit before the deadline.
+    """
+    delay = minDelay
+    while process.poll() is None:
+        if time() >= deadline:
+            return None
+        sleep(min(delay, max(0, deadline - time())))
+        delay = min(delay * 2, maxDelay)
+    return process.returncode
+
+
+def waitForBoot(adbPath, device, logger, timeout=180, emulatorProcess=None,
+                minDelay=0.05, maxDelay=1.0):
+    """>>> waitForBoot(adbPath, device, logger, timeout, emulatorProcess, ...) -> success
+    Wait until the device is connected and has finished booting. The boot
+    state is checked through a single shell session on the device, first
+    every 'minDelay' seconds and then less often, up to every 'maxDelay'
+    seconds. The shell session is restarted if the connection to the
+    device is lost during the boot. If the device is an emulator started
+    by the process 'emulatorProcess', the wait is aborted if it exits.
+    """
+    startTime = time()
+    deadline = startTime + timeout
+    args = [adbPath, '-s', device, 'wait-for-device']
+    logger.verbose('Calling ' + subprocess.list2cmdline(args))
+    with open(os.devnull, 'w') as devNull:
+        waitProcess = subprocess.Popen(args, stdout=devNull, stderr=devNull)
+    try:
+        while True:
+            returnCode = _waitForProcess(waitProcess, min(deadline, time() + maxDelay),
+                                         minDelay, maxDelay)
+            if returnCode is not None:
+                break
+            if emulatorProcess is not None and emulatorProcess.poll() is not None:
+                logger.error('The emulator exited with code {code} while waiting for device '
+                             '{name}'.format(code=emulatorProcess.returncode, name=device))
+                return False
+            if time() >= deadline:
+                logger.error('Boot time out: Device {name} did not connect within {time}s!'
+                             .format(name=device, time=timeout))
+                return False
+    finally:
+        if waitProcess.poll() is None:
+            waitProcess.kill()
+            waitProcess.wait()
+    if returnCode != 0:
+        logger.error('Failed to wait for online state of device {name}'.format(name=device))
+        return False
+    session = ShellSession(adbPath, device)
+    delay = minDelay
+    numChecks = 0
+    try:
+        session.start()
+        while time() < deadline:
+            output = session.run('getprop sys.boot_completed', max(0, deadline - time()))
+            numChecks += 1
+            if output is None:
+                if emulatorProcess is not None and emulatorProcess.poll() is not None:
+                    logger.error('The emulator exited with code {code} while waiting for device '
+                                 '{name}'.format(code=emulatorProcess.returncode, name=device))
+                    return False
+                logger.verbose('Lost the shell session to device {name}, reconnecting...',
+                               name=device)
+                session.close()
+                sleep(min(delay, max(0, deadline - time())))
+                session.start()
+            elif output.strip() == '1':
+                logger.verbose('Device {name} finished booting after {time:.2f}s '
+                               '({num} checks).', name=device, time=time() - startTime,
+                               num=numChecks)
+                return True
+            else:
+                sleep(min(delay, max(0, deadline - time())))
+            delay = min(delay * 2, maxDelay)
+    finally:
+        session.close()
+    logger.error('Boot time out: Device {name} took too long to boot!'.format(name=device))
+    return False
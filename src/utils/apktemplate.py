@@ -1,20 +1,35 @@
 from __future__ import absolute_import
 
+import filecmp
+import io
 import os
 import re
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 
 try:
     from ConfigParser import RawConfigParser
 except ImportError:
     from configparser import RawConfigParser
-from .files import resolvePath
+from .files import mkDirs, replaceFile, resolvePath
+from .fillplan import FillPlan
 from shutil import copy as copyFile
 
 
 class ApkTemplateFiller(object):
-    """Handles the filling of the apk template."""
+    """
+    Handles the filling of the apk template. The template is filled
+    from the template directory into the build directory. Only the
+    files that contain replace commands (and the custom icon and
+    manifest template) are written by the filler, all other files
+    of the template must be copied into the build directory
+    separately. Files are only written if their content changes.
+    """
     templateDir = None
+    buildDir = None
     logger = None
+    fillPlan = None
+    jobs = None
     _PY_VERSION_REGEX = re.compile(r'\A\d+(\.\d+){0,2}\Z')
     _JAVA_PACKAGE_REGEX = re.compile(r'\A[a-zA-Z_][a-zA-Z0-9_]*(\.[a-zA-Z_][a-zA-Z0-9_]*)*\Z')
     FORMAT_ARG_VERIFIERS = {
@@ -43,15 +58,25 @@ class ApkTemplateFiller(object):
     formatArgs = None
     appIcon = None
     appManifestTemplate = None
+    excludePatterns = None
+    useDefaultExcludes = True
+    stripDocstrings = False
+    stripComments = False
+    treeShake = False
+    keepModules = None
+    keepFiles = None
+    buildTypes = None
     FORMAT_FILES_EXT = ['.java', '.xml', '.gradle']
     JAVA_PACKAGE_DIR_PATH = 'app/src/main/java'.replace('/', os.path.sep)
     TEMPLATE_ICON_PATH = 'app/src/main/res/drawable-mdpi/app_launcher_icon.png'.\
         replace('/', os.path.sep)
     TEMPLATE_MANIFEST_PATH = 'app/src/main/AndroidManifest.xml'.replace('/', os.path.sep)
 
-    def __init__(self, templateDir, logger):
+    def __init__(self, templateDir, buildDir, logger, jobs=None):
         self.templateDir = templateDir
+        self.buildDir = buildDir
         self.logger = logger
+        self.jobs = jobs or cpu_count()
 
     def validateValues(self):
         """>>> validateValues() -> boolean
@@ -91,10 +116,80 @@ class ApkTemplateFiller(object):
                               'existing file: {path}'.format(path=self.appManifestTemplate))
         return valid
 
-    def loadConfigFile(self, path):
-        """>>> loadConfigFile(path) -> success
-        Load formatting arguments from the section
-        android_app of configuration file at path.
+    @staticmethod
+    def getVariantNames(path):
+        """>>> getVariantNames(path) -> list of names
+        Returns the names of the build variants defined in the configuration
+        file at path by a section called android_app:<name>.
+        """
+        parser = RawConfigParser()
+        parser.read(path)
+        return [section.split(':', 1)[1].strip() for section in parser.sections()
+                if section.startswith('android_app:')]
+
+    def _loadAppSection(self, parser, section, appDir, sourceOptions=True):
+        """>>> _loadAppSection(parser, section, appDir, sourceOptions)
+        Load the formatting arguments from the section of the parser.
+        The options that affect the Python sources are only loaded,
+        if 'sourceOptions' is True.
+        """
+        if parser.has_option(section, 'app_name'):
+            self.formatArgs['appName'] = parser.get(section, 'app_name')
+        if parser.has_option(section, 'app_tag'):
+            self.formatArgs['appLogTag'] = parser.get(section, 'app_tag')
+        if parser.has_option(section, 'app_id'):
+            self.formatArgs['appId'] = parser.get(section, 'app_id')
+        if parser.has_option(section, 'app_num_version'):
+            self.formatArgs['appNumVersion'] = parser.get(section, 'app_num_version')
+        if parser.has_option(section, 'app_icon'):
+            self.appIcon = resolvePath(parser.get(section, 'app_icon'), appDir)
+        if parser.has_option(section, 'app_window_type'):
+            self.formatArgs['windowType'] = parser.get(section, 'app_window_type')
+        if parser.has_option(section, 'app_min_sdk'):
+            self.formatArgs['appMinSdk'] = parser.get(section, 'app_min_sdk')
+        if parser.has_option(section, 'app_target_sdk'):
+            self.formatArgs['appTargetSdk'] = parser.get(section, 'app_target_sdk')
+        if parser.has_option(section, 'min_python_version'):
+            self.formatArgs['minPyVersion'] = parser.get(section, 'min_python_version')
+        if parser.has_option(section, 'requirements'):
+            self.formatArgs['requirements'] = parser.get(section, 'requirements')
+        if parser.has_option(section, 'app_manifest_template'):
+            self.appManifestTemplate = resolvePath(
+                parser.get(section, 'app_manifest_template'), appDir)
+        if parser.has_option(section, 'build_types'):
+            self.buildTypes = parser.get(section, 'build_types').split()
+        if not sourceOptions:
+            for option in ['exclude', 'default_excludes', 'strip_sources', 'tree_shake',
+                           'keep_modules', 'keep_files']:
+                if parser.has_option(section, option):
+                    self.logger.warn('Ignoring {option} in the section {section}: The Python '
+                                     'sources are shared by all variants.'
+                                     .format(option=option, section=section))
+            return
+        if parser.has_option(section, 'exclude'):
+            self.excludePatterns = parser.get(section, 'exclude').splitlines()
+        if parser.has_option(section, 'default_excludes'):
+            self.useDefaultExcludes = parser.getboolean(section, 'default_excludes')
+        if parser.has_option(section, 'strip_sources'):
+            stripOptions = parser.get(section, 'strip_sources').split()
+            for option in stripOptions:
+                if option not in ['docstrings', 'comments']:
+                    self.logger.warn('Ignoring unknown value "{value}" of strip_sources'
+                                     .format(value=option))
+            self.stripDocstrings = 'docstrings' in stripOptions
+            self.stripComments = 'comments' in stripOptions
+        if parser.has_option(section, 'tree_shake'):
+            self.treeShake = parser.getboolean(section, 'tree_shake')
+        if parser.has_option(section, 'keep_modules'):
+            self.keepModules = parser.get(section, 'keep_modules').split()
+        if parser.has_option(section, 'keep_files'):
+            self.keepFiles = parser.get(section, 'keep_files').splitlines()
+
+    def loadConfigFile(self, path, variant=None):
+        """>>> loadConfigFile(path, variant) -> success
+        Load formatting arguments from the section android_app of
+        configuration file at path. If a variant is given, the
+        values of the section android_app:<variant> override them.
         """
         parser = RawConfigParser()
         if path not in parser.read(path):
@@ -104,41 +199,79 @@ class ApkTemplateFiller(object):
         if parser.has_section('android_app'):
             if self.formatArgs is None:
                 self.formatArgs = {}
-            if parser.has_option('android_app', 'app_name'):
-                self.formatArgs['appName'] = parser.get('android_app', 'app_name')
-            if parser.has_option('android_app', 'app_tag'):
-                self.formatArgs['appLogTag'] = parser.get('android_app', 'app_tag')
-            if parser.has_option('android_app', 'app_id'):
-                self.formatArgs['appId'] = parser.get('android_app', 'app_id')
-            if parser.has_option('android_app', 'app_num_version'):
-                self.formatArgs['appNumVersion'] = parser.get('android_app', 'app_num_version')
-            if parser.has_option('android_app', 'app_icon'):
-                self.appIcon = resolvePath(parser.get('android_app', 'app_icon'), appDir)
-            if parser.has_option('android_app', 'app_window_type'):
-                self.formatArgs['windowType'] = parser.get('android_app', 'app_window_type')
-            if parser.has_option('android_app', 'app_min_sdk'):
-                self.formatArgs['appMinSdk'] = parser.get('android_app', 'app_min_sdk')
-            if parser.has_option('android_app', 'app_target_sdk'):
-                self.formatArgs['appTargetSdk'] = parser.get('android_app', 'app_target_sdk')
-            if parser.has_option('android_app', 'min_python_version'):
-                self.formatArgs['minPyVersion'] = parser.get('android_app', 'min_python_version')
-            if parser.has_option('android_app', 'requirements'):
-                self.formatArgs['requirements'] = parser.get('android_app', 'requirements')
-            if parser.has_option('android_app', 'app_manifest_template'):
-                self.appManifestTemplate = resolvePath(
-                    parser.get('android_app', 'app_manifest_template'), appDir)
-            if len(self.formatArgs) == 0:
-                if self.appIcon is None and self.appManifestTemplate is None:
-                    self.logger.warn('No configuration found in the setup.py at ' + path)
-                self.formatArgs = None
-        else:
+            self._loadAppSection(parser, 'android_app', appDir)
+        elif variant is None:
             self.logger.warn('No configuration found in the setup.py at {path}: '
                              'No configuration found called "android_app".'.format(path=path))
+        if variant is not None:
+            section = [name for name in parser.sections()
+                       if name.startswith('android_app:') and
+                       name.split(':', 1)[1].strip() == variant]
+            if len(section) == 0:
+                self.logger.error('The variant {name} is not defined in {path}'
+                                  .format(name=variant, path=path))
+                return False
+            if self.formatArgs is None:
+                self.formatArgs = {}
+            self._loadAppSection(parser, section[0], appDir, sourceOptions=False)
+        if self.formatArgs is not None and len(self.formatArgs) == 0:
+            if self.appIcon is None and self.appManifestTemplate is None:
+                self.logger.warn('No configuration found in the setup.py at ' + path)
+            self.formatArgs = None
         return True
 
     def loadConfigFromSetupPy(self, path):
         pass
 
+    def loadFillPlan(self, cacheDir, commit):
+        """>>> loadFillPlan(cacheDir, commit)
+        Load the fill plan of the template at the given commit
+        from the cache directory or create it by scanning the template.
+        """
+        self.fillPlan = FillPlan.create(self.templateDir, self.FORMAT_FILES_EXT,
+                                        cacheDir, commit, self.logger)
+
+    def getPackageDirs(self):
+        """>>> getPackageDirs() -> (templatePath, buildPath) or None
+        Returns the path of the directory that makes up the package
+        name in the template and the path it is renamed to in the build
+        directory, both relative and separated by '/'. Returns None if
+        the directory is not renamed.
+        """
+        if self.formatArgs is None or self.formatArgs.get('appId') is None:
+            return None
+        parentDirPath = os.path.join(self.templateDir, self.JAVA_PACKAGE_DIR_PATH)
+        if not os.path.isdir(parentDirPath):
+            return None
+        packageNameDirs = sorted(path for path in os.listdir(parentDirPath)
+                                 if os.path.isdir(os.path.join(parentDirPath, path)))
+        if len(packageNameDirs) == 0 or packageNameDirs[0] == self.formatArgs['appId']:
+            return None
+        parentDir = self.JAVA_PACKAGE_DIR_PATH.replace(os.path.sep, '/')
+        return parentDir + '/' + packageNameDirs[0], parentDir + '/' + self.formatArgs['appId']
+
+    def getBuildPath(self, relPath):
+        """>>> getBuildPath(relPath) -> relPath
+        Returns the path in the build directory of the file at the
+        template path 'relPath'. Both paths are separated by '/'.
+        """
+        packageDirs = self.getPackageDirs()
+        if packageDirs is not None and relPath.startswith(packageDirs[0] + '/'):
+            return packageDirs[1] + relPath[len(packageDirs[0]):]
+        return relPath
+
+    def getOwnedFiles(self):
+        """>>> getOwnedFiles() -> list of paths
+        Returns the paths relative to the template directory
+        (separated by '/') of all files that are written by the filler.
+        """
+        ownedFiles = set(self.fillPlan.files.keys())
+        if self.appManifestTemplate is not None:
+            ownedFiles.add(self.TEMPLATE_MANIFEST_PATH.replace(os.path.sep, '/'))
+        if self.appIcon is not None:
+            ownedFiles.add(self.TEMPLATE_ICON_PATH.replace(os.path.sep, '/'))
+        return sorted(ownedFiles)
+
     def copyIcon(self):
         """>>> copyIcon() -> success
         Copy the custom icon of the Python program
@@ -146,96 +279,71 @@ class ApkTemplateFiller(object):
         """
         if self.appIcon is None:
             return True
-        self.logger.info('Copying icon file...')
         templateIconPath = os.path.join(self.templateDir, self.TEMPLATE_ICON_PATH)
         if not os.path.exists(templateIconPath):
             self.logger.error('Could not find the icon file of the template at {path}'
                               .format(path=templateIconPath))
             return False
-        os.remove(templateIconPath)
-        copyFile(self.appIcon, templateIconPath)
+        buildIconPath = os.path.join(self.buildDir, self.TEMPLATE_ICON_PATH)
+        if os.path.isfile(buildIconPath) and filecmp.cmp(self.appIcon, buildIconPath, False):
+            return True
+        self.logger.info('Copying icon file...')
+        mkDirs(os.path.dirname(buildIconPath))
+        copyFile(self.appIcon, buildIconPath + '.tmp')
+        replaceFile(buildIconPath + '.tmp', buildIconPath)
         return True
 
-    def copyCustomManifestTemplate(self):
-        """>>> copyCustomManifestTemplate() -> success
-        Copy the custom manifest template of the Python
-        program into the template, if one was specified.
+    def _fillCommandsInLine(self, line, commands):
+        """>>> _fillCommandsInLine(line, commands) -> string
+        Replace the default values in the line with the
+        corresponding formatting arguments of the commands.
         """
-        if self.appManifestTemplate is None:
-            return True
-        templateManifestPath = os.path.join(self.templateDir, self.TEMPLATE_MANIFEST_PATH)
-        self.logger.info('Copying manifest template...')
-        if not os.path.exists(templateManifestPath):
-            self.logger.error('Could not find the manifest file of the template at {path}'
-                              .format(path=templateManifestPath))
-            return False
-        os.remove(templateManifestPath)
-        copyFile(self.appManifestTemplate, templateManifestPath)
-        return True
+        for start, end, key in sorted(commands, reverse=True):
+            if key not in self.formatArgs:
+                self.logger.warn('Found unknown formatting variable "{name}"!'.format(name=key))
+                continue
+            elif self.formatArgs[key] is None:
+                continue
+            self.logger.verbose('Replacing variable "{name}" with "{value}"',
+                                name=key, value=self.formatArgs[key])
+            line = line[:start] + self.formatArgs[key] + line[end:]
+        return line
 
-    def changePackageName(self):
-        """>>> changePackageName() -> success
-        Rename the directory that makes up the package name.
+    def _fillFileTemplate(self, relPath):
+        """>>> _fillFileTemplate(relPath) -> boolean
+        Fill all default values in the template file at 'relPath'
+        with their corresponding formatting arguments and write the
+        result into the build directory, if it changed. Returns True
+        if the file in the build directory was changed.
         """
-        parentDirPath = os.path.join(self.templateDir, self.JAVA_PACKAGE_DIR_PATH)
-        if not os.path.isdir(parentDirPath):
-            self.logger.error('Failed to find the directory that describes the package path: '
-                              '{path} is not an existing directory!'.format(path=parentDirPath))
+        sourcePath = os.path.join(self.templateDir, relPath.replace('/', os.path.sep))
+        commands = {}
+        if relPath == self.TEMPLATE_MANIFEST_PATH.replace(os.path.sep, '/') and \
+                self.appManifestTemplate is not None:
+            sourcePath = self.appManifestTemplate
+            with io.open(sourcePath, encoding='utf-8', newline='') as manifestFile:
+                for lineIndex, line in enumerate(manifestFile):
+                    if 'REPLACE(' in line:
+                        commands[lineIndex] = FillPlan.parseLine(line)[0]
+        elif relPath in self.fillPlan.files:
+            for lineIndex, start, end, key in self.fillPlan.files[relPath]['commands']:
+                commands.setdefault(lineIndex, []).append((start, end, key))
+        destPath = os.path.join(self.buildDir, self.getBuildPath(relPath).replace('/', os.path.sep))
+        if not mkDirs(os.path.dirname(destPath)):
+            raise OSError('Failed to create the directory ' + os.path.dirname(destPath))
+        tempPath = destPath + '.tmp'
+        with io.open(sourcePath, encoding='utf-8', newline='') as sourceFile:
+            with io.open(tempPath, 'w', encoding='utf-8', newline='') as tempFile:
+                for lineIndex, line in enumerate(sourceFile):
+                    if lineIndex in commands and self.formatArgs is not None:
+                        line = self._fillCommandsInLine(line, commands[lineIndex])
+                    tempFile.write(line)
+        if os.path.isfile(destPath) and filecmp.cmp(tempPath, destPath, False):
+            os.remove(tempPath)
             return False
-        packageNameDirs = [path for path in os.listdir(parentDirPath)
-                           if os.path.isdir(os.path.join(parentDirPath, path))]
-        if len(packageNameDirs) == 0:
-            self.logger.error('Failed to find the directory that describes the package path: '
-                              '{path} has no child directories!'.format(path=parentDirPath))
-            return False
-        elif len(packageNameDirs) > 1:
-            self.logger.warn('Found multiple possible directories that describe the package path: '
-                             '{paths}'.format(paths=', '.join(packageNameDirs)))
-        os.rename(os.path.join(parentDirPath, packageNameDirs[0]),
-                  os.path.join(parentDirPath, self.formatArgs['appId']))
+        replaceFile(tempPath, destPath)
         return True
 
-    def _fillVarInText(self, text):
-        """>>> _fillVarInText(text) -> string
-        Replace any default value with the corresponding
-        formatting argument, if there is a replace command
-        in the text.
-        """
-        cmdStart = text.find('REPLACE(')
-        if cmdStart == -1:
-            return text
-        cmdData = text[cmdStart + len('REPLACE('):]
-        paramEndIndex = cmdData.find(')')
-        if paramEndIndex != -1:
-            indexes = [index.strip() for index in cmdData[:paramEndIndex].split(',')]
-            if len(indexes) == 2 or not all(map(lambda index: index.isdigit(), indexes)):
-                indexes = [int(index) for index in indexes]
-                key = cmdData[cmdData.find(':', paramEndIndex) + 1:].strip()
-                if len(key) > 0:
-                    key = key[:key.find(' ')]
-                    if key not in self.formatArgs:
-                        self.logger.warn('Found unknown formatting variable "{name}"!'
-                                         .format(name=key))
-                        return text
-                    elif self.formatArgs[key] is None:
-                        return text
-                    self.logger.verbose('Replacing variable "{name}" with " {value}"'
-                                        .format(name=key, value=self.formatArgs[key]))
-                    return text[:(indexes[0] - 1)] + self.formatArgs[key] + text[(indexes[1] - 1):]
-        self.logger.warn('Found invalid formatting command: "{cmd}"'.format(cmd=text))
-        return text
-
-    def _fillFileTemplate(self, filePath):
-        """_fillFileTemplate(filePath)
-        Fill all default values in the provided file
-        with their corresponding formatting arguments.
-        """
-        with open(filePath) as f:
-            lines = f.readlines()
-        with open(filePath, 'w') as f:
-            for line in lines:
-                f.write(self._fillVarInText(line))
-
     def fillTemplate(self, sdkPath):
         """>>> fillTemplate(sdkPath) -> success
         Fill all default values in the template
@@ -247,26 +355,47 @@ class ApkTemplateFiller(object):
             self.logger.warn('No arguments specified to fill in the apk template. The app will be '
                              'generated using the default configuration! This is most likely not '
                              'what you want and the resulting apk must only be used for testing.')
-            return True
-        if not self.validateValues():
+        elif not self.validateValues():
             return False
-        if not (self.copyCustomManifestTemplate() and self.copyIcon()):
+        for relPath, lineNumber, command in self.fillPlan.invalidCommands:
+            self.logger.warn('Found invalid formatting command in {path}, line {line}: "{cmd}"'
+                             .format(path=relPath, line=lineNumber, cmd=command))
+        if self.appManifestTemplate is not None:
+            templateManifestPath = os.path.join(self.templateDir, self.TEMPLATE_MANIFEST_PATH)
+            if not os.path.exists(templateManifestPath):
+                self.logger.error('Could not find the manifest file of the template at {path}'
+                                  .format(path=templateManifestPath))
+                return False
+        if not self.copyIcon():
             return False
-        for dirPath, dirNames, fileNames in os.walk(self.templateDir):
-            if '.git' in dirNames:
-                dirNames.remove('.git')
-            files = [os.path.join(dirPath, filename) for filename in fileNames
-                     if os.path.splitext(filename)[-1] in self.FORMAT_FILES_EXT]
-            for filePath in files:
-                self._fillFileTemplate(filePath)
-        return self.createPropertiesFile(sdkPath) and self.changePackageName()
+        templateFiles = [path for path in self.getOwnedFiles()
+                         if path != self.TEMPLATE_ICON_PATH.replace(os.path.sep, '/')]
+        if self.jobs > 1 and len(templateFiles) > 1:
+            pool = ThreadPool(min(self.jobs, len(templateFiles)))
+            try:
+                changed = pool.map(self._fillFileTemplate, templateFiles)
+            finally:
+                pool.close()
+        else:
+            changed = [self._fillFileTemplate(path) for path in templateFiles]
+        self.logger.info('Filled {num} template files, {changed} of them changed.'
+                         .format(num=len(templateFiles), changed=sum(changed)))
+        return self.createPropertiesFile(sdkPath)
 
     def createPropertiesFile(self, sdkPath):
         """>>> createPropertiesFile(sdkPath):
-        Create a local.properties file in the template
-        and set the sdk path to the provided path.
+        Create a local.properties file in the build
+        directory and set the sdk path to the provided path.
         """
-        with open(os.path.join(self.templateDir, 'local.properties'), 'w') as propertiesFile:
-            sdkPath = sdkPath.replace('\\', '\\\\').replace(':', '\\:')
-            propertiesFile.write('sdk.dir={path}'.format(path=sdkPath))
+        sdkPath = sdkPath.replace('\\', '\\\\').replace(':', '\\:')
+        content = 'sdk.dir={path}'.format(path=sdkPath)
+        propertiesPath = os.path.join(self.buildDir, 'local.properties')
+        if os.path.isfile(propertiesPath):
+            with open(propertiesPath) as propertiesFile:
+                if propertiesFile.read() == content:
+                    return True
+        # Replace the file instead of writing to it, it might be hard linked to the template
+        with open(propertiesPath + '.tmp', 'w') as propertiesFile:
+            propertiesFile.write(content)
+        replaceFile(propertiesPath + '.tmp', propertiesPath)
         return True
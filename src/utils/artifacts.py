@@ -0,0 +1,178 @@
+"""
+A content-addressed cache of build artifacts. The artifacts of a build
+are stored under a fingerprint of all inputs of the build, so an
+identical build can be skipped and its artifacts reused instead.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from time import time
+
+from .files import fileDigest, mkDirs, replaceFile, walkDir
+
+
+class Fingerprint(object):
+    """
+    Combines named values and the contents of
+    files into a single sha256 hash.
+    """
+    _digest = None
+
+    def __init__(self):
+        self._digest = hashlib.sha256()
+
+    def _add(self, name, value):
+        self._digest.update(json.dumps([name, value], sort_keys=True).encode('utf-8'))
+
+    def addValue(self, name, value):
+        """>>> addValue(name, value)
+        Add a value that can be serialized to JSON.
+        """
+        self._add(name, value)
+
+    def addFile(self, name, path):
+        """>>> addFile(name, path)
+        Add the content of the file at 'path', which might be None.
+        """
+        self._add(name, None if path is None or not os.path.isfile(path)
+                  else fileDigest(path, algorithm='sha256'))
+
+    def hexdigest(self):
+        return self._digest.hexdigest()
+
+
+def hashFiles(srcDir, ignore=None, statePath=None):
+    """>>> hashFiles(srcDir, ignore, statePath) -> dict of relative path to hex digest
+    Returns the sha256 hashes of the contents of all files in 'srcDir'.
+    'ignore' works like the ignore function of syncDir. The files are
+    hashed in blocks, so they are never read completely into memory,
+    and the hashes are remembered together with the size and
+    modification time of the files in the state file at 'statePath',
+    so only new or changed files are read again.
+    """
+    oldState = {}
+    if statePath is not None and os.path.isfile(statePath):
+        try:
+            with open(statePath) as stateFile:
+                oldState = json.load(stateFile)
+        except (IOError, OSError, ValueError):
+            oldState = {}
+    newState = {}
+    for dirPath, dirNames, fileNames in walkDir(srcDir):
+        relDir = os.path.relpath(dirPath, srcDir).replace(os.path.sep, '/')
+        relDir = '' if relDir == '.' else relDir + '/'
+        dirNames[:] = [name for name in dirNames
+                       if ignore is None or not ignore(relDir + name, True)]
+        for fileName in fileNames:
+            relPath = relDir + fileName
+            if ignore is not None and ignore(relPath, False):
+                continue
+            path = os.path.join(dirPath, fileName)
+            fileStat = os.stat(path)
+            signature = [fileStat.st_size, fileStat.st_mtime]
+            oldEntry = oldState.get(relPath)
+            if oldEntry is not None and oldEntry[0:2] == signature:
+                newState[relPath] = oldEntry
+            else:
+                newState[relPath] = signature + [fileDigest(path, algorithm='sha256')]
+    if statePath is not None and newState != oldState and mkDirs(os.path.dirname(statePath)):
+        tempPath = statePath + '.tmp'
+        with open(tempPath, 'w') as stateFile:
+            json.dump(newState, stateFile)
+        replaceFile(tempPath, statePath)
+    return dict((relPath, entry[2]) for relPath, entry in newState.items())
+
+
+def hashTree(srcDir, ignore=None, statePath=None):
+    """>>> hashTree(srcDir, ignore, statePath) -> hex digest
+    Returns a sha256 hash of the paths and the contents of all
+    files in 'srcDir'. The arguments are the same as for hashFiles.
+    """
+    digest = hashlib.sha256()
+    for relPath, fileHash in sorted(hashFiles(srcDir, ignore, statePath).items()):
+        digest.update('{path}\0{hash}\n'.format(path=relPath, hash=fileHash).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class ArtifactCache(object):
+    """
+    Stores named artifact files in a directory per fingerprint.
+    Entries are written to a temporary directory and renamed
+    when they are complete, so concurrent builds never see
+    partial entries. The least recently used entries are
+    removed when there are more than 'maxEntries' entries.
+    """
+    _MANIFEST_NAME = 'artifacts.json'
+    cacheDir = None
+    maxEntries = 20
+    logger = None
+
+    def __init__(self, cacheDir, logger, maxEntries=20):
+        self.cacheDir = cacheDir
+        self.logger = logger
+        self.maxEntries = maxEntries
+
+    def lookup(self, key):
+        """>>> lookup(key) -> dict of name to path or None
+        Returns the paths of the artifacts stored under 'key'.
+        """
+        entryDir = os.path.join(self.cacheDir, key)
+        try:
+            with open(os.path.join(entryDir, self._MANIFEST_NAME)) as manifestFile:
+                manifest = json.load(manifestFile)
+        except (IOError, OSError, ValueError):
+            return None
+        artifacts = dict((name, os.path.join(entryDir, fileName))
+                         for name, fileName in manifest['artifacts'].items())
+        if not all(os.path.isfile(path) for path in artifacts.values()):
+            return None
+        try:
+            os.utime(entryDir, None)  # Mark the entry as recently used
+        except OSError:
+            pass
+        return artifacts
+
+    def store(self, key, artifacts):
+        """>>> store(key, artifacts) -> success
+        Store copies of the artifacts (a dict of name to path) under 'key'.
+        """
+        entryDir = os.path.join(self.cacheDir, key)
+        tempDir = '{path}.tmp-{pid}'.format(path=entryDir, pid=os.getpid())
+        try:
+            if os.path.exists(tempDir):
+                shutil.rmtree(tempDir)
+            os.makedirs(tempDir)
+            manifest = {'created': time(), 'artifacts': {}}
+            for name, path in artifacts.items():
+                fileName = os.path.basename(path)
+                shutil.copy2(path, os.path.join(tempDir, fileName))
+                manifest['artifacts'][name] = fileName
+            with open(os.path.join(tempDir, self._MANIFEST_NAME), 'w') as manifestFile:
+                json.dump(manifest, manifestFile, indent=2, sort_keys=True)
+            if os.path.exists(entryDir):
+                shutil.rmtree(entryDir)
+            os.rename(tempDir, entryDir)
+        except (IOError, OSError) as e:
+            self.logger.warn('Failed to store the build artifacts in the cache {path}: {msg}'
+                             .format(path=self.cacheDir, msg=str(e)))
+            shutil.rmtree(tempDir, ignore_errors=True)
+            return False
+        self.prune()
+        return True
+
+    def prune(self):
+        """>>> prune()
+        Remove the least recently used entries, so that
+        at most 'maxEntries' entries are kept.
+        """
+        try:
+            entries = [os.path.join(self.cacheDir, name) for name in os.listdir(self.cacheDir)
+                       if '.tmp-' not in name]
+            entries.sort(key=os.path.getmtime, reverse=True)
+        except OSError:
+            return
+        for entryDir in entries[self.maxEntries:]:
+            self.logger.verbose('Removing the cached artifacts in {path}', path=entryDir)
+            shutil.rmtree(entryDir, ignore_errors=True)
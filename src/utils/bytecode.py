@@ -0,0 +1,310 @@
+"""
+Compiles Python sources to bytecode for one or more target interpreters.
+Every target interpreter compiles the sources in multiple worker processes
+and compiled files are stored in a cache keyed by the source content.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from .files import mkDirs, replaceFile
+
+_INTERPRETER_INFO_SCRIPT = '''
+import sys
+print('%d.%d' % sys.version_info[:2])
+print(getattr(getattr(sys, 'implementation', None), 'cache_tag', None) or '')
+'''
+
+# Reads lines of 'sourcePath<TAB>bytecodePath<TAB>displayName' from stdin and compiles them.
+# Must be compatible with all supported target interpreters.
+_COMPILE_SCRIPT = '''
+import sys, py_compile
+try:
+    mode = py_compile.PycInvalidationMode.CHECKED_HASH
+except AttributeError:
+    mode = None
+for line in sys.stdin:
+    src, dest, name = line.rstrip('\\n').split('\\t')
+    try:
+        if mode is None:
+            py_compile.compile(src, dest, name, doraise=True)
+        else:
+            py_compile.compile(src, dest, name, doraise=True, invalidation_mode=mode)
+        sys.stdout.write('OK\\t%s\\n' % src)
+    except py_compile.PyCompileError as e:
+        sys.stdout.write('ERR\\t%s\\t%s\\n' % (src, ' '.join(str(e.msg).split())))
+    except Exception as e:
+        sys.stdout.write('ERR\\t%s\\t%s\\n' % (src, ' '.join(str(e).split())))
+    sys.stdout.flush()
+'''
+
+
+class TargetInterpreter(object):
+    """A Python interpreter that bytecode is generated for."""
+    executable = None
+    version = None
+    cacheTag = None
+
+    def __init__(self, executable, version, cacheTag):
+        self.executable = executable
+        self.version = version
+        self.cacheTag = cacheTag
+
+    @property
+    def name(self):
+        return self.cacheTag or 'python{0}.{1}'.format(*self.version)
+
+    def usesHashBasedPyc(self):
+        """>>> usesHashBasedPyc() -> boolean
+        Returns True if the interpreter generates bytecode files
+        that are validated with a hash of the source (PEP 552).
+        """
+        return self.version >= (3, 7)
+
+    def getBytecodePath(self, relPath):
+        """>>> getBytecodePath(relPath) -> path
+        Returns the path of the bytecode file for the source
+        file at 'relPath', where the interpreter expects it.
+        """
+        if not self.cacheTag:
+            return relPath + 'c'
+        dirPath, fileName = os.path.split(relPath)
+        return os.path.join(dirPath, '__pycache__', '{name}.{tag}.pyc'.format(
+            name=os.path.splitext(fileName)[0], tag=self.cacheTag))
+
+
+def parseVersion(version):
+    """>>> parseVersion(version) -> tuple or None
+    Parse a version string like '2.7' into a tuple of ints.
+    """
+    if version is None or not re.match(r'\A\d+(\.\d+)*\Z', version.strip()):
+        return None
+    return tuple(int(part) for part in version.strip().split('.'))
+
+
+def queryInterpreter(executable, logger):
+    """>>> queryInterpreter(executable, logger) -> TargetInterpreter or None
+    Ask the interpreter at 'executable' for its version and cache tag.
+    """
+    args = [executable, '-c', _INTERPRETER_INFO_SCRIPT]
+    logger.verbose('Calling ' + subprocess.list2cmdline(args))
+    try:
+        with open(os.devnull, 'w') as devNull:
+            output = subprocess.check_output(args, stderr=devNull, universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    lines = output.splitlines() + ['']
+    version = parseVersion(lines[0])
+    if version is None:
+        return None
+    return TargetInterpreter(executable, version[:2], lines[1].strip() or None)
+
+
+def findInterpreters(minPyVersion, executables, logger):
+    """>>> findInterpreters(minPyVersion, executables, logger) -> list of TargetInterpreter
+    Find the target interpreters. If 'executables' is empty,
+    all interpreters called pythonX.Y on the PATH with the same
+    major version as 'minPyVersion' and a version not lower
+    than 'minPyVersion' are used.
+    """
+    interpreters = []
+    if not executables:
+        minVersion = parseVersion(minPyVersion)
+        majorVersions = [minVersion[0]] if minVersion else [2, 3]
+        executables = ['python{major}.{minor}'.format(major=major, minor=minor)
+                       for major in majorVersions for minor in range(0, 20)
+                       if minVersion is None or (major, minor) >= minVersion[:2]]
+        executables = [executable for executable in executables
+                       if _findExecutable(executable) is not None]
+    for executable in executables:
+        interpreter = queryInterpreter(executable, logger)
+        if interpreter is None:
+            logger.warn('Failed to query the Python interpreter {exe}'.format(exe=executable))
+        elif interpreter.version not in [other.version for other in interpreters]:
+            interpreters.append(interpreter)
+    return interpreters
+
+
+def _findExecutable(name):
+    """>>> _findExecutable(name) -> path or None
+    Returns the path of the executable called 'name' on the PATH.
+    """
+    for dirPath in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(dirPath, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+class BytecodeCompiler(object):
+    """
+    Compiles all Python sources in a directory for a set of target
+    interpreters and places the bytecode files next to them.
+    """
+    interpreters = None
+    cacheDir = None
+    statePath = None
+    logger = None
+    jobs = None
+    errors = None
+
+    def __init__(self, interpreters, cacheDir, statePath, logger, jobs=None):
+        self.interpreters = interpreters
+        self.cacheDir = cacheDir
+        self.statePath = statePath
+        self.logger = logger
+        self.jobs = jobs or cpu_count()
+        self.errors = []
+
+    @staticmethod
+    def isBytecodePath(relPath):
+        """>>> isBytecodePath(relPath) -> boolean
+        Returns True if 'relPath' is a path that a bytecode
+        file is written to.
+        """
+        relPath = relPath.replace(os.path.sep, '/')
+        return relPath.endswith('.pyc') or relPath.endswith('/__pycache__') \
+            or relPath == '__pycache__'
+
+    def _getCacheKey(self, interpreter, sourcePath, relPath):
+        """>>> _getCacheKey(interpreter, sourcePath, relPath) -> key
+        Compute the key of the bytecode of the source file in the cache.
+        """
+        digest = hashlib.sha1(relPath.replace(os.path.sep, '/').encode('utf-8') + b'\0')
+        with open(sourcePath, 'rb') as sourceFile:
+            digest.update(sourceFile.read())
+        if not interpreter.usesHashBasedPyc():
+            stat = os.stat(sourcePath)
+            digest.update('\0{size}\0{time}'.format(
+                size=stat.st_size, time=int(stat.st_mtime)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _compileChunk(self, interpreter, chunk):
+        """>>> _compileChunk(interpreter, chunk) -> list of (sourcePath, error)
+        Compile the (sourcePath, cachePath, relPath) entries in
+        'chunk' in a new process of the interpreter.
+        """
+        args = [interpreter.executable, '-c', _COMPILE_SCRIPT]
+        tasks = ''.join('{src}\t{dest}\t{name}\n'.format(src=src, dest=dest, name=name)
+                        for src, dest, name in chunk)
+        process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   universal_newlines=True)
+        output = process.communicate(tasks)[0]
+        results = [line.split('\t', 2) for line in output.splitlines()]
+        errors = [(result[1], result[2]) for result in results if result[0] == 'ERR']
+        if process.returncode != 0 or len(results) != len(chunk):
+            errors.append((chunk[len(results)][0] if len(results) < len(chunk) else None,
+                           'The interpreter {exe} exited with code {code}'.format(
+                               exe=interpreter.executable, code=process.returncode)))
+        return errors
+
+    def _compileForInterpreter(self, interpreter, sourceDir, sourceFiles, state):
+        """>>> _compileForInterpreter(interpreter, sourceDir, sourceFiles, state)
+        -> (list of bytecode paths, number of compiled files)
+        Compile all source files for the interpreter, using the
+        cache for unchanged files, and copy the results next to
+        the sources.
+        """
+        cacheDir = os.path.join(self.cacheDir, interpreter.name)
+        if not mkDirs(cacheDir):
+            raise OSError('Failed to create the bytecode cache directory ' + cacheDir)
+        entries = []
+        missing = []
+        for relPath in sourceFiles:
+            sourcePath = os.path.join(sourceDir, relPath)
+            cachePath = os.path.join(cacheDir, self._getCacheKey(
+                interpreter, sourcePath, relPath) + '.pyc')
+            entries.append((relPath, cachePath))
+            if not os.path.isfile(cachePath):
+                missing.append((sourcePath, cachePath + '.tmp', relPath.replace(os.path.sep, '/')))
+        if missing:
+            numChunks = min(self.jobs, len(missing))
+            chunks = [missing[index::numChunks] for index in range(numChunks)]
+            pool = ThreadPool(numChunks)
+            try:
+                results = pool.map(lambda chunk: self._compileChunk(interpreter, chunk), chunks)
+            finally:
+                pool.close()
+            for errors in results:
+                for sourcePath, message in errors:
+                    self.errors.append((interpreter, sourcePath, message))
+            for _, tempPath, _ in missing:
+                if os.path.isfile(tempPath):
+                    replaceFile(tempPath, tempPath[:-len('.tmp')])
+        bytecodePaths = []
+        for relPath, cachePath in entries:
+            bytecodeRelPath = interpreter.getBytecodePath(relPath)
+            bytecodePath = os.path.join(sourceDir, bytecodeRelPath)
+            bytecodePaths.append(bytecodePath)
+            if not os.path.isfile(cachePath):
+                continue
+            if state.get(bytecodeRelPath) == os.path.basename(cachePath) and \
+                    os.path.isfile(bytecodePath):
+                continue
+            mkDirs(os.path.dirname(bytecodePath))
+            shutil.copyfile(cachePath, bytecodePath)
+            state[bytecodeRelPath] = os.path.basename(cachePath)
+        return bytecodePaths, len(missing)
+
+    def compileDir(self, sourceDir):
+        """>>> compileDir(sourceDir) -> success
+        Compile all Python sources in 'sourceDir' for all
+        target interpreters. Bytecode files that don't belong
+        to a source anymore are removed. Returns False and
+        logs the errors, if any source failed to compile.
+        """
+        sourceFiles = []
+        for dirPath, dirNames, fileNames in os.walk(sourceDir):
+            if '__pycache__' in dirNames:
+                dirNames.remove('__pycache__')
+            relDir = os.path.relpath(dirPath, sourceDir)
+            sourceFiles += [os.path.normpath(os.path.join(relDir, fileName))
+                            for fileName in fileNames if fileName.endswith('.py')]
+        state = {}
+        if os.path.isfile(self.statePath):
+            try:
+                with open(self.statePath) as stateFile:
+                    state = json.load(stateFile)
+            except (IOError, OSError, ValueError):
+                state = {}
+        bytecodePaths = set()
+        for interpreter in self.interpreters:
+            paths, numCompiled = self._compileForInterpreter(
+                interpreter, sourceDir, sourceFiles, state)
+            bytecodePaths.update(paths)
+            self.logger.info('Compiled {num} of {total} Python sources for {name} ({cached} '
+                             'cached)'.format(num=numCompiled, total=len(sourceFiles),
+                                              name=interpreter.name,
+                                              cached=len(sourceFiles) - numCompiled))
+        self._removeStaleBytecode(sourceDir, bytecodePaths, state)
+        if mkDirs(os.path.dirname(self.statePath)):
+            with open(self.statePath + '.tmp', 'w') as stateFile:
+                json.dump(state, stateFile)
+            replaceFile(self.statePath + '.tmp', self.statePath)
+        for interpreter, sourcePath, message in self.errors:
+            self.logger.error('Failed to compile {path} for {name}: {msg}'.format(
+                path=sourcePath, name=interpreter.name, msg=message))
+        return len(self.errors) == 0
+
+    @staticmethod
+    def _removeStaleBytecode(sourceDir, bytecodePaths, state):
+        """>>> _removeStaleBytecode(sourceDir, bytecodePaths, state)
+        Remove all bytecode files in 'sourceDir' that are
+        not in 'bytecodePaths'.
+        """
+        for dirPath, dirNames, fileNames in os.walk(sourceDir, topdown=False):
+            for fileName in fileNames:
+                path = os.path.join(dirPath, fileName)
+                if fileName.endswith('.pyc') and path not in bytecodePaths:
+                    os.remove(path)
+                    state.pop(os.path.relpath(path, sourceDir), None)
+            if os.path.basename(dirPath) == '__pycache__' and len(os.listdir(dirPath)) == 0:
+                os.rmdir(dirPath)
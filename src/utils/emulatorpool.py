@@ -0,0 +1,296 @@
+"""
+A pool of emulators that keep running between invocations of the
+install command. An emulator is leased to one invocation at a time,
+its health is checked before it is reused and it is shut down after
+it was idle for a while. The state of the pool is stored in a JSON
+file, which is only accessed while holding an inter-process lock.
+"""
+
+import errno
+import json
+import os
+import signal
+import subprocess
+from time import sleep, time
+
+from .adb import ShellSession, findFreeEmulatorPort
+from .files import DirectoryLock, mkDirs, replaceFile
+from .process import runProcess
+
+
+def isProcessAlive(pid):
+    """>>> isProcessAlive(pid) -> boolean
+    Returns True if a process with the given id is running.
+    """
+    if os.name == 'nt':
+        try:
+            output = subprocess.check_output(
+                ['tasklist', '/FI', 'PID eq {pid}'.format(pid=pid), '/NH'],
+                universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError):
+            return False
+        return str(pid) in output.split()
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class EmulatorPool(object):
+    """
+    Manages the emulators of the configured AVDs. The emulators are
+    started detached from the current process, so they can be reused
+    by later invocations. Unless snapshots are disabled, the emulators
+    boot from their quick boot snapshot, which is saved when they are
+    shut down through the emulator console.
+    """
+    HEALTH_CHECK_TIMEOUT = 10
+    SHUTDOWN_TIMEOUT = 60
+    stateDir = None
+    emulatorPath = None
+    adbPath = None
+    logger = None
+    avds = None
+    idleTimeout = 900
+    useSnapshots = True
+    bootTimeout = 180
+    _statePath = None
+    _lockPath = None
+
+    def __init__(self, stateDir, emulatorPath, adbPath, logger, avds, idleTimeout=900,
+                 useSnapshots=True, bootTimeout=180):
+        self.stateDir = stateDir
+        self.emulatorPath = emulatorPath
+        self.adbPath = adbPath
+        self.logger = logger
+        self.avds = avds
+        self.idleTimeout = idleTimeout
+        self.useSnapshots = useSnapshots
+        self.bootTimeout = bootTimeout
+        self._statePath = os.path.join(stateDir, 'pool.json')
+        self._lockPath = os.path.join(stateDir, 'pool.lock')
+
+    def _lock(self):
+        mkDirs(self.stateDir)
+        return DirectoryLock(self._lockPath, timeout=120, staleAge=300)
+
+    def _loadState(self):
+        """>>> _loadState() -> dict of avd name to emulator entry
+        Load the state of the pool. A missing or broken state file results in an empty pool.
+        """
+        try:
+            with open(self._statePath) as stateFile:
+                state = json.load(stateFile)
+        except (IOError, OSError, ValueError):
+            return {}
+        return state if isinstance(state, dict) else {}
+
+    def _saveState(self, state):
+        tempPath = self._statePath + '.tmp'
+        with open(tempPath, 'w') as stateFile:
+            json.dump(state, stateFile, indent=2, sort_keys=True)
+        replaceFile(tempPath, self._statePath)
+
+    def getConnectedDevices(self):
+        """>>> getConnectedDevices() -> dict of device name to state
+        Returns the devices known to adb and their state.
+        """
+        try:
+            output = subprocess.check_output([self.adbPath, 'devices'], universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.logger.warn('Failed to list the connected devices: ' + str(e))
+            return {}
+        devices = {}
+        for line in output.splitlines():
+            content = line.split()
+            if len(content) == 2:
+                devices[content[0]] = content[1]
+        return devices
+
+    def _refresh(self, state):
+        """>>> _refresh(state)
+        Remove the emulators whose process exited from the
+        state and release the leases of exited processes.
+        """
+        for avd, entry in list(state.items()):
+            if not isProcessAlive(entry['pid']):
+                self.logger.verbose('Emulator {avd} ({device}) is no longer running.',
+                                    avd=avd, device=entry['device'])
+                del state[avd]
+            elif entry['leasedBy'] is not None and not isProcessAlive(entry['leasedBy']):
+                self.logger.verbose('Releasing emulator {avd}, which was leased by the exited '
+                                    'process {pid}.', avd=avd, pid=entry['leasedBy'])
+                entry['leasedBy'] = None
+                entry['lastUsed'] = time()
+
+    def isHealthy(self, entry, devices):
+        """>>> isHealthy(entry, devices) -> boolean
+        Returns True if the emulator is connected to adb and
+        its shell answers within HEALTH_CHECK_TIMEOUT seconds.
+        """
+        if devices.get(entry['device']) != 'device':
+            return False
+        session = ShellSession(self.adbPath, entry['device'])
+        try:
+            session.start()
+            output = session.run('echo ok', self.HEALTH_CHECK_TIMEOUT)
+        finally:
+            session.close()
+        return output is not None and output.strip() == 'ok'
+
+    def _startEmulator(self, avd, usedDevices):
+        """>>> _startEmulator(avd, usedDevices) -> (entry, process) or (None, None)
+        Start the emulator for the AVD detached from this process.
+        """
+        port = findFreeEmulatorPort(usedDevices)
+        if port is None:
+            self.logger.error('Failed to find a free port for emulator {avd}'.format(avd=avd))
+            return None, None
+        args = [self.emulatorPath, '-avd', avd, '-port', str(port)]
+        if not self.useSnapshots:
+            args.append('-no-snapshot')
+        self.logger.info('Starting emulator {avd} on port {port}...'.format(avd=avd, port=port))
+        self.logger.verbose('Calling ' + subprocess.list2cmdline(args))
+        extraArgs = {'creationflags': 0x00000008} if os.name == 'nt' \
+            else {'preexec_fn': os.setsid}  # Detach the emulator from this process
+        try:
+            with open(os.path.join(self.stateDir, avd + '.log'), 'w') as logFile, \
+                    open(os.devnull) as devNull:
+                process = subprocess.Popen(args, stdin=devNull, stdout=logFile,
+                                           stderr=subprocess.STDOUT, **extraArgs)
+        except OSError as e:
+            self.logger.error('Failed to start emulator {avd}: {msg}'.format(avd=avd, msg=str(e)))
+            return None, None
+        now = time()
+        entry = {'device': 'emulator-{port}'.format(port=port), 'pid': process.pid,
+                 'started': now, 'lastUsed': now, 'leasedBy': None}
+        return entry, process
+
+    def stopEmulator(self, entry):
+        """>>> stopEmulator(entry)
+        Shut the emulator down through its console, which saves its
+        quick boot snapshot, and kill it if it does not exit in time.
+        """
+        self.logger.info('Stopping emulator {device}...'.format(device=entry['device']))
+        runProcess([self.adbPath, '-s', entry['device'], 'emu', 'kill'], self.logger)
+        endTime = time() + self.SHUTDOWN_TIMEOUT
+        while isProcessAlive(entry['pid']) and time() < endTime:
+            sleep(0.2)
+        if isProcessAlive(entry['pid']):
+            self.logger.warn('Emulator {device} did not shut down in time, killing it.'
+                             .format(device=entry['device']))
+            try:
+                os.kill(entry['pid'], getattr(signal, 'SIGKILL', signal.SIGTERM))
+            except OSError:
+                pass
+
+    def lease(self, avd=None):
+        """>>> lease(avd) -> (device name, process or None) or (None, None)
+        Lease a running and healthy emulator of the AVD (or of any AVD of
+        the pool, in the configured order) or start a new one. If a new
+        emulator was started, its process is returned, too. The emulator
+        might still be booting and must be released with release().
+        """
+        candidates = self.avds if avd is None else [avd]
+        with self._lock():
+            state = self._loadState()
+            self._refresh(state)
+            devices = self.getConnectedDevices()
+            for candidate in candidates:
+                entry = state.get(candidate)
+                if entry is None or entry['leasedBy'] is not None:
+                    continue
+                # An emulator that is still booting might not be connected yet
+                if entry['started'] + self.bootTimeout < time() and \
+                        not self.isHealthy(entry, devices):
+                    self.logger.warn('Emulator {avd} ({device}) is not responding, '
+                                     'restarting it.'.format(avd=candidate,
+                                                             device=entry['device']))
+                    self.stopEmulator(entry)
+                    del state[candidate]
+                    continue
+                entry['leasedBy'] = os.getpid()
+                self._saveState(state)
+                self.logger.info('Reusing running emulator {avd} ({device}).'
+                                 .format(avd=candidate, device=entry['device']))
+                return entry['device'], None
+            for candidate in candidates:
+                if candidate in state:
+                    continue
+                usedDevices = list(devices.keys()) + [entry['device'] for entry in state.values()]
+                entry, process = self._startEmulator(candidate, usedDevices)
+                if entry is None:
+                    return None, None
+                entry['leasedBy'] = os.getpid()
+                state[candidate] = entry
+                self._saveState(state)
+                return entry['device'], process
+        self.logger.error('All emulators of the pool are in use: {avds}'
+                          .format(avds=', '.join(candidates)))
+        return None, None
+
+    def release(self, device):
+        """>>> release(device)
+        Return the leased emulator to the pool.
+        """
+        with self._lock():
+            state = self._loadState()
+            for entry in state.values():
+                if entry['device'] == device and entry['leasedBy'] == os.getpid():
+                    entry['leasedBy'] = None
+                    entry['lastUsed'] = time()
+            self._saveState(state)
+
+    def start(self, avds=None):
+        """>>> start(avds) -> list of started device names
+        Start the emulators of the AVDs that are not running yet,
+        without leasing them.
+        """
+        started = []
+        with self._lock():
+            state = self._loadState()
+            self._refresh(state)
+            devices = self.getConnectedDevices()
+            for avd in avds or self.avds:
+                if avd in state:
+                    continue
+                usedDevices = list(devices.keys()) + [entry['device'] for entry in state.values()]
+                entry, _ = self._startEmulator(avd, usedDevices)
+                if entry is not None:
+                    state[avd] = entry
+                    started.append(entry['device'])
+            self._saveState(state)
+        return started
+
+    def shutdown(self, avds=None, idleOnly=True):
+        """>>> shutdown(avds, idleOnly) -> number of stopped emulators
+        Stop the emulators of the AVDs (or all emulators of the pool)
+        that are not leased. If 'idleOnly' is True, only emulators that
+        were not used for 'idleTimeout' seconds are stopped.
+        """
+        with self._lock():
+            state = self._loadState()
+            self._refresh(state)
+            stopped = []
+            for avd, entry in list(state.items()):
+                if avds is not None and avd not in avds or entry['leasedBy'] is not None:
+                    continue
+                if idleOnly and entry['lastUsed'] + self.idleTimeout > time():
+                    continue
+                stopped.append(entry)
+                del state[avd]
+            self._saveState(state)
+        for entry in stopped:
+            self.stopEmulator(entry)
+        return len(stopped)
+
+    def getStatus(self):
+        """>>> getStatus() -> dict of avd name to emulator entry
+        Returns the running emulators of the pool.
+        """
+        with self._lock():
+            state = self._loadState()
+            self._refresh(state)
+            self._saveState(state)
+        return state
@@ -1,7 +1,18 @@
 import errno
+import hashlib
+import json
 import os
 import shutil
-from time import sleep
+from time import sleep, time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# The ioctl that clones the data of a file on Linux file systems like btrfs and xfs.
+_FICLONE = 0x40049409
+STAGING_MODES = ['auto', 'reflink', 'hardlink', 'copy']
 
 
 def mkDirs(path):
@@ -52,3 +63,352 @@ def resolvePath(path, currDir=None):
     if os.path.isabs(path):
         return path
     return os.path.join(currDir, path)
+
+
+class DirectoryLock(object):
+    """
+    An inter-process lock, held while the directory at 'path' exists.
+    A lock that is older than 'staleAge' seconds is considered
+    abandoned and is broken. Use it in a with statement.
+    """
+    path = None
+    timeout = None
+    staleAge = None
+
+    def __init__(self, path, timeout=600, staleAge=3600):
+        self.path = path
+        self.timeout = timeout
+        self.staleAge = staleAge
+
+    def __enter__(self):
+        endTime = time() + self.timeout
+        while True:
+            try:
+                os.mkdir(self.path)
+                return self
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                if time() - os.path.getmtime(self.path) > self.staleAge:
+                    os.rmdir(self.path)
+                    continue
+            except OSError:
+                continue
+            if time() > endTime:
+                raise OSError(errno.EEXIST, 'Timed out waiting for the lock', self.path)
+            sleep(0.1)
+
+    def __exit__(self, excType, excValue, traceback):
+        try:
+            os.rmdir(self.path)
+        except OSError:
+            pass
+
+
+def replaceFile(srcPath, destPath):
+    """>>> replaceFile(srcPath, destPath)
+    Move the file at 'srcPath' to 'destPath', replacing
+    any existing file at 'destPath'. This is atomic on
+    all platforms that support it.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(srcPath, destPath)
+        return
+    if os.name == 'nt' and os.path.exists(destPath):
+        os.remove(destPath)
+    os.rename(srcPath, destPath)
+
+
+class SyncResult(object):
+    """Statistics about a directory synchronization done by syncDir."""
+    copiedFiles = 0
+    copiedBytes = 0
+    unchangedFiles = 0
+    removedFiles = 0
+
+    def __str__(self):
+        return '{copied} copied ({size} bytes), {unchanged} unchanged, {removed} removed'.format(
+            copied=self.copiedFiles, size=self.copiedBytes,
+            unchanged=self.unchangedFiles, removed=self.removedFiles)
+
+
+def fileDigest(path, blockSize=1024 * 1024, algorithm='sha1'):
+    """>>> fileDigest(path, blockSize, algorithm) -> hex digest
+    Returns the hex digest of the content of the file at 'path',
+    reading it in blocks. 'algorithm' is any hashlib algorithm name.
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as fileHandle:
+        for block in iter(lambda: fileHandle.read(blockSize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _copyFileData(srcFile, destFile):
+    """>>> _copyFileData(srcFile, destFile)
+    Copy the content of the source file object into the empty
+    destination file object in the kernel, using copy_file_range or
+    sendfile if they are available, or through a buffer otherwise.
+    """
+    remaining = os.fstat(srcFile.fileno()).st_size
+    try:
+        if hasattr(os, 'copy_file_range'):
+            while remaining > 0:
+                copied = os.copy_file_range(srcFile.fileno(), destFile.fileno(), remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+            return
+        if hasattr(os, 'sendfile') and os.uname()[0] == 'Linux':
+            offset = 0
+            while remaining > 0:
+                copied = os.sendfile(destFile.fileno(), srcFile.fileno(), offset, remaining)
+                if copied == 0:
+                    break
+                offset += copied
+                remaining -= copied
+            return
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+            raise
+    srcFile.seek(0)
+    destFile.seek(0)
+    destFile.truncate()
+    shutil.copyfileobj(srcFile, destFile, 1024 * 1024)
+
+
+class FileStager(object):
+    """
+    A copy function for syncDir that stages files into the build
+    directory without duplicating their data, if possible: As a
+    copy-on-write clone (reflink) on file systems that support it,
+    then as a hard link, if 'allowHardlinks' is True, and else as a
+    copy in the kernel. A hard link shares the file with the source,
+    so hard links must only be allowed for sources that are never
+    changed in place and the staged files must only be replaced,
+    never written to. 'mode' is one of STAGING_MODES and restricts
+    the methods to reflinks or hard links, in both cases with copies
+    as the fallback.
+    """
+    mode = 'auto'
+    allowHardlinks = False
+    reflinkedFiles = 0
+    linkedFiles = 0
+    copiedFiles = 0
+    sharedBytes = 0
+    copiedBytes = 0
+    duration = 0
+    _canReflink = True
+    _canLink = True
+
+    def __init__(self, mode='auto', allowHardlinks=False):
+        if mode not in STAGING_MODES:
+            raise ValueError('Invalid staging mode: ' + mode)
+        self.mode = mode
+        self.allowHardlinks = allowHardlinks
+        self._canReflink = fcntl is not None and mode in ['auto', 'reflink']
+        self._canLink = hasattr(os, 'link') and allowHardlinks and mode in ['auto', 'hardlink']
+
+    def _reflink(self, srcPath, destPath):
+        """>>> _reflink(srcPath, destPath) -> success
+        Clone the source file. Stops trying after the first failure,
+        because the file system or the pair of devices does not change.
+        """
+        try:
+            with open(srcPath, 'rb') as srcFile, open(destPath, 'wb') as destFile:
+                fcntl.ioctl(destFile.fileno(), _FICLONE, srcFile.fileno())
+            return True
+        except (IOError, OSError):
+            self._canReflink = False
+            if os.path.exists(destPath):
+                os.remove(destPath)
+            return False
+
+    def _link(self, srcPath, destPath):
+        """>>> _link(srcPath, destPath) -> success
+        Hard link the source file. Stops trying after the first failure.
+        """
+        try:
+            os.link(srcPath, destPath)
+            return True
+        except OSError:
+            self._canLink = False
+            return False
+
+    def __call__(self, srcPath, destPath):
+        startTime = time()
+        if os.path.lexists(destPath):
+            os.remove(destPath)  # Never write through an earlier hard link
+        size = os.path.getsize(srcPath)
+        if self._canReflink and self._reflink(srcPath, destPath):
+            shutil.copystat(srcPath, destPath)
+            self.reflinkedFiles += 1
+            self.sharedBytes += size
+        elif self._canLink and self._link(srcPath, destPath):
+            self.linkedFiles += 1
+            self.sharedBytes += size
+        else:
+            with open(srcPath, 'rb') as srcFile, open(destPath, 'wb') as destFile:
+                _copyFileData(srcFile, destFile)
+            shutil.copystat(srcPath, destPath)
+            self.copiedFiles += 1
+            self.copiedBytes += size
+        self.duration += time() - startTime
+
+    def __str__(self):
+        return '{reflinked} reflinked, {linked} hard linked, {copied} copied in {duration:.2f}s, ' \
+               '{shared} bytes shared, {copiedBytes} bytes of new disk usage'.format(
+                   reflinked=self.reflinkedFiles, linked=self.linkedFiles,
+                   copied=self.copiedFiles, duration=self.duration, shared=self.sharedBytes,
+                   copiedBytes=self.copiedBytes)
+
+
+def _loadSyncState(statePath):
+    """>>> _loadSyncState(statePath) -> dict
+    Load the synchronization state from 'statePath'.
+    A missing or broken state file results in an empty state.
+    """
+    if statePath is None or not os.path.isfile(statePath):
+        return {}
+    try:
+        with open(statePath) as stateFile:
+            state = json.load(stateFile)
+    except (IOError, OSError, ValueError):
+        return {}
+    return state if isinstance(state, dict) else {}
+
+
+def _saveSyncState(statePath, state):
+    """>>> _saveSyncState(statePath, state)
+    Atomically write the synchronization state to 'statePath'.
+    """
+    if statePath is None or not mkDirs(os.path.dirname(statePath)):
+        return
+    tempPath = statePath + '.tmp'
+    with open(tempPath, 'w') as stateFile:
+        json.dump(state, stateFile)
+    replaceFile(tempPath, statePath)
+
+
+def walkDir(path):
+    """>>> walkDir(path) -> iterator of (dirPath, dirNames, fileNames)
+    Like os.walk, but follows symbolic links to directories, so their
+    content is treated like the content of a real directory. A link to
+    a directory that contains the link is skipped to avoid endless
+    recursion. Entries can be removed from 'dirNames' to skip them.
+    """
+    parents = {path: frozenset()}
+    for dirPath, dirNames, fileNames in os.walk(path, followlinks=True):
+        yield dirPath, dirNames, fileNames
+        chain = parents.pop(dirPath) | {os.path.realpath(dirPath)}
+        subDirNames = []
+        for name in dirNames:
+            subDirPath = os.path.join(dirPath, name)
+            if os.path.realpath(subDirPath) not in chain:
+                parents[subDirPath] = chain
+                subDirNames.append(name)
+        dirNames[:] = subDirNames
+
+
+def _isPreserved(relPath, preserve):
+    """>>> _isPreserved(relPath, preserve) -> boolean
+    Returns True if 'relPath' or one of its parent
+    directories is listed in 'preserve'. 'preserve'
+    can also be a function that receives 'relPath'.
+    """
+    if callable(preserve):
+        return preserve(relPath)
+    for path in preserve:
+        if relPath == path or relPath.startswith(path + '/'):
+            return True
+    return False
+
+
+def syncDir(srcDir, destDir, statePath=None, ignore=None, preserve=(), checksum=False,
+            copyFunction=shutil.copy2):
+    """>>> syncDir(srcDir, destDir, statePath, ignore, preserve, checksum, copyFunction)
+    -> SyncResult
+    Make 'destDir' a copy of 'srcDir', copying only files
+    that changed since the last synchronization and removing
+    files from 'destDir' which don't exist in 'srcDir'.
+    The size and modification time of every source and
+    destination file is remembered in the state file at
+    'statePath', so a destination file that was modified
+    after it was copied is copied again. If 'checksum' is True,
+    a source file whose modification time changed but whose
+    content is identical is not copied again.
+    'ignore' is an optional function receiving the path of a
+    file or directory relative to 'srcDir' (separated by '/')
+    and a boolean indicating a directory, which returns True
+    if the path should not be synchronized. Paths relative to
+    'destDir' listed in 'preserve' are never removed.
+    """
+    oldState = _loadSyncState(statePath)
+    newState = {}
+    srcDirs = set()
+    result = SyncResult()
+    for dirPath, dirNames, fileNames in walkDir(srcDir):
+        relDir = os.path.relpath(dirPath, srcDir).replace(os.path.sep, '/')
+        relDir = '' if relDir == '.' else relDir + '/'
+        if ignore is not None:
+            dirNames[:] = [name for name in dirNames if not ignore(relDir + name, True)]
+        srcDirs.add(relDir.rstrip('/'))
+        destDirPath = os.path.join(destDir, relDir)
+        if os.path.isfile(destDirPath.rstrip(os.path.sep)):
+            os.remove(destDirPath.rstrip(os.path.sep))
+        if not mkDirs(destDirPath):
+            raise OSError(errno.EEXIST, 'Failed to create the directory', destDirPath)
+        for fileName in fileNames:
+            relPath = relDir + fileName
+            if ignore is not None and ignore(relPath, False):
+                continue
+            srcPath = os.path.join(dirPath, fileName)
+            destPath = os.path.join(destDirPath, fileName)
+            srcStat = os.stat(srcPath)
+            srcSignature = [srcStat.st_size, srcStat.st_mtime]
+            try:
+                destStat = os.stat(destPath)
+                destSignature = [destStat.st_size, destStat.st_mtime]
+            except OSError:
+                destSignature = None
+            oldEntry = oldState.get(relPath)
+            if oldEntry is not None and destSignature is not None and \
+                    oldEntry[2:4] == destSignature:
+                if oldEntry[0:2] == srcSignature:
+                    newState[relPath] = oldEntry
+                    result.unchangedFiles += 1
+                    continue
+                if checksum and oldEntry[4] is not None and oldEntry[0] == srcStat.st_size:
+                    digest = fileDigest(srcPath)
+                    if digest == oldEntry[4]:
+                        newState[relPath] = srcSignature + destSignature + [digest]
+                        result.unchangedFiles += 1
+                        continue
+            if os.path.isdir(destPath):
+                shutil.rmtree(destPath)
+            elif destSignature is not None and os.stat(destPath).st_nlink > 1:
+                os.remove(destPath)  # Don't write through a hard link into its source
+            copyFunction(srcPath, destPath)
+            destStat = os.stat(destPath)
+            newState[relPath] = srcSignature + [destStat.st_size, destStat.st_mtime] + \
+                [fileDigest(srcPath) if checksum else None]
+            result.copiedFiles += 1
+            result.copiedBytes += srcStat.st_size
+    emptyCandidates = []
+    for dirPath, dirNames, fileNames in os.walk(destDir):
+        relDir = os.path.relpath(dirPath, destDir).replace(os.path.sep, '/')
+        relDir = '' if relDir == '.' else relDir + '/'
+        dirNames[:] = [name for name in dirNames if not _isPreserved(relDir + name, preserve)]
+        for fileName in fileNames:
+            relPath = relDir + fileName
+            if relPath not in newState and not _isPreserved(relPath, preserve):
+                os.remove(os.path.join(dirPath, fileName))
+                result.removedFiles += 1
+        if relDir and relDir.rstrip('/') not in srcDirs:
+            emptyCandidates.append(dirPath)
+    for dirPath in reversed(emptyCandidates):
+        if len(os.listdir(dirPath)) == 0:
+            os.rmdir(dirPath)
+    _saveSyncState(statePath, newState)
+    return result
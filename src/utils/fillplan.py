@@ -0,0 +1,163 @@
+"""
+The fill plan of a template lists every file of the template that
+contains replace commands and the position of those commands,
+so the template only has to be scanned once per template commit.
+"""
+
+from __future__ import absolute_import
+
+import io
+import json
+import os
+import re
+
+from .files import mkDirs, replaceFile
+
+
+class FillPlan(object):
+    """
+    The positions of all replace commands in the files of a template.
+    A replace command looks like 'REPLACE(start, end): name' and
+    requests that the text between the columns start (inclusive)
+    and end (exclusive) of its line is replaced by the value of
+    the formatting argument called name.
+    """
+    VERSION = 1
+    _COMMAND_MARKER = 'REPLACE('
+    _COMMAND_REGEX = re.compile(r'REPLACE\(([^)\n]*)\)(?:[^:\n]*:\s*([A-Za-z_][A-Za-z0-9_]*))?')
+
+    templateDir = None
+    fileExtensions = None
+    files = None
+    invalidCommands = None
+
+    def __init__(self, templateDir, fileExtensions):
+        self.templateDir = templateDir
+        self.fileExtensions = fileExtensions
+        self.files = {}
+        self.invalidCommands = []
+
+    @classmethod
+    def parseLine(cls, line):
+        """>>> parseLine(line) -> (list of commands, list of invalid commands)
+        Find all replace commands in the line. Each command is a
+        list of the start and end index of the text to replace
+        and the name of the formatting argument.
+        """
+        commands = []
+        invalid = []
+        for match in cls._COMMAND_REGEX.finditer(line):
+            indexes = [index.strip() for index in match.group(1).split(',')]
+            if len(indexes) != 2 or not all(index.isdigit() for index in indexes) or \
+                    match.group(2) is None or not 0 < int(indexes[0]) <= int(indexes[1]):
+                invalid.append(match.group(0))
+                continue
+            commands.append([int(indexes[0]) - 1, int(indexes[1]) - 1, match.group(2)])
+        return commands, invalid
+
+    def scanFile(self, relPath):
+        """>>> scanFile(relPath)
+        Scan the template file at 'relPath' (separated
+        by '/') for replace commands and update the plan.
+        """
+        path = os.path.join(self.templateDir, relPath.replace('/', os.path.sep))
+        self.files.pop(relPath, None)
+        self.invalidCommands = [command for command in self.invalidCommands
+                                if command[0] != relPath]
+        stat = os.stat(path)
+        commands = []
+        with io.open(path, encoding='utf-8', newline='') as templateFile:
+            for lineIndex, line in enumerate(templateFile):
+                if self._COMMAND_MARKER not in line:
+                    continue
+                lineCommands, invalid = self.parseLine(line)
+                commands += [[lineIndex] + command for command in lineCommands]
+                self.invalidCommands += [[relPath, lineIndex + 1, command] for command in invalid]
+        if len(commands) == 0:
+            return
+        self.files[relPath] = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                               'commands': commands}
+
+    def scan(self):
+        """>>> scan()
+        Scan all files with one of the file extensions
+        of this plan in the template directory.
+        """
+        self.files = {}
+        self.invalidCommands = []
+        for dirPath, dirNames, fileNames in os.walk(self.templateDir):
+            if '.git' in dirNames:
+                dirNames.remove('.git')
+            relDir = os.path.relpath(dirPath, self.templateDir).replace(os.path.sep, '/')
+            relDir = '' if relDir == '.' else relDir + '/'
+            for fileName in fileNames:
+                if os.path.splitext(fileName)[-1] in self.fileExtensions:
+                    self.scanFile(relDir + fileName)
+
+    def refresh(self):
+        """>>> refresh() -> number of rescanned files
+        Scan all files of the plan again, that were changed
+        after the plan was created.
+        """
+        rescanned = 0
+        for relPath, entry in list(self.files.items()):
+            path = os.path.join(self.templateDir, relPath.replace('/', os.path.sep))
+            try:
+                stat = os.stat(path)
+            except OSError:
+                del self.files[relPath]
+                continue
+            if [stat.st_size, stat.st_mtime] != [entry['size'], entry['mtime']]:
+                self.scanFile(relPath)
+                rescanned += 1
+        return rescanned
+
+    def load(self, path):
+        """>>> load(path) -> success
+        Load the plan from the cache file at 'path'.
+        """
+        try:
+            with open(path) as planFile:
+                data = json.load(planFile)
+        except (IOError, OSError, ValueError):
+            return False
+        if not isinstance(data, dict) or data.get('version') != self.VERSION or \
+                data.get('extensions') != sorted(self.fileExtensions):
+            return False
+        self.files = data['files']
+        self.invalidCommands = data['invalid']
+        return True
+
+    def save(self, path):
+        """>>> save(path)
+        Store the plan in the cache file at 'path'.
+        """
+        if not mkDirs(os.path.dirname(path)):
+            return
+        with open(path + '.tmp', 'w') as planFile:
+            json.dump({'version': self.VERSION, 'extensions': sorted(self.fileExtensions),
+                       'files': self.files, 'invalid': self.invalidCommands}, planFile)
+        replaceFile(path + '.tmp', path)
+
+    @classmethod
+    def create(cls, templateDir, fileExtensions, cacheDir, commit, logger):
+        """>>> create(templateDir, fileExtensions, cacheDir, commit, logger) -> FillPlan
+        Returns the plan for the template at the given commit from
+        the cache or scans the template, if the plan is not cached.
+        If 'commit' is None, the template is always scanned.
+        """
+        plan = cls(templateDir, fileExtensions)
+        cachePath = None if commit is None or cacheDir is None \
+            else os.path.join(cacheDir, commit + '.json')
+        if cachePath is not None and plan.load(cachePath):
+            rescanned = plan.refresh()
+            logger.verbose('Loaded the fill plan of the template for commit {commit} '
+                           '({num} files changed)', commit=commit, num=rescanned)
+            if rescanned > 0:
+                plan.save(cachePath)
+            return plan
+        logger.info('Scanning the template for replace commands...')
+        plan.scan()
+        if cachePath is not None:
+            plan.save(cachePath)
+        return plan
@@ -1,7 +1,15 @@
+import json
 import os
+import re
 from shutil import rmtree
 import subprocess
+from time import time
 
+from .files import DirectoryLock
+from .process import runProcess
+from ..logger import Logger
+
+_FULL_COMMIT_REGEX = re.compile(r'\A[0-9a-f]{40}\Z')
 _updatedGitRepos = []
 """A Cache for all repositories which have been updated
 during the runtime of this program. We don't want them
@@ -17,37 +25,225 @@ def isInitalized(repoPath):
     return os.path.isdir(os.path.join(repoPath, '.git'))
 
 
-def update(gitPath, repoDir, logger):
-    """>>> update(gitpath, repoDir, logger) -> success
+def _getGitDir(repoDir):
+    """>>> _getGitDir(repoDir) -> path or None
+    Returns the path of the git directory of the
+    repository in 'repoDir'.
+    """
+    gitDir = os.path.join(repoDir, '.git')
+    if os.path.isfile(gitDir):
+        with open(gitDir) as gitFile:
+            content = gitFile.read().strip()
+        if not content.startswith('gitdir:'):
+            return None
+        gitDir = os.path.join(repoDir, content[len('gitdir:'):].strip())
+    return gitDir if os.path.isdir(gitDir) else None
+
+
+def readRef(repoDir, refName):
+    """>>> readRef(repoDir, refName) -> commit or None
+    Resolve the reference 'refName' (e.g. 'HEAD' or
+    'refs/remotes/origin/main') of the repository in
+    'repoDir' to a commit hash by reading the reference
+    files directly, without calling git.
+    """
+    gitDir = _getGitDir(repoDir)
+    if gitDir is None:
+        return None
+    for _ in range(10):  # Limit the depth of symbolic references
+        refPath = os.path.join(gitDir, refName.replace('/', os.path.sep))
+        content = None
+        if os.path.isfile(refPath):
+            with open(refPath) as refFile:
+                content = refFile.read().strip()
+        else:
+            packedRefsPath = os.path.join(gitDir, 'packed-refs')
+            if os.path.isfile(packedRefsPath):
+                with open(packedRefsPath) as packedRefsFile:
+                    for line in packedRefsFile:
+                        parts = line.split()
+                        if len(parts) == 2 and parts[1] == refName:
+                            content = parts[0]
+                            break
+        if content is None:
+            return None
+        if not content.startswith('ref:'):
+            return content
+        refName = content[len('ref:'):].strip()
+    return None
+
+
+def _getFreshnessRecordPath(repoDir):
+    """>>> _getFreshnessRecordPath(repoDir) -> path or None
+    Returns the path of the file in the git directory of the
+    repository that records when it was last checked for updates.
+    """
+    gitDir = _getGitDir(repoDir)
+    return None if gitDir is None else os.path.join(gitDir, 'pytoapk-freshness.json')
+
+
+def _loadFreshnessRecord(repoDir):
+    """>>> _loadFreshnessRecord(repoDir) -> dict
+    Load the record of the last update check of the repository.
+    """
+    path = _getFreshnessRecordPath(repoDir)
+    if path is None or not os.path.isfile(path):
+        return {}
+    try:
+        with open(path) as recordFile:
+            record = json.load(recordFile)
+    except (IOError, OSError, ValueError):
+        return {}
+    return record if isinstance(record, dict) else {}
+
+
+def _saveFreshnessRecord(repoDir, commit, target):
+    """>>> _saveFreshnessRecord(repoDir, commit, target)
+    Record that the repository was checked for updates just
+    now and that 'commit' was the state of the branch, tag or
+    commit 'target' of the origin.
+    """
+    path = _getFreshnessRecordPath(repoDir)
+    if path is None or commit is None:
+        return
+    with open(path, 'w') as recordFile:
+        json.dump({'checked': time(), 'commit': commit, 'target': target}, recordFile)
+
+
+def getRemoteCommit(gitPath, repoDir, refName, logger):
+    """>>> getRemoteCommit(gitPath, repoDir, refName, logger) -> commit or None
+    Ask the origin of the repository in 'repoDir' for the commit
+    of the reference 'refName' (a full reference name or the
+    name of a branch or tag), without fetching any objects.
+    """
+    args = [gitPath, '-C', repoDir, 'ls-remote', 'origin', refName]
+    logger.verbose('Calling ' + subprocess.list2cmdline(args))
+    try:
+        output = subprocess.check_output(args, universal_newlines=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warn('Failed to query the origin of {dir}: {msg}'.format(dir=repoDir, msg=str(e)))
+        return None
+    commit = None
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) != 2:
+            continue
+        name = parts[1]
+        if name.endswith('^{}'):  # The commit of an annotated tag
+            name = name[:-len('^{}')]
+        elif commit is not None:
+            continue
+        if name == refName or name.endswith('/' + refName):
+            commit = parts[0]
+    return commit
+
+
+def _call(args, logger):
+    """>>> _call(args, logger) -> success
+    Call the git command and return True if it succeeded.
+    The output of git is written to the logger.
+    """
+    result = runProcess(args, logger, outputPriority=Logger.PRIORITY_INFO)
+    if result.returnCode is not None and not result.success:
+        logger.error('Git exited with code {code}: {cmd}'.format(
+            code=result.returnCode, cmd=subprocess.list2cmdline(args)))
+    return result.success
+
+
+def _checkout(gitPath, repoDir, target, depth, logger):
+    """>>> _checkout(gitPath, repoDir, target, depth, logger) -> success
+    Fetch the branch, tag or commit 'target' from the origin
+    and reset the repository in 'repoDir' to it. If 'depth' is
+    given, only that many commits of the history are fetched.
+    """
+    args = [gitPath, '-C', repoDir, 'fetch', 'origin', target]
+    if depth is not None:
+        args[-2:-2] = ['--depth', str(depth)]
+    if not _call(args, logger):
+        if not _FULL_COMMIT_REGEX.match(target):
+            return False
+        # The origin might not allow to fetch commits directly
+        if not _call([gitPath, '-C', repoDir, 'fetch', 'origin'], logger):
+            return False
+        resetTarget = target
+    else:
+        resetTarget = 'FETCH_HEAD'
+    return _call([gitPath, '-C', repoDir, 'reset', '--hard', resetTarget], logger) and \
+        _call([gitPath, '-C', repoDir, 'clean', '-d', '-f'], logger)
+
+
+def updateMirror(gitPath, repoUrl, mirrorDir, logger):
+    """>>> updateMirror(gitPath, repoUrl, mirrorDir, logger) -> success
+    Create or update the bare mirror of the repository at 'repoUrl'
+    in 'mirrorDir'. The mirror can be shared by multiple checkouts
+    and processes, it is locked while it is updated.
+    """
+    try:
+        with DirectoryLock(mirrorDir.rstrip('/\\') + '.lock'):
+            if os.path.isfile(os.path.join(mirrorDir, 'HEAD')):
+                return _call([gitPath, '-C', mirrorDir, 'fetch', '--prune', 'origin'], logger)
+            if os.path.exists(mirrorDir):
+                rmtree(mirrorDir)
+            return _call([gitPath, 'clone', '--progress', '--mirror', repoUrl, mirrorDir], logger)
+    except OSError as e:
+        logger.error('Failed to update the mirror in {dir}: {msg}'.format(dir=mirrorDir,
+                                                                          msg=str(e)))
+        return False
+
+
+def update(gitPath, repoDir, logger, maxAge=0, branch='main', ref=None, depth=None,
+           mirrorDir=None, repoUrl=None):
+    """>>> update(gitpath, repoDir, logger, maxAge, branch, ref, depth, mirrorDir, repoUrl)
+    -> success
     Updates the repository in 'repoPath', so it
-    is at the same state as the origin, using the
-    git executable at 'gitPath'.
+    is at the same state as the branch of the origin,
+    or at the tag or commit 'ref' if one is given,
+    using the git executable at 'gitPath'. If the
+    repository was checked less than 'maxAge' seconds
+    ago and is still at the commit seen at that time,
+    no git command is executed at all. Otherwise the
+    objects are only fetched if the origin moved.
+    If the repository was cloned from a mirror, the
+    mirror is updated from 'repoUrl' first.
     """
     if repoDir in _updatedGitRepos:
         return True
     _updatedGitRepos.append(repoDir)
-    args = [gitPath, '-C', repoDir, 'fetch', 'origin']
-    logger.verbose('Calling ' + subprocess.list2cmdline(args))
-    if subprocess.call(args) != 0:
-        return False
-    args = [gitPath, '-C', repoDir, 'reset', '--hard', 'origin/main']
-    logger.verbose('Calling ' + subprocess.list2cmdline(args))
-    if subprocess.call(args) != 0:
+    headCommit = readRef(repoDir, 'HEAD')
+    if ref is not None and _FULL_COMMIT_REGEX.match(ref) and headCommit == ref:
+        return True  # A pinned commit never changes
+    record = _loadFreshnessRecord(repoDir)
+    if headCommit is not None and record.get('commit') == headCommit and \
+            record.get('target') == (ref or branch) and \
+            0 <= time() - record.get('checked', 0) < maxAge:
+        logger.verbose('The repository in {dir} was checked for updates {age:.0f} seconds ago, '
+                       'skipping the update', dir=repoDir, age=time() - record['checked'])
+        return True
+    if mirrorDir is not None and not updateMirror(gitPath, repoUrl, mirrorDir, logger):
         return False
-    args = [gitPath, '-C', repoDir, 'clean', '-d', '-f']
-    logger.verbose('Calling ' + subprocess.list2cmdline(args))
-    if subprocess.call(args) != 0:
+    target = ref or branch
+    remoteCommit = getRemoteCommit(gitPath, repoDir, ref or 'refs/heads/' + branch, logger)
+    if remoteCommit is not None and remoteCommit == headCommit:
+        logger.verbose('The repository in {dir} is up to date', dir=repoDir)
+        _saveFreshnessRecord(repoDir, headCommit, target)
+        return True
+    if not _checkout(gitPath, repoDir, target, depth, logger):
         return False
-    args = [gitPath, '-C', repoDir, 'pull']
-    logger.verbose('Calling ' + subprocess.list2cmdline(args))
-    return subprocess.call(args) == 0
+    _saveFreshnessRecord(repoDir, readRef(repoDir, 'HEAD'), target)
+    return True
 
 
-def initialize(gitPath, repoUrl, repoDir, logger):
-    """>>> initialize(gitPath, repoUrl, repoDir, logger) -> success
-    Initializes and clones the repository from 'repoUrl'
-    to 'repoDir', using the git executable at 'gitPath'.
-    Returns True on success and False on failure.
+def initialize(gitPath, repoUrl, repoDir, logger, branch='main', ref=None, depth=None,
+               mirrorDir=None):
+    """>>> initialize(gitPath, repoUrl, repoDir, logger, branch, ref, depth, mirrorDir) -> success
+    Initializes and clones the branch of the repository
+    from 'repoUrl' to 'repoDir', using the git executable
+    at 'gitPath'. If 'depth' is given, a shallow clone with
+    that many commits is created. If 'mirrorDir' is given,
+    a shared bare mirror of the repository is created or
+    updated there and the clone borrows all objects from it.
+    If 'ref' is given, the repository is reset to that tag
+    or commit. Returns True on success and False on failure.
     """
     if os.path.exists(repoDir):
         if not os.path.isdir(repoDir):
@@ -55,11 +251,20 @@ def initialize(gitPath, repoUrl, repoDir, logger):
                          'The destination is an existing file!'.format(url=repoUrl, dir=repoDir))
             return False
         rmtree(repoDir)
-    args = [gitPath, 'clone', '--progress', repoUrl, repoDir]
-    logger.verbose('Calling ' + subprocess.list2cmdline(args))
-    if subprocess.call(args) == 0:
-        return True
-        args = [gitPath, '--work-tree', repoDir, 'pull']
-        logger.verbose('Calling ' + subprocess.list2cmdline(args))
-        return subprocess.call(args)
-    return False
+    args = [gitPath, 'clone', '--progress', '--single-branch', '--branch', branch]
+    if mirrorDir is not None:
+        if not updateMirror(gitPath, repoUrl, mirrorDir, logger):
+            return False
+        args += ['--shared', mirrorDir, repoDir]
+    else:
+        if depth is not None:
+            if os.path.isdir(repoUrl):  # Git ignores the depth for local paths
+                repoUrl = 'file://' + os.path.abspath(repoUrl).replace(os.path.sep, '/')
+            args += ['--depth', str(depth)]
+        args += [repoUrl, repoDir]
+    if not _call(args, logger):
+        return False
+    if ref is not None and not _checkout(gitPath, repoDir, ref, depth, logger):
+        return False
+    _saveFreshnessRecord(repoDir, readRef(repoDir, 'HEAD'), ref or branch)
+    return True
@@ -0,0 +1,123 @@
+"""
+Matches paths against a list of gitignore style patterns.
+"""
+
+import os
+import re
+
+
+class IgnoreMatcher(object):
+    """
+    Decides if a path should be ignored, based on a list of patterns in
+    the syntax of a .gitignore file. Consecutive patterns with the same
+    sign are compiled into one regular expression, so checking a path
+    only costs a few regular expression matches. As with git, the last
+    matching pattern decides if a path is ignored and a path can't be
+    included again by a negated pattern if one of its parent
+    directories is ignored, because ignored directories are not walked.
+    """
+    # Files and directories that are never needed in the apk.
+    DEFAULT_PATTERNS = [
+        '.git/', '.hg/', '.svn/', '.idea/', '.vscode/', '__pycache__/', '*.py[cod]',
+        '.venv/', 'venv/', '.tox/', '.nox/', '.pytest_cache/', '.mypy_cache/', '*.egg-info/',
+        '.DS_Store', 'Thumbs.db', '.apkignore', '/tests/', '/docs/',
+    ]
+    _groups = None
+
+    def __init__(self, patterns=()):
+        self._groups = []
+        for pattern in patterns:
+            self.addPattern(pattern)
+
+    @classmethod
+    def fromFile(cls, path, patterns=()):
+        """>>> fromFile(path, patterns) -> IgnoreMatcher
+        Create a matcher from the given patterns followed
+        by the patterns in the file at 'path', if it exists.
+        """
+        matcher = cls(patterns)
+        if os.path.isfile(path):
+            with open(path) as ignoreFile:
+                for line in ignoreFile:
+                    matcher.addPattern(line)
+        return matcher
+
+    @staticmethod
+    def _translate(pattern):
+        """>>> _translate(pattern) -> regex string
+        Translate the glob pattern into a regular expression
+        matching a path relative to the root, separated by '/'.
+        """
+        dirOnly = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        anchored = '/' in pattern
+        pattern = pattern.lstrip('/')
+        result = '' if anchored else '(?:.*/)?'
+        index = 0
+        while index < len(pattern):
+            char = pattern[index]
+            if pattern.startswith('**/', index):
+                result += '(?:.*/)?'
+                index += 3
+                continue
+            elif pattern.startswith('**', index):
+                result += '.*'
+                index += 2
+                continue
+            elif char == '*':
+                result += '[^/]*'
+            elif char == '?':
+                result += '[^/]'
+            elif char == '[':
+                end = pattern.find(']', index + 2)
+                if end == -1:
+                    result += re.escape(char)
+                else:
+                    charClass = pattern[index + 1:end]
+                    if charClass.startswith('!'):
+                        charClass = '^' + charClass[1:]
+                    result += '[' + charClass.replace('\\', '\\\\') + ']'
+                    index = end
+            elif char == '\\' and index + 1 < len(pattern):
+                index += 1
+                result += re.escape(pattern[index])
+            else:
+                result += re.escape(char)
+            index += 1
+        return result + ('/' if dirOnly else '/?') + r'\Z'
+
+    def addPattern(self, pattern):
+        """>>> addPattern(pattern)
+        Add a pattern in the syntax of a .gitignore file.
+        Empty patterns and comments are ignored.
+        """
+        pattern = pattern.rstrip('\r\n')
+        if not pattern.endswith('\\ '):
+            pattern = pattern.rstrip()
+        if pattern == '' or pattern.startswith('#'):
+            return
+        negated = pattern.startswith('!')
+        if negated or pattern.startswith('\\!') or pattern.startswith('\\#'):
+            pattern = pattern[1:]
+        regex = self._translate(pattern)
+        if len(self._groups) > 0 and self._groups[-1][0] == negated:
+            self._groups[-1] = (negated, self._groups[-1][1] + [regex], None)
+        else:
+            self._groups.append((negated, [regex], None))
+
+    def isIgnored(self, path, isDir=False):
+        """>>> isIgnored(path, isDir) -> boolean
+        Returns True if the path relative to the root of
+        the patterns matches the patterns. 'isDir' must
+        be True if the path points to a directory.
+        """
+        path = path.replace(os.path.sep, '/') + ('/' if isDir else '')
+        for index in range(len(self._groups) - 1, -1, -1):
+            negated, regexes, compiled = self._groups[index]
+            if compiled is None:
+                compiled = re.compile('|'.join('(?:' + regex + ')' for regex in regexes),
+                                      re.DOTALL)
+                self._groups[index] = (negated, regexes, compiled)
+            if compiled.match(path):
+                return not negated
+        return False
@@ -0,0 +1,606 @@
+"""
+Builds the import graph of the Python modules in one or more source
+directories without executing them. Every file is parsed with the ast
+module, in worker processes if many files changed, and the imports of
+every file are cached by its size and modification time. Imports are
+recorded as top level imports, which run when the module is imported,
+or function level imports, which only run when the function is called.
+"""
+
+from __future__ import absolute_import
+
+import ast
+import json
+import os
+from fnmatch import fnmatchcase
+from multiprocessing import Pool, cpu_count
+
+from .files import mkDirs, replaceFile, walkDir
+from .ignore import IgnoreMatcher
+
+# The minimal number of files to parse before worker processes are started.
+_MIN_PARALLEL_FILES = 64
+# Calls that import the module named by their first argument.
+_DYNAMIC_IMPORT_FUNCTIONS = ['__import__', 'import_module']
+_PARSE_CACHE_VERSION = 2
+
+
+def getModuleName(relPath):
+    """>>> getModuleName(relPath) -> name or None
+    Returns the dotted name of the module at the path relative to the
+    source directory, separated by '/', or None if it is no Python file.
+    """
+    if not relPath.endswith('.py'):
+        return None
+    parts = relPath[:-len('.py')].split('/')
+    if parts[-1] == '__init__':
+        parts.pop()
+    if len(parts) == 0 or not all(part.replace('_', 'a').isalnum() for part in parts):
+        return None
+    return '.'.join(parts)
+
+
+class _ImportCollector(ast.NodeVisitor):
+    """Collects the imports of a module as lists of
+    [name, level, fromNames, line, topLevel, conditional, dynamic]."""
+    imports = None
+    _functionDepth = 0
+    _conditionalDepth = 0
+
+    def __init__(self):
+        self.imports = []
+
+    def _add(self, node, name, level=0, fromNames=(), dynamic=False):
+        self.imports.append([name, level, list(fromNames), node.lineno,
+                             self._functionDepth == 0, self._conditionalDepth > 0, dynamic])
+
+    def _visitFunction(self, node):
+        self._functionDepth += 1
+        self.generic_visit(node)
+        self._functionDepth -= 1
+
+    visit_FunctionDef = visit_AsyncFunctionDef = visit_Lambda = _visitFunction
+
+    def _visitConditional(self, node):
+        self._conditionalDepth += 1
+        self.generic_visit(node)
+        self._conditionalDepth -= 1
+
+    visit_If = visit_Try = visit_TryStar = visit_TryExcept = visit_TryFinally = _visitConditional
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            self._add(node, alias.name)
+
+    def visit_ImportFrom(self, node):
+        self._add(node, node.module or '', node.level or 0,
+                  [alias.name for alias in node.names])
+
+    def visit_Call(self, node):
+        function = node.func
+        functionName = function.id if isinstance(function, ast.Name) else \
+            function.attr if isinstance(function, ast.Attribute) else None
+        if functionName in _DYNAMIC_IMPORT_FUNCTIONS and len(node.args) > 0:
+            argument = node.args[0]
+            value = getattr(argument, 'value', getattr(argument, 's', None))
+            if isinstance(value, str) and value and not value.startswith('.'):
+                self._add(node, value, dynamic=True)
+        self.generic_visit(node)
+
+
+def parseImports(path):
+    """>>> parseImports(path) -> (path, imports, error)
+    Parse the Python file at 'path' and return its imports, as
+    collected by _ImportCollector, or the reason why it failed.
+    """
+    try:
+        with open(path, 'rb') as sourceFile:
+            tree = ast.parse(sourceFile.read(), path)
+    except (SyntaxError, ValueError) as e:
+        return path, [], 'line {line}: {error}'.format(
+            line=getattr(e, 'lineno', None) or '?', error=getattr(e, 'msg', None) or str(e))
+    except (IOError, OSError) as e:
+        return path, [], str(e)
+    collector = _ImportCollector()
+    collector.visit(tree)
+    return path, collector.imports, None
+
+
+class Import(object):
+    """An import statement of a module."""
+    name = None
+    line = None
+    topLevel = True
+    conditional = False
+    dynamic = False
+    fromNames = None
+
+    def __init__(self, name, line, topLevel, conditional, dynamic, fromNames):
+        self.name = name
+        self.line = line
+        self.topLevel = topLevel
+        self.conditional = conditional
+        self.dynamic = dynamic
+        self.fromNames = fromNames
+
+
+class Module(object):
+    """A Python module in one of the source directories."""
+    name = None
+    path = None
+    relPath = None
+    size = 0
+    imports = None
+    error = None
+
+    def __init__(self, name, path, relPath, size):
+        self.name = name
+        self.path = path
+        self.relPath = relPath
+        self.size = size
+        self.imports = []
+
+    @property
+    def isPackage(self):
+        return os.path.basename(self.relPath) == '__init__.py'
+
+    def resolveName(self, name, level):
+        """>>> resolveName(name, level) -> absolute name or None
+        Resolve the name of a relative import in this module.
+        """
+        if level == 0:
+            return name
+        parts = self.name.split('.')
+        if not self.isPackage:
+            parts.pop()
+        if level - 1 > len(parts):
+            return None
+        parts = parts[:len(parts) - (level - 1)]
+        return '.'.join(parts + ([name] if name else [])) or None
+
+
+class ImportGraph(object):
+    """
+    The modules of the source directories and the imports between them.
+    Imports of modules that are not in the source directories, like the
+    standard library, are recorded as external imports by their top level name.
+    """
+    modules = None
+    parsedFiles = 0
+    cachedFiles = 0
+    _edges = None
+    _externals = None
+    _sizeCache = None
+
+    def __init__(self):
+        self.modules = {}
+        self._sizeCache = {}
+
+    @classmethod
+    def scan(cls, sources, cachePath=None, jobs=None):
+        """>>> scan(sources, cachePath, jobs) -> ImportGraph
+        Parse every Python file in the source directories, given as a list
+        of (directory, ignore) pairs. Earlier directories take precedence
+        over later ones. 'ignore' may be None or is called with the relative
+        path and whether it is a directory for every entry and may exclude
+        it. The imports of files that did not change since the last scan
+        are read from the cache at 'cachePath'.
+        """
+        graph = cls()
+        for sourceDir, ignore in sources:
+            for dirPath, dirNames, fileNames in walkDir(sourceDir):
+                relDir = os.path.relpath(dirPath, sourceDir).replace(os.sep, '/')
+                relDir = '' if relDir == '.' else relDir + '/'
+                if ignore is not None:
+                    dirNames[:] = [name for name in dirNames
+                                   if not ignore(relDir + name, True)]
+                for fileName in fileNames:
+                    relPath = relDir + fileName
+                    name = getModuleName(relPath)
+                    if name is None or name in graph.modules or \
+                            (ignore is not None and ignore(relPath, False)):
+                        continue
+                    path = os.path.join(dirPath, fileName)
+                    graph.modules[name] = Module(name, path, relPath, os.path.getsize(path))
+        graph._parse(cachePath, jobs)
+        return graph
+
+    def _parse(self, cachePath, jobs):
+        cache = {}
+        if cachePath is not None:
+            try:
+                with open(cachePath) as cacheFile:
+                    cache = json.load(cacheFile)
+                if cache.get('version') != _PARSE_CACHE_VERSION:
+                    cache = {}
+            except (IOError, OSError, ValueError):
+                cache = {}
+        entries = cache.get('files', {})
+        newEntries = {}
+        pending = []
+        for module in self.modules.values():
+            stat = os.stat(module.path)
+            entry = entries.get(module.path)
+            if entry is not None and entry['size'] == stat.st_size and \
+                    entry['mtime'] == stat.st_mtime:
+                newEntries[module.path] = entry
+            else:
+                newEntries[module.path] = {'size': stat.st_size, 'mtime': stat.st_mtime}
+                pending.append(module.path)
+        jobs = min(jobs or cpu_count(), len(pending) // _MIN_PARALLEL_FILES)
+        if jobs > 1:
+            pool = Pool(jobs)
+            try:
+                results = pool.map(parseImports, pending, chunksize=16)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [parseImports(path) for path in pending]
+        for path, imports, error in results:
+            newEntries[path].update({'imports': imports, 'error': error})
+        self.parsedFiles = len(pending)
+        self.cachedFiles = len(self.modules) - len(pending)
+        for module in self.modules.values():
+            entry = newEntries[module.path]
+            module.error = entry['error']
+            for name, level, fromNames, line, topLevel, conditional, dynamic in entry['imports']:
+                name = module.resolveName(name, level)
+                if name is not None:
+                    module.imports.append(
+                        Import(name, line, topLevel, conditional, dynamic, fromNames))
+        if cachePath is not None and len(pending) > 0 and mkDirs(os.path.dirname(cachePath)):
+            with open(cachePath + '.tmp', 'w') as cacheFile:
+                json.dump({'version': _PARSE_CACHE_VERSION, 'files': newEntries}, cacheFile)
+            replaceFile(cachePath + '.tmp', cachePath)
+
+    def resolveImport(self, anImport):
+        """>>> resolveImport(anImport) -> (set of module names, external name or None)
+        Returns the modules in the graph that are executed by the import:
+        The imported module, its parent packages and the imported submodules.
+        A star import may import any submodule of a package.
+        """
+        parts = anImport.name.split('.')
+        names = set('.'.join(parts[:index]) for index in range(1, len(parts) + 1))
+        names.update(anImport.name + '.' + fromName for fromName in anImport.fromNames)
+        if '*' in anImport.fromNames:
+            prefix = anImport.name + '.'
+            names.update(name for name in self.modules
+                         if name.startswith(prefix) and '.' not in name[len(prefix):])
+        internal = set(name for name in names if name in self.modules)
+        external = parts[0] if parts[0] not in self.modules else None
+        return internal, external
+
+    def _buildEdges(self):
+        if self._edges is not None:
+            return
+        self._edges = {}
+        self._externals = {}
+        for module in self.modules.values():
+            edges = {}
+            externals = {}
+            for anImport in module.imports:
+                internal, external = self.resolveImport(anImport)
+                for name in internal - {module.name}:
+                    if name not in edges or anImport.topLevel and not edges[name].topLevel:
+                        edges[name] = anImport
+                if external is not None and \
+                        (external not in externals or anImport.topLevel):
+                    externals[external] = anImport
+            self._edges[module.name] = edges
+            self._externals[module.name] = externals
+
+    def getImports(self, name, topLevelOnly=False):
+        """>>> getImports(name, topLevelOnly) -> dict of module name to Import
+        Returns the modules of the graph that the module imports directly,
+        with the import statement that imports it. If a module is imported
+        multiple times, a top level import is preferred.
+        """
+        self._buildEdges()
+        return dict((target, anImport) for target, anImport in self._edges[name].items()
+                    if anImport.topLevel or not topLevelOnly)
+
+    def getExternalImports(self, name, topLevelOnly=False):
+        """>>> getExternalImports(name, topLevelOnly) -> dict of top level name to Import
+        Returns the modules outside of the graph that the module imports directly.
+        """
+        self._buildEdges()
+        return dict((target, anImport) for target, anImport in self._externals[name].items()
+                    if anImport.topLevel or not topLevelOnly)
+
+    def getReachable(self, roots, topLevelOnly=False, skipImports=None):
+        """>>> getReachable(roots, topLevelOnly, skipImports) -> dict of module name to parent name
+        Returns all modules that are imported by the root modules, directly
+        or through other modules, mapped to the module that imports them on
+        the shortest import chain. The roots are mapped to None. Importing a
+        module also loads its parent packages. If 'skipImports' is given as
+        (importer, module names), the imports of the modules by the importer
+        are ignored.
+        """
+        parents = {}
+        queue = []
+
+        def load(name, parent):
+            parts = name.split('.')
+            for index in range(1, len(parts) + 1):
+                module = '.'.join(parts[:index])
+                if module in self.modules and module not in parents:
+                    parents[module] = parent
+                    queue.append(module)
+
+        for root in sorted(roots):
+            load(root, None)
+        while queue:
+            currentQueue = sorted(queue)
+            del queue[:]
+            for name in currentQueue:
+                for target in sorted(self.getImports(name, topLevelOnly)):
+                    if skipImports is not None and name == skipImports[0] and \
+                            target in skipImports[1]:
+                        continue
+                    load(target, name)
+        return parents
+
+    def getImportChain(self, name, parents):
+        """>>> getImportChain(name, parents) -> list of module names
+        Returns the import chain from the root to the module,
+        using the result of getReachable.
+        """
+        chain = [name]
+        while parents.get(chain[-1]) is not None:
+            chain.append(parents[chain[-1]])
+        return chain[::-1]
+
+    def getTransitiveSize(self, name):
+        """>>> getTransitiveSize(name) -> (number of modules, size in bytes)
+        Returns the number and the source size of the modules
+        that are loaded at top level when the module is imported.
+        """
+        if name not in self._sizeCache:
+            reachable = self.getReachable([name], topLevelOnly=True)
+            self._sizeCache[name] = (len(reachable),
+                                     sum(self.modules[module].size for module in reachable))
+        return self._sizeCache[name]
+
+
+class ImportReport(object):
+    """The startup cost of the modules imported by an entry point."""
+    graph = None
+    entryPoint = None
+    heavyShare = 0.1
+    startupModules = None
+    reachableModules = None
+
+    def __init__(self, graph, entryPoint, heavyShare=0.1):
+        self.graph = graph
+        self.entryPoint = entryPoint
+        self.heavyShare = heavyShare
+        self.startupModules = graph.getReachable([entryPoint], topLevelOnly=True)
+        self.reachableModules = graph.getReachable([entryPoint])
+
+    def getStartupSize(self):
+        """>>> getStartupSize() -> size in bytes
+        Returns the size of all modules imported when the entry point starts.
+        """
+        return sum(self.graph.modules[name].size for name in self.startupModules)
+
+    def getRanking(self, limit=None):
+        """>>> getRanking(limit) -> list of (name, modules, size, fan-out)
+        Returns the modules loaded at startup, ordered by the size of all
+        modules that they load (including themselves) and their fan-out,
+        the number of modules and external packages they import directly.
+        """
+        ranking = []
+        for name in self.startupModules:
+            numModules, size = self.graph.getTransitiveSize(name)
+            fanOut = len(self.graph.getImports(name)) + len(self.graph.getExternalImports(name))
+            ranking.append((name, numModules, size, fanOut))
+        ranking.sort(key=lambda item: (-item[2], -item[3], item[0]))
+        return ranking[:limit] if limit is not None else ranking
+
+    def getHeavyImports(self):
+        """>>> getHeavyImports() -> list of (importer, Import, target, deferred size)
+        Returns the top level import statements of the modules loaded at
+        startup which are the only reason that more than 'heavyShare' of the
+        startup size is loaded at startup. They are candidates to be moved
+        into the functions that use the imported module, which would defer
+        loading that size. Modules that the importer also imports with
+        another top level statement are not deferred, and neither are
+        the parent packages of modules that are still imported.
+        """
+        startupSize = self.getStartupSize()
+        threshold = startupSize * self.heavyShare
+        heavyImports = []
+        for name in self.startupModules:
+            statements = [(anImport, self.graph.resolveImport(anImport)[0] - {name})
+                          for anImport in self.graph.modules[name].imports if anImport.topLevel]
+            for anImport, targets in statements:
+                for otherImport, otherTargets in statements:
+                    if otherImport is not anImport:
+                        targets = targets - otherTargets
+                if len(targets) == 0 or sum(self.graph.getTransitiveSize(target)[1]
+                                            for target in targets) <= threshold:
+                    continue
+                remaining = self.graph.getReachable([self.entryPoint], topLevelOnly=True,
+                                                    skipImports=(name, targets))
+                deferredSize = startupSize - sum(self.graph.modules[module].size
+                                                 for module in remaining)
+                if deferredSize > threshold:
+                    heavyImports.append((name, anImport, anImport.name, deferredSize))
+        heavyImports.sort(key=lambda item: (-item[3], item[0], item[1].line))
+        return heavyImports
+
+    def format(self, limit=20):
+        """>>> format(limit) -> text
+        Format the report as a text with the ranking of the 'limit' most
+        expensive modules, their import chains and the heavy top level imports.
+        """
+        graph = self.graph
+        lines = ['{num} of {total} modules ({size} bytes) are imported when {entry} starts, '
+                 '{reachable} can be imported in total.'.format(
+                     num=len(self.startupModules), total=len(graph.modules),
+                     size=self.getStartupSize(), entry=self.entryPoint,
+                     reachable=len(self.reachableModules))]
+        ranking = self.getRanking(limit)
+        nameWidth = max([len('Module')] + [len(item[0]) for item in ranking])
+        lines += ['', '{name:<{width}}  {modules:>7}  {size:>10}  {fanOut:>7}'.format(
+            name='Module', width=nameWidth, modules='Modules', size='Bytes', fanOut='Fan-out')]
+        for name, numModules, size, fanOut in ranking:
+            lines.append('{name:<{width}}  {modules:>7}  {size:>10}  {fanOut:>7}'.format(
+                name=name, width=nameWidth, modules=numModules, size=size, fanOut=fanOut))
+        lines += ['', 'Import chains at startup:']
+        for name, _, _, _ in ranking:
+            lines.append('  ' + ' -> '.join(graph.getImportChain(name, self.startupModules)))
+        heavyImports = self.getHeavyImports()
+        lines += ['', 'Heavy top level imports (candidates for lazy loading):' if heavyImports
+                  else 'No top level import loads more than {share:.0%} of the startup size.'
+                  .format(share=self.heavyShare)]
+        for name, anImport, target, size in heavyImports[:limit]:
+            if anImport.fromNames:
+                target = '{names} from {target}'.format(names=', '.join(anImport.fromNames),
+                                                        target=target)
+            lines.append('  {path}:{line} imports {target} (defers {size} bytes{usage})'.format(
+                path=graph.modules[name].relPath, line=anImport.line, target=target, size=size,
+                usage=', conditional' if anImport.conditional else ''))
+        if len(heavyImports) > limit:
+            lines.append('  ... and {num} more'.format(num=len(heavyImports) - limit))
+        externals = set()
+        for name in self.startupModules:
+            externals.update(graph.getExternalImports(name, topLevelOnly=True))
+        lines += ['', 'External modules imported at startup: ' + (', '.join(sorted(externals))
+                                                                 or 'none')]
+        errors = sorted((module.relPath, module.error) for module in graph.modules.values()
+                        if module.error is not None)
+        for relPath, error in errors:
+            lines.append('Failed to parse {path} ({error}), its imports are unknown.'
+                         .format(path=relPath, error=error))
+        return '\n'.join(lines)
+
+    def toJson(self):
+        """>>> toJson() -> dict
+        Returns the report as a JSON serializable dict.
+        """
+        graph = self.graph
+        return {
+            'entryPoint': self.entryPoint,
+            'startupSize': self.getStartupSize(),
+            'modules': dict((name, {
+                'path': module.relPath,
+                'size': module.size,
+                'startup': name in self.startupModules,
+                'reachable': name in self.reachableModules,
+                'importChain': graph.getImportChain(name, self.startupModules)
+                if name in self.startupModules else None,
+                'transitiveSize': graph.getTransitiveSize(name)[1],
+                'imports': sorted([target, anImport.line, anImport.topLevel]
+                                  for target, anImport in graph.getImports(name).items()),
+                'externalImports': sorted(graph.getExternalImports(name)),
+                'error': module.error,
+            }) for name, module in graph.modules.items()),
+            'heavyImports': [{'module': name, 'line': anImport.line, 'target': target,
+                              'deferredSize': size}
+                             for name, anImport, target, size in self.getHeavyImports()],
+        }
+
+
+class TreeShaker(object):
+    """
+    Selects the files of a source directory that are needed by an entry
+    point: The modules that it can import directly or through other
+    modules, the modules in 'keepModules' (fnmatch patterns of module
+    names for dynamic imports) and the modules they can import, the
+    files matching the .gitignore style patterns in 'keepFiles' and all
+    other files, except for the ones in a Python package of which no
+    module is kept. Files of the source directory that are ignored by
+    'ignore' are not considered.
+    """
+    graph = None
+    sourceDir = None
+    ignore = None
+    keptModules = None
+    unmatchedPatterns = None
+    totalFiles = 0
+    totalBytes = 0
+    keptFiles = 0
+    keptBytes = 0
+    removedModules = None
+    removedDataFiles = None
+    _keptPaths = None
+    _keptDirs = None
+
+    def __init__(self, graph, sourceDir, ignore, entryPoint, keepModules=(), keepFiles=()):
+        self.graph = graph
+        self.sourceDir = sourceDir
+        self.ignore = ignore
+        roots = [entryPoint]
+        self.unmatchedPatterns = []
+        for pattern in keepModules:
+            matches = [name for name in graph.modules if fnmatchcase(name, pattern)]
+            if len(matches) == 0:
+                self.unmatchedPatterns.append(pattern)
+            roots += matches
+        self.keptModules = graph.getReachable(roots)
+        self._select(IgnoreMatcher(keepFiles))
+
+    def _select(self, keepMatcher):
+        modulePaths = dict((module.relPath, name) for name, module in self.graph.modules.items())
+        keptModuleDirs = set()
+        for name in self.keptModules:
+            parts = self.graph.modules[name].relPath.split('/')[:-1]
+            keptModuleDirs.update('/'.join(parts[:index]) for index in range(len(parts) + 1))
+
+        def isKeptDataFile(relPath):
+            parts = relPath.split('/')
+            if any(keepMatcher.isIgnored('/'.join(parts[:index]), True)
+                   for index in range(1, len(parts))) or keepMatcher.isIgnored(relPath):
+                return True
+            for index in range(len(parts) - 1, 0, -1):
+                packageDir = '/'.join(parts[:index])
+                if packageDir + '/__init__.py' in modulePaths:
+                    return packageDir in keptModuleDirs
+            return True
+
+        self._keptPaths = set()
+        self.removedModules = []
+        self.removedDataFiles = []
+        for dirPath, dirNames, fileNames in walkDir(self.sourceDir):
+            relDir = os.path.relpath(dirPath, self.sourceDir).replace(os.sep, '/')
+            relDir = '' if relDir == '.' else relDir + '/'
+            if self.ignore is not None:
+                dirNames[:] = [name for name in dirNames if not self.ignore(relDir + name, True)]
+            for fileName in fileNames:
+                relPath = relDir + fileName
+                if self.ignore is not None and self.ignore(relPath, False):
+                    continue
+                size = os.path.getsize(os.path.join(dirPath, fileName))
+                self.totalFiles += 1
+                self.totalBytes += size
+                name = modulePaths.get(relPath)
+                if name is not None and name not in self.keptModules and \
+                        not keepMatcher.isIgnored(relPath):
+                    self.removedModules.append(name)
+                elif name is None and not isKeptDataFile(relPath):
+                    self.removedDataFiles.append(relPath)
+                else:
+                    self._keptPaths.add(relPath)
+                    self.keptFiles += 1
+                    self.keptBytes += size
+        self._keptDirs = set()
+        for relPath in self._keptPaths:
+            parts = relPath.split('/')[:-1]
+            self._keptDirs.update('/'.join(parts[:index]) for index in range(1, len(parts) + 1))
+
+    def isRemoved(self, relPath, isDir=False):
+        """>>> isRemoved(relPath, isDir) -> boolean
+        Returns True if the file or directory at the path relative
+        to the source directory is not needed by the entry point.
+        """
+        return relPath not in (self._keptDirs if isDir else self._keptPaths)
+
+    def getUnparsedModules(self):
+        """>>> getUnparsedModules() -> list of relative paths
+        Returns the kept modules that could not be parsed,
+        whose imports may be missing from the kept modules.
+        """
+        return sorted(self.graph.modules[name].relPath for name in self.keptModules
+                      if self.graph.modules[name].error is not None)
@@ -0,0 +1,383 @@
+"""
+Compiles the C and C++ extensions of a Python module. The translation
+units of all extensions and ABIs are compiled in parallel and the
+object files are stored in a cache under a hash of the source, the
+compiler arguments and the identity of the toolchain, together with the
+hashes of the headers the source included, so unchanged sources are
+never compiled again. Toolchains are pluggable, the Android NDK is used
+for the app and the host compiler can be used to test the build.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import sysconfig
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from .files import fileDigest, mkDirs, replaceFile
+from .process import runProcess
+
+CPP_EXTENSIONS = ['.cpp', '.cc', '.cxx', '.c++']
+
+
+class Toolchain(object):
+    """
+    The compiler and linker for one ABI. Subclasses
+    provide the commands and the flags of their compilers.
+    """
+    name = None
+    abi = None
+    _identity = None
+
+    def getCompiler(self, language):
+        """>>> getCompiler(language) -> path
+        Returns the compiler for 'c' or 'c++'.
+        """
+        raise NotImplementedError()
+
+    def getCompileFlags(self):
+        return ['-fPIC', '-O2']
+
+    def getLinkFlags(self):
+        return ['-shared']
+
+    def getPythonIncludeDirs(self):
+        """>>> getPythonIncludeDirs() -> list of paths
+        Returns the default include directories of the Python headers.
+        """
+        return []
+
+    def isAvailable(self):
+        """>>> isAvailable() -> boolean
+        Returns True if the compilers of the toolchain exist.
+        """
+        for compiler in [self.getCompiler('c'), self.getCompiler('c++')]:
+            searchDirs = [''] if os.path.dirname(compiler) \
+                else os.environ.get('PATH', '').split(os.pathsep)
+            if not any(os.path.isfile(os.path.join(searchDir, compiler))
+                       for searchDir in searchDirs):
+                return False
+        return True
+
+    def getIdentity(self):
+        """>>> getIdentity() -> text
+        Returns a text that changes with the compilers of the toolchain,
+        made from their paths and the output of their --version option.
+        """
+        if self._identity is None:
+            parts = [self.name, self.abi]
+            for language in ['c', 'c++']:
+                compiler = self.getCompiler(language)
+                try:
+                    version = subprocess.check_output([compiler, '--version'],
+                                                      stderr=subprocess.STDOUT)
+                    version = version.decode('utf-8', 'replace')
+                except (OSError, subprocess.CalledProcessError):
+                    version = None
+                parts += [compiler, version]
+            self._identity = json.dumps(parts)
+        return self._identity
+
+    def getCompileArgs(self, language, sourcePath, objectPath, depsPath, flags):
+        """>>> getCompileArgs(language, sourcePath, objectPath, depsPath, flags) -> args
+        Returns the arguments to compile the source into the object file
+        and to write the included headers to the dependency file.
+        """
+        return [self.getCompiler(language)] + self.getCompileFlags() + flags + \
+            ['-MD', '-MF', depsPath, '-c', sourcePath, '-o', objectPath]
+
+    def getLinkArgs(self, language, objectPaths, libraryPath, flags):
+        """>>> getLinkArgs(language, objectPaths, libraryPath, flags) -> args
+        Returns the arguments to link the objects into a shared library.
+        """
+        return [self.getCompiler(language)] + self.getLinkFlags() + objectPaths + flags + \
+            ['-o', libraryPath]
+
+
+class HostToolchain(Toolchain):
+    """
+    The C compiler of the host system, from the CC and CXX environment
+    variables or 'cc' and 'c++'. The build does not run on Android, but
+    exercises the whole pipeline without the NDK.
+    """
+    name = 'host'
+    abi = 'host'
+    cc = None
+    cxx = None
+
+    def __init__(self, abi='host', ndkPath=None, apiLevel=None):
+        self.cc = os.environ.get('CC', 'cc')
+        self.cxx = os.environ.get('CXX', 'c++')
+
+    def getCompiler(self, language):
+        return self.cxx if language == 'c++' else self.cc
+
+    def getLinkFlags(self):
+        flags = ['-shared']
+        if sys.platform == 'darwin':
+            flags += ['-undefined', 'dynamic_lookup']
+        return flags
+
+    def getPythonIncludeDirs(self):
+        return [sysconfig.get_paths()['include']]
+
+
+class NdkToolchain(Toolchain):
+    """The clang compilers of the Android NDK (r19 and newer) for one ABI."""
+    name = 'ndk'
+    TARGETS = {
+        'armeabi-v7a': 'armv7a-linux-androideabi',
+        'arm64-v8a': 'aarch64-linux-android',
+        'x86': 'i686-linux-android',
+        'x86_64': 'x86_64-linux-android',
+    }
+    ndkPath = None
+    apiLevel = 21
+
+    def __init__(self, abi, ndkPath, apiLevel=21):
+        if abi not in self.TARGETS:
+            raise ValueError('Unsupported ABI: ' + abi)
+        self.abi = abi
+        self.ndkPath = ndkPath
+        self.apiLevel = apiLevel
+
+    def getBinDir(self):
+        """>>> getBinDir() -> path
+        Returns the directory of the prebuilt LLVM toolchain for this host.
+        """
+        hostTag = {'win32': 'windows-x86_64', 'darwin': 'darwin-x86_64'}.get(
+            sys.platform, 'linux-x86_64')
+        return os.path.join(self.ndkPath, 'toolchains', 'llvm', 'prebuilt', hostTag, 'bin')
+
+    def getCompiler(self, language):
+        executable = 'clang++' if language == 'c++' else 'clang'
+        if sys.platform == 'win32':
+            executable += '.exe'
+        return os.path.join(self.getBinDir(), executable)
+
+    def getCompileFlags(self):
+        return ['--target={target}{api}'.format(target=self.TARGETS[self.abi],
+                                                api=self.apiLevel),
+                '-fPIC', '-O2', '-DANDROID']
+
+    def getLinkFlags(self):
+        return ['--target={target}{api}'.format(target=self.TARGETS[self.abi],
+                                                api=self.apiLevel),
+                '-shared', '-static-libstdc++']
+
+
+# The available toolchains by name, new toolchains can be registered here.
+TOOLCHAINS = {
+    'ndk': NdkToolchain,
+    'host': HostToolchain,
+}
+
+
+def createToolchain(name, abi, ndkPath, apiLevel):
+    """>>> createToolchain(name, abi, ndkPath, apiLevel) -> Toolchain
+    Create the toolchain called 'name' for the ABI.
+    """
+    return TOOLCHAINS[name](abi, ndkPath, apiLevel)
+
+
+def parseDependencyFile(path):
+    """>>> parseDependencyFile(path) -> list of paths
+    Returns the prerequisites listed in a make
+    dependency file, as written by the -MD option.
+    """
+    with open(path) as depsFile:
+        content = depsFile.read().replace('\\\r\n', ' ').replace('\\\n', ' ')
+    rule = content.split('\n\n')[0]
+    if ': ' in rule:
+        rule = rule.split(': ', 1)[1]
+    paths = []
+    current = ''
+    index = 0
+    while index < len(rule):
+        char = rule[index]
+        if char == '\\' and index + 1 < len(rule) and rule[index + 1] in ' #':
+            current += rule[index + 1]
+            index += 1
+        elif char.isspace():
+            if current:
+                paths.append(current)
+            current = ''
+        else:
+            current += char
+        index += 1
+    if current:
+        paths.append(current)
+    return paths
+
+
+class CompileUnit(object):
+    """A source file to compile for one extension and one ABI."""
+    toolchain = None
+    language = None
+    sourcePath = None
+    flags = None
+    objectPath = None
+    cached = False
+
+    def __init__(self, toolchain, language, sourcePath, flags):
+        self.toolchain = toolchain
+        self.language = language
+        self.sourcePath = sourcePath
+        self.flags = flags
+
+
+class ObjectCache(object):
+    """
+    Stores object files under a hash of the source, the compiler arguments
+    and the toolchain. Every entry also records the hashes of the headers
+    that the source included, and is only used if none of them changed.
+    """
+    cacheDir = None
+    _headerHashes = None
+    _lock = None
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self._headerHashes = {}
+        self._lock = threading.Lock()
+
+    def hashFile(self, path):
+        """>>> hashFile(path) -> hex digest or None
+        Returns the sha256 hash of the header file, which is
+        only read once per build. Returns None if it is missing.
+        """
+        with self._lock:
+            if path in self._headerHashes:
+                return self._headerHashes[path]
+        fileHash = fileDigest(path, algorithm='sha256') if os.path.isfile(path) else None
+        with self._lock:
+            self._headerHashes[path] = fileHash
+        return fileHash
+
+    def getKey(self, unit):
+        """>>> getKey(unit) -> hex digest
+        Returns the key of the compile unit in the cache.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps([unit.toolchain.getIdentity(), unit.language,
+                                  unit.toolchain.getCompileFlags(), unit.flags,
+                                  os.path.abspath(unit.sourcePath)]).encode('utf-8'))
+        digest.update(fileDigest(unit.sourcePath, algorithm='sha256').encode('utf-8'))
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        """>>> lookup(key) -> path or None
+        Returns the path of the cached object file, if all headers are unchanged.
+        """
+        entryDir = os.path.join(self.cacheDir, key[:2], key)
+        try:
+            with open(os.path.join(entryDir, 'headers.json')) as headersFile:
+                headers = json.load(headersFile)
+        except (IOError, OSError, ValueError):
+            return None
+        objectPath = os.path.join(entryDir, 'object.o')
+        if not os.path.isfile(objectPath):
+            return None
+        for path, fileHash in headers.items():
+            if self.hashFile(path) != fileHash:
+                return None
+        return objectPath
+
+    def store(self, key, objectPath, headerPaths):
+        """>>> store(key, objectPath, headerPaths) -> path
+        Move the compiled object file into the cache and record the
+        hashes of its headers. Returns the path of the cached object.
+        """
+        entryDir = os.path.join(self.cacheDir, key[:2], key)
+        if not mkDirs(entryDir):
+            raise OSError('Failed to create the directory ' + entryDir)
+        headers = dict((os.path.abspath(path), self.hashFile(os.path.abspath(path)))
+                       for path in headerPaths)
+        cachedPath = os.path.join(entryDir, 'object.o')
+        tempPath = '{path}.tmp-{thread}'.format(path=cachedPath,
+                                                thread=threading.current_thread().ident)
+        shutil.copyfile(objectPath, tempPath)
+        replaceFile(tempPath, cachedPath)
+        with open(os.path.join(entryDir, 'headers.json.tmp'), 'w') as headersFile:
+            json.dump(headers, headersFile, indent=2, sort_keys=True)
+        replaceFile(os.path.join(entryDir, 'headers.json.tmp'),
+                    os.path.join(entryDir, 'headers.json'))
+        return cachedPath
+
+
+class CompileScheduler(object):
+    """
+    Compiles compile units on all cores, using the object cache.
+    Object files that are not cached are written to 'objectDir'.
+    """
+    objectDir = None
+    cache = None
+    logger = None
+    jobs = None
+    compiledUnits = 0
+    cachedUnits = 0
+
+    def __init__(self, objectDir, cache, logger, jobs=None):
+        self.objectDir = objectDir
+        self.cache = cache
+        self.logger = logger
+        self.jobs = jobs or cpu_count()
+
+    def _compile(self, unit):
+        """>>> _compile(unit) -> success
+        Compile the unit or take its object file from the cache.
+        """
+        key = None
+        if self.cache is not None:
+            key = self.cache.getKey(unit)
+            unit.objectPath = self.cache.lookup(key)
+            if unit.objectPath is not None:
+                unit.cached = True
+                return True
+        digest = hashlib.sha256(json.dumps([unit.toolchain.abi, unit.sourcePath, unit.flags])
+                                .encode('utf-8')).hexdigest()[:16]
+        objectPath = os.path.join(self.objectDir, unit.toolchain.abi, '{name}-{hash}.o'.format(
+            name=os.path.splitext(os.path.basename(unit.sourcePath))[0], hash=digest))
+        depsPath = objectPath[:-len('.o')] + '.d'
+        if not mkDirs(os.path.dirname(objectPath)):
+            self.logger.error('Failed to create the directory ' + os.path.dirname(objectPath))
+            return False
+        self.logger.info('Compiling {path} for {abi}', path=unit.sourcePath, abi=unit.toolchain.abi)
+        result = runProcess(unit.toolchain.getCompileArgs(
+            unit.language, unit.sourcePath, objectPath, depsPath, unit.flags), self.logger)
+        if not result.success:
+            self.logger.error('Failed to compile {path} for {abi}:\n{output}'.format(
+                path=unit.sourcePath, abi=unit.toolchain.abi, output=result.getTail()))
+            return False
+        unit.objectPath = objectPath
+        if key is not None:
+            try:
+                headers = [path for path in parseDependencyFile(depsPath)
+                           if os.path.abspath(path) != os.path.abspath(unit.sourcePath)]
+                unit.objectPath = self.cache.store(key, objectPath, headers)
+            except (IOError, OSError) as e:
+                self.logger.warn('Failed to store {path} in the object cache: {msg}'
+                                 .format(path=objectPath, msg=str(e)))
+        return True
+
+    def compile(self, units):
+        """>>> compile(units) -> success
+        Compile all units in parallel. Sets the object path of every unit.
+        """
+        if self.jobs > 1 and len(units) > 1:
+            pool = ThreadPool(min(self.jobs, len(units)))
+            try:
+                results = pool.map(self._compile, units)
+            finally:
+                pool.close()
+        else:
+            results = [self._compile(unit) for unit in units]
+        self.cachedUnits += sum(1 for unit in units if unit.cached)
+        self.compiledUnits += sum(1 for unit, success in zip(units, results)
+                                  if success and not unit.cached)
+        return all(results)
@@ -0,0 +1,169 @@
+"""
+Runs external programs and streams their output line by line into
+the logger, instead of letting it go straight to the terminal. Only
+the last lines of the output are kept, to summarize errors, and
+parsers can extract information from the output while it is read.
+"""
+
+import os
+import re
+import subprocess
+from collections import deque
+from time import time
+
+from ..logger import Logger
+
+
+class ProcessResult(object):
+    """The result of a finished process."""
+    args = None
+    returnCode = None
+    duration = 0
+    tail = None
+
+    def __init__(self, args, returnCode, duration, tail):
+        self.args = args
+        self.returnCode = returnCode
+        self.duration = duration
+        self.tail = tail
+
+    @property
+    def success(self):
+        return self.returnCode == 0
+
+    def getTail(self):
+        """>>> getTail() -> text
+        Returns the last lines of the output of the process.
+        """
+        return '\n'.join(self.tail)
+
+
+class GradleTaskParser(object):
+    """
+    Parses the task headers ('> Task :app:name OUTCOME') that Gradle
+    prints with the plain console into the outcome and the duration of
+    every task. A task is considered to run until the header of the next
+    task is printed or the build finishes, so the durations are only
+    exact if the tasks are not executed in parallel. Also detects whether
+    the configuration cache entry was reused, stored or discarded.
+    """
+    _TASK_REGEX = re.compile(r'^> Task (\S+)(?: (UP-TO-DATE|FROM-CACHE|NO-SOURCE|SKIPPED))?\s*$')
+    _CONFIGURATION_CACHE_REGEX = re.compile(
+        r'^(?:Configuration cache entry (reused|stored|discarded)|(Reusing) configuration cache)')
+    OUTCOME_EXECUTED = 'EXECUTED'
+    tasks = None
+    configurationCache = None
+    _currentTask = None
+
+    def __init__(self):
+        self.tasks = []
+
+    def _finishCurrentTask(self, now):
+        if self._currentTask is not None:
+            self._currentTask['duration'] = now - self._currentTask['start']
+            self._currentTask = None
+
+    def feed(self, line):
+        """>>> feed(line)
+        Parse a line of the output of Gradle.
+        """
+        match = self._TASK_REGEX.match(line)
+        if match is None:
+            match = self._CONFIGURATION_CACHE_REGEX.match(line)
+            if match is not None:
+                self.configurationCache = 'reused' if match.group(2) else match.group(1)
+            return
+        now = time()
+        self._finishCurrentTask(now)
+        self._currentTask = {'name': match.group(1), 'start': now, 'duration': 0,
+                             'outcome': match.group(2) or self.OUTCOME_EXECUTED}
+        self.tasks.append(self._currentTask)
+
+    def finish(self):
+        """>>> finish()
+        Mark the end of the output of Gradle.
+        """
+        self._finishCurrentTask(time())
+
+    def getOutcomeCounts(self):
+        """>>> getOutcomeCounts() -> dict of outcome to number of tasks
+        Returns how many tasks had each outcome.
+        """
+        counts = {}
+        for task in self.tasks:
+            counts[task['outcome']] = counts.get(task['outcome'], 0) + 1
+        return counts
+
+    def getBuildCacheHitRate(self):
+        """>>> getBuildCacheHitRate() -> percentage or None
+        Returns the percentage of the tasks that were not up-to-date
+        and were loaded from the build cache instead of being executed.
+        """
+        counts = self.getOutcomeCounts()
+        numRun = counts.get(self.OUTCOME_EXECUTED, 0) + counts.get('FROM-CACHE', 0)
+        return 100.0 * counts.get('FROM-CACHE', 0) / numRun if numRun > 0 else None
+
+    def getReport(self, maxTasks=10):
+        """>>> getReport(maxTasks) -> text
+        Returns a summary of the task outcomes and the cache usage
+        and a table of the 'maxTasks' tasks that took the longest.
+        """
+        counts = self.getOutcomeCounts()
+        numCacheable = counts.get(self.OUTCOME_EXECUTED, 0) + counts.get('UP-TO-DATE', 0) + \
+            counts.get('FROM-CACHE', 0)
+        numReused = counts.get('UP-TO-DATE', 0) + counts.get('FROM-CACHE', 0)
+        lines = ['{num} tasks: {outcomes}, {rate:.0f}% up-to-date or from cache'.format(
+            num=len(self.tasks), outcomes=', '.join(
+                '{count} {outcome}'.format(count=count, outcome=outcome.lower())
+                for outcome, count in sorted(counts.items())),
+            rate=100.0 * numReused / numCacheable if numCacheable > 0 else 0)]
+        hitRate = self.getBuildCacheHitRate()
+        if hitRate is not None:
+            lines.append('Build cache hit rate: {rate:.0f}%'.format(rate=hitRate))
+        if self.configurationCache is not None:
+            lines.append('Configuration cache entry ' + self.configurationCache)
+        slowest = sorted(self.tasks, key=lambda task: task['duration'], reverse=True)[:maxTasks]
+        if len(slowest) > 0:
+            nameWidth = max(len(task['name']) for task in slowest)
+            for task in slowest:
+                lines.append('{name:<{width}}  {duration:>7.2f}s  {outcome}'.format(
+                    name=task['name'], width=nameWidth, duration=task['duration'],
+                    outcome=task['outcome'].lower()))
+        return '\n'.join(lines)
+
+
+def runProcess(args, logger, cwd=None, env=None, parsers=(), tailLines=50,
+               outputPriority=Logger.PRIORITY_VERBOSE):
+    """>>> runProcess(args, logger, cwd, env, parsers, tailLines, outputPriority) -> ProcessResult
+    Run the program and write every line of its combined stdout and
+    stderr to the logger with 'outputPriority' as soon as it is printed.
+    Every line is also passed to the feed method of the 'parsers' and
+    the last 'tailLines' lines are kept in the result. If the program
+    could not be started, the return code of the result is None.
+    """
+    logger.verbose('Calling ' + subprocess.list2cmdline(args))
+    tail = deque(maxlen=tailLines)
+    startTime = time()
+    try:
+        with open(os.devnull) as devNull:
+            process = subprocess.Popen(args, cwd=cwd, env=env, stdin=devNull,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+        logger.error('Failed to run {cmd}: {msg}'.format(cmd=subprocess.list2cmdline(args),
+                                                         msg=str(e)))
+        return ProcessResult(args, None, time() - startTime, tail)
+    try:
+        for line in iter(process.stdout.readline, b''):
+            # Progress output overwrites the line with carriage returns, keep the last state
+            line = line.decode('utf-8', 'replace').rstrip('\r\n').rsplit('\r', 1)[-1]
+            tail.append(line)
+            logger.log(outputPriority, line)
+            for parser in parsers:
+                parser.feed(line)
+    finally:
+        process.stdout.close()
+        returnCode = process.wait()
+    for parser in parsers:
+        if hasattr(parser, 'finish'):
+            parser.finish()
+    return ProcessResult(args, returnCode, time() - startTime, tail)
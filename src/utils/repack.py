@@ -0,0 +1,170 @@
+"""
+Updates the Python sources in an already build debug apk without
+Gradle. The entries of the apk are copied into a new archive without
+being decompressed, only the changed Python files are replaced. The
+new archive is then aligned with zipalign and signed with the debug
+key by apksigner from the sdk build tools.
+"""
+
+import copy
+import os
+import re
+import struct
+import sys
+import zipfile
+
+from .files import replaceFile
+from .process import runProcess
+
+# The local file header of a zip entry, followed by the name and the extra field.
+_LOCAL_HEADER_SIZE = 30
+_LOCAL_HEADER_LENGTHS_OFFSET = 26
+# Set if the sizes and the checksum follow the data instead of being in the header.
+_FLAG_DATA_DESCRIPTOR = 0x08
+_SIGNATURE_FILE_REGEX = re.compile(r'\AMETA-INF/([^/]+\.(SF|RSA|DSA|EC)|MANIFEST\.MF)\Z',
+                                   re.IGNORECASE)
+DEBUG_KEY_ALIAS = 'androiddebugkey'
+DEBUG_KEY_PASSWORD = 'android'
+
+
+def findBuildTool(sdkPath, name):
+    """>>> findBuildTool(sdkPath, name) -> path or None
+    Returns the path to the tool in the newest
+    installed version of the sdk build tools.
+    """
+    buildToolsDir = os.path.join(sdkPath, 'build-tools')
+    if not os.path.isdir(buildToolsDir):
+        return None
+    executables = [name + '.exe', name + '.bat'] if sys.platform == 'win32' else [name]
+
+    def versionKey(version):
+        return [int(part) if part.isdigit() else 0 for part in re.split(r'[.-]', version)]
+
+    for version in sorted(os.listdir(buildToolsDir), key=versionKey, reverse=True):
+        for executable in executables:
+            path = os.path.join(buildToolsDir, version, executable)
+            if os.path.isfile(path):
+                return path
+    return None
+
+
+def findDebugKeystore():
+    """>>> findDebugKeystore() -> path or None
+    Returns the path to the debug keystore that
+    the Android Gradle plugin signs debug apks with.
+    """
+    candidates = []
+    if os.environ.get('ANDROID_USER_HOME'):
+        candidates.append(os.path.join(os.environ['ANDROID_USER_HOME'], 'debug.keystore'))
+    if os.environ.get('ANDROID_SDK_HOME'):
+        candidates.append(os.path.join(os.environ['ANDROID_SDK_HOME'], '.android',
+                                       'debug.keystore'))
+    candidates.append(os.path.join(os.path.expanduser('~'), '.android', 'debug.keystore'))
+    for path in candidates:
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def findEntryPrefix(apkPath, relPaths):
+    """>>> findEntryPrefix(apkPath, relPaths) -> (prefix, packaged relative paths) or None
+    Find the directory in the apk that the files with the relative paths
+    were packaged into, as the prefix of the entry names that matches
+    the most paths. Also returns which of the paths are in the apk.
+    """
+    relPaths = set(relPaths)
+    with zipfile.ZipFile(apkPath) as apk:
+        names = apk.namelist()
+    counts = {}
+    for name in names:
+        for index in [-1] + [i for i, char in enumerate(name) if char == '/']:
+            if name[index + 1:] in relPaths:
+                prefix = name[:index + 1]
+                counts[prefix] = counts.get(prefix, 0) + 1
+    if len(counts) == 0:
+        return None
+    prefix = max(sorted(counts), key=lambda candidate: counts[candidate])
+    names = set(names)
+    return prefix, set(relPath for relPath in relPaths if prefix + relPath in names)
+
+
+def _copyRawEntry(source, target, info):
+    """>>> _copyRawEntry(source, target, info)
+    Copy the entry described by 'info' from the source to the target
+    zip file without decompressing and compressing its data again.
+    """
+    source.fp.seek(info.header_offset)
+    header = source.fp.read(_LOCAL_HEADER_SIZE)
+    nameLength, extraLength = struct.unpack(
+        '<HH', header[_LOCAL_HEADER_LENGTHS_OFFSET:_LOCAL_HEADER_SIZE])
+    source.fp.seek(info.header_offset + _LOCAL_HEADER_SIZE + nameLength + extraLength)
+    newInfo = copy.copy(info)
+    # The sizes are known, so they are written into the header instead of a descriptor
+    newInfo.flag_bits &= ~_FLAG_DATA_DESCRIPTOR
+    newInfo.header_offset = target.fp.tell()
+    target.fp.write(newInfo.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        block = source.fp.read(min(remaining, 1024 * 1024))
+        if not block:
+            raise zipfile.BadZipfile('Truncated entry ' + info.filename)
+        target.fp.write(block)
+        remaining -= len(block)
+    target.filelist.append(newInfo)
+    target.NameToInfo[newInfo.filename] = newInfo
+    target.start_dir = target.fp.tell()
+
+
+def rewriteApk(apkPath, outputPath, replacements, removals):
+    """>>> rewriteApk(apkPath, outputPath, replacements, removals) -> number of replaced entries
+    Write a copy of the apk to 'outputPath', in which the entries
+    in 'replacements' (a dict of entry name to file path) contain
+    the content of the files and the entries in 'removals' are
+    deleted. The old signature files are not copied.
+    """
+    numReplaced = 0
+    with zipfile.ZipFile(apkPath) as source, zipfile.ZipFile(outputPath, 'w') as target:
+        for info in source.infolist():
+            if info.filename in removals or _SIGNATURE_FILE_REGEX.match(info.filename):
+                continue
+            if info.filename in replacements:
+                target.write(replacements[info.filename], info.filename,
+                             compress_type=info.compress_type)
+                numReplaced += 1
+            else:
+                _copyRawEntry(source, target, info)
+    return numReplaced
+
+
+def alignAndSign(apkPath, outputPath, zipalignPath, apksignerPath, keystorePath, logger):
+    """>>> alignAndSign(apkPath, outputPath, zipalignPath, apksignerPath, keystorePath, logger)
+    -> success
+    Align the entries of the unsigned apk and sign it with the debug key
+    from the keystore. If a v4 signature existed next to 'outputPath',
+    it is replaced by a new one, otherwise it is not generated.
+    """
+    alignedPath = outputPath + '.aligned'
+    signedPath = outputPath + '.signed'
+    idsigPath = outputPath + '.idsig'
+    withV4Signature = os.path.isfile(idsigPath)
+    try:
+        result = runProcess([zipalignPath, '-f', '-p', '4', apkPath, alignedPath], logger)
+        if not result.success:
+            logger.warn('Failed to align the apk:\n' + result.getTail())
+            return False
+        result = runProcess([
+            apksignerPath, 'sign', '--ks', keystorePath, '--ks-key-alias', DEBUG_KEY_ALIAS,
+            '--ks-pass', 'pass:' + DEBUG_KEY_PASSWORD, '--key-pass', 'pass:' + DEBUG_KEY_PASSWORD,
+            '--v4-signing-enabled', 'true' if withV4Signature else 'false',
+            '--out', signedPath, alignedPath], logger)
+        if not result.success:
+            logger.warn('Failed to sign the apk:\n' + result.getTail())
+            return False
+        replaceFile(signedPath, outputPath)
+        if withV4Signature:
+            replaceFile(signedPath + '.idsig', idsigPath)
+        return True
+    finally:
+        for path in [alignedPath, signedPath, signedPath + '.idsig']:
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,121 @@
+"""
+Removes docstrings and comments from Python sources
+without changing the line numbers of the remaining code.
+"""
+
+import ast
+import functools
+import io
+import re
+import shutil
+import tokenize
+
+_CODING_REGEX = re.compile(r'^[ \t\f]*#.*?coding[:=]')
+
+
+def _charOffset(line, byteOffset):
+    """>>> _charOffset(line, byteOffset) -> offset
+    Convert the utf-8 byte offset reported by the ast
+    module into a character offset into 'line'.
+    """
+    return len(line.encode('utf-8')[:byteOffset].decode('utf-8', 'ignore'))
+
+
+def _stripComments(lines):
+    """>>> _stripComments(lines) -> lines
+    Remove all comments except for the shebang and the encoding declaration.
+    """
+    lines = list(lines)
+    for token in tokenize.generate_tokens(functools.partial(next, iter(lines))):
+        if token[0] != tokenize.COMMENT:
+            continue
+        row, column = token[2]
+        if row <= 2 and (token[1].startswith('#!') and row == 1 or _CODING_REGEX.match(token[1])):
+            continue
+        line = lines[row - 1]
+        ending = line[len(line.rstrip('\r\n')):]
+        lines[row - 1] = line[:column].rstrip() + ending
+    return lines
+
+
+def _stripDocstrings(lines):
+    """>>> _stripDocstrings(lines) -> lines
+    Remove the docstrings of the module, all classes and
+    all functions. A docstring that is the only statement
+    of a body is replaced by a pass statement.
+    """
+    lines = list(lines)
+    tree = ast.parse(''.join(lines))
+    for node in ast.walk(tree):
+        if not isinstance(node, (ast.Module, ast.ClassDef, ast.FunctionDef,
+                                 getattr(ast, 'AsyncFunctionDef', ast.FunctionDef))):
+            continue
+        if len(node.body) == 0 or not isinstance(node.body[0], ast.Expr):
+            continue
+        docNode = node.body[0].value
+        if not (isinstance(docNode, getattr(ast, 'Constant', ())) and
+                isinstance(docNode.value, str) or isinstance(docNode, getattr(ast, 'Str', ()))):
+            continue
+        if getattr(docNode, 'end_lineno', None) is None:
+            return lines  # Python < 3.8 does not provide the end of nodes
+        firstLine, lastLine = lines[docNode.lineno - 1], lines[docNode.end_lineno - 1]
+        prefix = firstLine[:_charOffset(firstLine, docNode.col_offset)]
+        suffix = lastLine[_charOffset(lastLine, docNode.end_col_offset):]
+        needsPass = not isinstance(node, ast.Module) and len(node.body) == 1 \
+            or prefix.strip() != '' or suffix.lstrip().startswith(';')
+        replacement = prefix + ('pass' if needsPass else '')
+        if docNode.lineno == docNode.end_lineno:
+            lines[docNode.lineno - 1] = replacement + suffix
+        else:
+            lines[docNode.lineno - 1] = replacement.rstrip() + '\n'
+            for lineNumber in range(docNode.lineno, docNode.end_lineno - 1):
+                lines[lineNumber] = '\n'
+            lines[docNode.end_lineno - 1] = suffix
+    return lines
+
+
+def stripSource(source, docstrings=True, comments=True):
+    """>>> stripSource(source, docstrings, comments) -> bytes
+    Remove the docstrings and / or comments from the Python
+    source given as bytes. If the source can't be parsed,
+    it is returned unchanged.
+    """
+    try:
+        encoding = tokenize.detect_encoding(io.BytesIO(source).readline)[0]
+        lines = source.decode(encoding).splitlines(True)
+        if comments:
+            lines = _stripComments(lines)
+        if docstrings:
+            lines = _stripDocstrings(lines)
+        result = ''.join(lines)
+        compile(result, '<stripped>', 'exec', dont_inherit=True)
+        return result.encode(encoding)
+    except (SyntaxError, ValueError, UnicodeError, tokenize.TokenError, IndentationError):
+        return source
+
+
+class SourceStripper(object):
+    """
+    A copy function for syncDir that strips docstrings and / or
+    comments from all Python files and counts the saved bytes.
+    """
+    docstrings = False
+    comments = False
+    savedBytes = 0
+
+    def __init__(self, docstrings, comments):
+        self.docstrings = docstrings
+        self.comments = comments
+        self.savedBytes = 0
+
+    def __call__(self, srcPath, destPath):
+        if not srcPath.endswith('.py'):
+            shutil.copy2(srcPath, destPath)
+            return
+        with open(srcPath, 'rb') as sourceFile:
+            source = sourceFile.read()
+        result = stripSource(source, self.docstrings, self.comments)
+        with open(destPath, 'wb') as destFile:
+            destFile.write(result)
+        shutil.copystat(srcPath, destPath)
+        self.savedBytes += len(source) - len(result)
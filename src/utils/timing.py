@@ -0,0 +1,180 @@
+"""
+Measures the wall and CPU time of the phases of a command and collects
+counters, like the number of copied files or bytes, per phase. The
+results can be written as a Chrome trace (see chrome://tracing or
+https://ui.perfetto.dev) and summarized as a table.
+"""
+
+import json
+import os
+import threading
+from contextlib import contextmanager
+from time import time
+
+try:
+    from time import thread_time as _threadTime
+except ImportError:
+    try:
+        from time import process_time as _threadTime
+    except ImportError:
+        def _threadTime():
+            times = os.times()
+            return times[0] + times[1]
+
+
+def _childTime():
+    """>>> _childTime() -> seconds
+    Returns the CPU time of all finished child processes, if it is known.
+    """
+    times = os.times()
+    return times[2] + times[3]
+
+
+class Phase(object):
+    """A measured phase of a command."""
+    name = None
+    depth = 0
+    threadId = None
+    startTime = None
+    wallTime = None
+    cpuTime = None
+    childCpuTime = None
+    counters = None
+
+    def __init__(self, name, depth, threadId):
+        self.name = name
+        self.depth = depth
+        self.threadId = threadId
+        self.counters = {}
+
+
+class Tracer(object):
+    """
+    Records the phases of a command. Phases are entered with the phase
+    context manager and can be nested. Counters are added to the
+    innermost phase of the current thread.
+    """
+    _phases = None
+    _lock = None
+    _local = None
+    _startTime = None
+
+    def __init__(self):
+        self._phases = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._startTime = time()
+
+    def _getStack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def phase(self, name):
+        """>>> with phase(name) as phase:
+        Measure the code in the with block as a phase called 'name'.
+        """
+        stack = self._getStack()
+        phase = Phase(name, len(stack), threading.current_thread().ident)
+        stack.append(phase)
+        phase.startTime = time()
+        cpuStart, childStart = _threadTime(), _childTime()
+        try:
+            yield phase
+        finally:
+            phase.wallTime = time() - phase.startTime
+            phase.cpuTime = _threadTime() - cpuStart
+            phase.childCpuTime = _childTime() - childStart
+            stack.pop()
+            with self._lock:
+                self._phases.append(phase)
+
+    def count(self, name, value=1):
+        """>>> count(name, value)
+        Add 'value' to the counter called 'name' of the
+        current phase. Does nothing outside of a phase.
+        """
+        stack = self._getStack()
+        if len(stack) > 0:
+            stack[-1].counters[name] = stack[-1].counters.get(name, 0) + value
+
+    def getCurrentPhase(self):
+        """>>> getCurrentPhase() -> name or None
+        Returns the name of the innermost phase of the current thread.
+        """
+        stack = self._getStack()
+        return stack[-1].name if len(stack) > 0 else None
+
+    def getPhases(self):
+        """>>> getPhases() -> list of Phase
+        Returns all finished phases in the order they were started.
+        """
+        with self._lock:
+            return sorted(self._phases, key=lambda phase: phase.startTime)
+
+    def writeChromeTrace(self, path):
+        """>>> writeChromeTrace(path)
+        Write all finished phases as complete events
+        in the Chrome trace event format to 'path'.
+        """
+        events = []
+        for phase in self.getPhases():
+            args = {'cpu ms': round(phase.cpuTime * 1000, 3),
+                    'child cpu ms': round(phase.childCpuTime * 1000, 3)}
+            args.update(phase.counters)
+            events.append({
+                'name': phase.name, 'cat': 'build', 'ph': 'X', 'pid': os.getpid(),
+                'tid': phase.threadId, 'ts': int((phase.startTime - self._startTime) * 1e6),
+                'dur': int(phase.wallTime * 1e6), 'args': args,
+            })
+        with open(path, 'w') as traceFile:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, traceFile)
+
+    def getSummary(self):
+        """>>> getSummary() -> table
+        Returns a table of the phases, combining phases with the same name.
+        """
+        rows = []
+        rowsByName = {}
+        for phase in self.getPhases():
+            row = rowsByName.get(phase.name)
+            if row is None:
+                row = rowsByName[phase.name] = {
+                    'name': '  ' * phase.depth + phase.name, 'calls': 0, 'wall': 0,
+                    'cpu': 0, 'child': 0, 'counters': {}}
+                rows.append(row)
+            row['calls'] += 1
+            row['wall'] += phase.wallTime
+            row['cpu'] += phase.cpuTime
+            row['child'] += phase.childCpuTime
+            for name, value in phase.counters.items():
+                row['counters'][name] = row['counters'].get(name, 0) + value
+        nameWidth = max([len('Phase')] + [len(row['name']) for row in rows])
+        lines = ['{name:<{width}}  {calls:>5}  {wall:>9}  {cpu:>9}  {child:>9}  Counters'.format(
+            name='Phase', width=nameWidth, calls='Calls', wall='Wall', cpu='CPU',
+            child='Child CPU')]
+        for row in rows:
+            lines.append(
+                '{name:<{width}}  {calls:>5}  {wall:>8.3f}s  {cpu:>8.3f}s  {child:>8.3f}s  '
+                '{counters}'.format(name=row['name'], width=nameWidth, calls=row['calls'],
+                                    wall=row['wall'], cpu=row['cpu'], child=row['child'],
+                                    counters=', '.join('{name}={value}'.format(
+                                        name=name, value=value)
+                                        for name, value in sorted(row['counters'].items()))))
+        return '\n'.join(lines)
+
+
+def tracedPhase(name):
+    """>>> @tracedPhase(name)
+    Decorator for methods of objects with a 'config' attribute, that
+    measures every call of the method as a phase called 'name'.
+    """
+    def decorator(function):
+        def wrapper(self, *args, **kwargs):
+            with self.config.tracer.phase(name):
+                return function(self, *args, **kwargs)
+        wrapper.__name__ = function.__name__
+        wrapper.__doc__ = function.__doc__
+        return wrapper
+    return decorator
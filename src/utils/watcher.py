@@ -0,0 +1,258 @@
+"""
+File system watchers used to detect changes to the sources of an app.
+On Linux, changes are reported by inotify, on all other
+platforms the watched paths are polled periodically.
+"""
+
+import errno
+import os
+import select
+import struct
+import sys
+from time import sleep, time
+
+try:
+    from os import scandir
+except ImportError:  # Python < 3.5
+    scandir = None
+
+
+class PollingWatcher(object):
+    """
+    Detects changes to the watched files and directories by comparing
+    snapshots of the size and modification time of every file.
+    """
+    paths = None
+    interval = 1.0
+    _snapshot = None
+
+    def __init__(self, paths, interval=1.0):
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.interval = interval
+        self._snapshot = self._takeSnapshot()
+
+    def _scanDir(self, dirPath, snapshot):
+        """>>> _scanDir(dirPath, snapshot)
+        Add the size and modification time of every file in
+        'dirPath' and its subdirectories to the snapshot.
+        """
+        if scandir is None:
+            for dirPath, _, fileNames in os.walk(dirPath):
+                for fileName in fileNames:
+                    self._scanFile(os.path.join(dirPath, fileName), snapshot)
+            return
+        try:
+            entries = list(scandir(dirPath))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    snapshot[entry.path] = None
+                    self._scanDir(entry.path, snapshot)
+                else:
+                    stat = entry.stat()
+                    snapshot[entry.path] = (stat.st_size, stat.st_mtime)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _scanFile(filePath, snapshot):
+        """>>> _scanFile(filePath, snapshot)
+        Add the size and modification time of the file to the snapshot.
+        """
+        try:
+            stat = os.stat(filePath)
+        except OSError:
+            return
+        snapshot[filePath] = (stat.st_size, stat.st_mtime)
+
+    def _takeSnapshot(self):
+        """>>> _takeSnapshot() -> snapshot
+        Returns a dict mapping every watched path to its
+        size and modification time.
+        """
+        snapshot = {}
+        for path in self.paths:
+            if os.path.isdir(path):
+                self._scanDir(path, snapshot)
+            else:
+                self._scanFile(path, snapshot)
+        return snapshot
+
+    def poll(self, timeout):
+        """>>> poll(timeout) -> set of paths
+        Wait at most 'timeout' seconds for changes and
+        return the paths that were changed.
+        """
+        endTime = time() + timeout
+        while True:
+            snapshot = self._takeSnapshot()
+            changes = set(path for path in set(snapshot) | set(self._snapshot)
+                          if snapshot.get(path, False) != self._snapshot.get(path, False))
+            self._snapshot = snapshot
+            remaining = endTime - time()
+            if changes or remaining <= 0:
+                return changes
+            sleep(min(self.interval, remaining))
+
+    def close(self):
+        """>>> close()
+        Release all resources used by this watcher.
+        """
+        self._snapshot = {}
+
+
+class InotifyWatcher(object):
+    """
+    Detects changes to the watched files and directories with
+    the inotify api of the Linux kernel. Raises OSError if
+    inotify is not available.
+    """
+    _IN_MODIFY = 0x2
+    _IN_ATTRIB = 0x4
+    _IN_CLOSE_WRITE = 0x8
+    _IN_MOVED_FROM = 0x40
+    _IN_MOVED_TO = 0x80
+    _IN_CREATE = 0x100
+    _IN_DELETE = 0x200
+    _IN_DELETE_SELF = 0x400
+    _IN_MOVE_SELF = 0x800
+    _IN_Q_OVERFLOW = 0x4000
+    _IN_IGNORED = 0x8000
+    _IN_ISDIR = 0x40000000
+    _IN_CLOEXEC = 0o2000000
+    _WATCH_MASK = _IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | \
+        _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF
+    _EVENT_HEADER = struct.Struct('iIII')
+
+    paths = None
+    _libc = None
+    _fd = None
+    _watchedDirs = None
+    _watchedFiles = None
+
+    def __init__(self, paths):
+        import ctypes
+        import ctypes.util
+        self.paths = [os.path.abspath(path) for path in paths]
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init1(self._IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, 'inotify_init1 failed: ' + os.strerror(error))
+        self._watchedDirs = {}
+        self._watchedFiles = set()
+        for path in self.paths:
+            if os.path.isdir(path):
+                self._addDirWatch(path, recursive=True)
+            else:
+                self._watchedFiles.add(path)
+                self._addDirWatch(os.path.dirname(path), recursive=False)
+
+    def _addDirWatch(self, dirPath, recursive):
+        """>>> _addDirWatch(dirPath, recursive)
+        Start watching the directory and optionally
+        all of its subdirectories.
+        """
+        encodedPath = dirPath.encode(sys.getfilesystemencoding())
+        watchDescriptor = self._libc.inotify_add_watch(self._fd, encodedPath, self._WATCH_MASK)
+        if watchDescriptor < 0:
+            return
+        self._watchedDirs[watchDescriptor] = (dirPath, recursive)
+        if recursive:
+            for name in os.listdir(dirPath):
+                subDirPath = os.path.join(dirPath, name)
+                if os.path.isdir(subDirPath) and not os.path.islink(subDirPath):
+                    self._addDirWatch(subDirPath, recursive)
+
+    def _readEvents(self):
+        """>>> _readEvents() -> set of paths
+        Read all pending events from the inotify file
+        descriptor and return the changed paths.
+        """
+        changes = set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return changes
+            raise
+        offset = 0
+        while offset + self._EVENT_HEADER.size <= len(data):
+            watchDescriptor, mask, _, nameLength = self._EVENT_HEADER.unpack_from(data, offset)
+            offset += self._EVENT_HEADER.size
+            name = data[offset:offset + nameLength].rstrip(b'\0')
+            offset += nameLength
+            if mask & self._IN_Q_OVERFLOW:
+                changes.update(self.paths)
+                continue
+            if watchDescriptor not in self._watchedDirs:
+                continue
+            dirPath, recursive = self._watchedDirs[watchDescriptor]
+            if mask & self._IN_IGNORED:
+                del self._watchedDirs[watchDescriptor]
+                continue
+            path = os.path.join(dirPath, name.decode(sys.getfilesystemencoding())) \
+                if name else dirPath
+            if not recursive and path not in self._watchedFiles:
+                continue
+            changes.add(path)
+            if recursive and mask & self._IN_ISDIR and mask & (self._IN_CREATE | self._IN_MOVED_TO):
+                self._addDirWatch(path, recursive)
+        return changes
+
+    def poll(self, timeout):
+        """>>> poll(timeout) -> set of paths
+        Wait at most 'timeout' seconds for changes and
+        return the paths that were changed.
+        """
+        endTime = time() + timeout
+        while True:
+            remaining = max(0.0, endTime - time())
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+            if not readable:
+                return set()
+            changes = self._readEvents()
+            if changes or time() >= endTime:
+                return changes
+
+    def close(self):
+        """>>> close()
+        Release all resources used by this watcher.
+        """
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def createWatcher(paths, logger, usePolling=False):
+    """>>> createWatcher(paths, logger, usePolling) -> watcher
+    Create a watcher for the given files and directories.
+    Uses inotify if it is available and 'usePolling' is False,
+    otherwise the watched paths are polled.
+    """
+    if not usePolling and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(paths)
+        except (OSError, AttributeError) as e:
+            logger.verbose('Inotify is not available, falling back to polling: ' + str(e))
+    return PollingWatcher(paths)
+
+
+def waitForChanges(watcher, delay):
+    """>>> waitForChanges(watcher, delay) -> (firstChangeTime, set of paths)
+    Block until the first change is detected and collect all
+    following changes until no change happened for 'delay'
+    seconds. Returns the time the first change was detected
+    and all changed paths.
+    """
+    changes = set()
+    while not changes:
+        changes = watcher.poll(3600)
+    firstChangeTime = time()
+    while True:
+        newChanges = watcher.poll(delay)
+        if not newChanges:
+            return firstChangeTime, changes
+        changes.update(newChanges)
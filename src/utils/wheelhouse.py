@@ -0,0 +1,469 @@
+"""
+Resolves the requirements of an app against local directories of
+pure-Python wheels, so they can be packaged into the apk instead of
+being downloaded by the app when it is started for the first time.
+Extracted wheels are cached by the hash of the wheel file.
+"""
+
+import json
+import os
+import re
+import shutil
+import zipfile
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+from .files import fileDigest, mkDirs, replaceFile
+
+_VERSION_REGEX = re.compile(
+    r'\A[vV]?(\d+(?:\.\d+)*)(?:[-_.]?(a|alpha|b|beta|c|rc|pre|preview)[-_.]?(\d*))?'
+    r'(?:[-_.]?(?:post|rev|r)[-_.]?(\d*))?(?:[-_.]?dev[-_.]?(\d*))?(?:\+[a-zA-Z0-9.]*)?\Z',
+    re.IGNORECASE)
+_PRE_RELEASE_RANKS = {'a': 0, 'alpha': 0, 'b': 1, 'beta': 1, 'c': 2, 'rc': 2, 'pre': 2,
+                      'preview': 2}
+_REQUIREMENT_REGEX = re.compile(r'\A\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?\s*'
+                                r'\(?([^;()]*)\)?\s*(?:;(.*))?\Z')
+_SPECIFIER_REGEX = re.compile(r'\A\s*(===|==|!=|~=|>=|<=|>|<)\s*(\S+?)\s*\Z')
+_MARKER_REGEX = re.compile(r'\A\s*(?:([a-z_]+)\s*(===|==|!=|~=|>=|<=|>|<|not in|in)\s*'
+                           r'["\']([^"\']*)["\']|["\']([^"\']*)["\']\s*'
+                           r'(===|==|!=|~=|>=|<=|>|<|not in|in)\s*([a-z_]+))\s*\Z')
+# The values of the environment markers on Android. Markers that
+# depend on the Python version are only evaluated if it is known.
+ANDROID_MARKERS = {
+    'sys_platform': 'linux',
+    'platform_system': 'Linux',
+    'os_name': 'posix',
+    'implementation_name': 'cpython',
+    'platform_python_implementation': 'CPython',
+    'extra': '',
+}
+
+
+def normalizeName(name):
+    """>>> normalizeName(name) -> name
+    Returns the normalized form of a project name (PEP 503).
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def versionKey(version):
+    """>>> versionKey(version) -> key or None
+    Returns a key that sorts versions in the order defined by PEP 440,
+    or None if the version can't be parsed.
+    """
+    match = _VERSION_REGEX.match(version.strip())
+    if match is None:
+        return None
+    release = [int(part) for part in match.group(1).split('.')]
+    while len(release) > 1 and release[-1] == 0:
+        release.pop()
+    preRelease, preNumber, post, dev = match.group(2, 3, 4, 5)
+    if preRelease is not None:
+        preKey = (0, _PRE_RELEASE_RANKS[preRelease.lower()], int(preNumber or 0))
+    elif dev is not None and post is None:
+        preKey = (-1, 0, 0)  # 1.0.dev1 is before 1.0a1
+    else:
+        preKey = (1, 0, 0)
+    postKey = (-1,) if post is None else (int(post or 0),)
+    devKey = (1, 0) if dev is None else (0, int(dev or 0))
+    return tuple(release), preKey, postKey, devKey
+
+
+def isPreRelease(version):
+    """>>> isPreRelease(version) -> boolean
+    Returns True if the version is a pre- or development release.
+    """
+    key = versionKey(version)
+    return key is not None and (key[1][0] != 1 or key[3][0] == 0)
+
+
+def _releasePrefixMatches(version, prefix):
+    release = [int(part) for part in _VERSION_REGEX.match(version).group(1).split('.')]
+    prefix = [int(part) for part in prefix.split('.')]
+    release += [0] * (len(prefix) - len(release))
+    return release[:len(prefix)] == prefix
+
+
+def matchesSpecifier(version, operator, target):
+    """>>> matchesSpecifier(version, operator, target) -> boolean
+    Returns True if the version satisfies the version
+    specifier 'operator' 'target', e.g. '>=' '1.2'.
+    """
+    if operator == '===':
+        return version == target
+    if operator in ['==', '!='] and target.endswith('.*'):
+        if versionKey(version) is None or versionKey(target[:-2]) is None:
+            return operator == '!='
+        return _releasePrefixMatches(version, target[:-2]) == (operator == '==')
+    key, targetKey = versionKey(version), versionKey(target)
+    if key is None or targetKey is None:
+        return False
+    if operator == '~=':
+        prefix = _VERSION_REGEX.match(target).group(1).split('.')
+        return key >= targetKey and _releasePrefixMatches(version, '.'.join(prefix[:-1]))
+    return {'==': key == targetKey, '!=': key != targetKey, '>=': key >= targetKey,
+            '<=': key <= targetKey, '>': key > targetKey, '<': key < targetKey}[operator]
+
+
+def evaluateMarker(marker, pythonVersion=None):
+    """>>> evaluateMarker(marker, pythonVersion) -> boolean
+    Evaluate the environment marker of a requirement for Android.
+    Parentheses are ignored and clauses that can't be evaluated
+    are considered true, so unknown dependencies are rather included.
+    """
+    environment = dict(ANDROID_MARKERS)
+    if pythonVersion is not None:
+        environment['python_version'] = '.'.join(pythonVersion.split('.')[:2])
+        environment['python_full_version'] = pythonVersion
+    marker = marker.replace('(', ' ').replace(')', ' ')
+    for alternative in re.split(r'\s+or\s+', marker):
+        result = True
+        for clause in re.split(r'\s+and\s+', alternative):
+            match = _MARKER_REGEX.match(clause)
+            if match is None:
+                continue
+            if match.group(1) is not None:
+                variable, operator, value = match.group(1, 2, 3)
+                left, right = environment.get(variable), value
+            else:
+                value, operator, variable = match.group(4, 5, 6)
+                left, right = value, environment.get(variable)
+            if variable not in environment:
+                continue
+            if operator in ['in', 'not in']:
+                clauseResult = (left in right) == (operator == 'in')
+            elif variable.startswith('python') and versionKey(left) is not None:
+                clauseResult = matchesSpecifier(left, operator, right)
+            else:
+                clauseResult = {'==': left == right, '===': left == right,
+                                '!=': left != right}.get(operator, True)
+            result = result and clauseResult
+        if result:
+            return True
+    return False
+
+
+class Requirement(object):
+    """A requirement on a project, like 'requests>=1.2,<3'."""
+    text = None
+    name = None
+    key = None
+    specifiers = None
+    marker = None
+
+    def __init__(self, text, name, specifiers, marker):
+        self.text = text
+        self.name = name
+        self.key = normalizeName(name)
+        self.specifiers = specifiers
+        self.marker = marker
+
+    @classmethod
+    def parse(cls, text):
+        """>>> Requirement.parse(text) -> Requirement or None
+        Parse a requirement in the syntax of a requirements.txt file.
+        URLs and editable requirements are not supported.
+        """
+        match = _REQUIREMENT_REGEX.match(text)
+        if match is None:
+            return None
+        specifiers = []
+        for specifier in match.group(2).split(','):
+            if specifier.strip() == '':
+                continue
+            specifierMatch = _SPECIFIER_REGEX.match(specifier)
+            if specifierMatch is None:
+                return None
+            specifiers.append(specifierMatch.groups())
+        marker = match.group(3).strip() if match.group(3) is not None else None
+        return cls(text.strip(), match.group(1), specifiers, marker)
+
+    def allowsPreReleases(self):
+        return any(isPreRelease(version) for _, version in self.specifiers)
+
+    def isSatisfiedBy(self, version):
+        """>>> isSatisfiedBy(version) -> boolean
+        Returns True if the version matches all specifiers.
+        """
+        if isPreRelease(version) and not self.allowsPreReleases():
+            return False
+        return all(matchesSpecifier(version, operator, target)
+                   for operator, target in self.specifiers)
+
+
+def parseRequirements(text):
+    """>>> parseRequirements(text) -> (list of Requirement, list of invalid requirements)
+    Parse the whitespace separated requirements of the app configuration.
+    """
+    requirements = []
+    invalid = []
+    for part in text.split():
+        requirement = Requirement.parse(part)
+        if requirement is None:
+            invalid.append(part)
+        else:
+            requirements.append(requirement)
+    return requirements, invalid
+
+
+class Wheel(object):
+    """A wheel file, described by its file name (PEP 427)."""
+    path = None
+    name = None
+    key = None
+    version = None
+    pythonTags = None
+    abiTag = None
+    platformTag = None
+    sha256 = None
+
+    def __init__(self, path, name, version, pythonTags, abiTag, platformTag):
+        self.path = path
+        self.name = name
+        self.key = normalizeName(name)
+        self.version = version
+        self.pythonTags = pythonTags
+        self.abiTag = abiTag
+        self.platformTag = platformTag
+
+    @classmethod
+    def fromPath(cls, path):
+        """>>> Wheel.fromPath(path) -> Wheel or None
+        Returns the wheel described by the name of the file at 'path'.
+        """
+        fileName = os.path.basename(path)
+        if not fileName.endswith('.whl'):
+            return None
+        parts = fileName[:-len('.whl')].split('-')
+        if len(parts) not in [5, 6] or versionKey(parts[1]) is None:
+            return None
+        return cls(path, parts[0], parts[1], parts[-3].split('.'), parts[-2], parts[-1])
+
+    def isPurePython(self):
+        return self.abiTag == 'none' and self.platformTag == 'any' and \
+            all(tag.startswith('py') for tag in self.pythonTags)
+
+    def supportsPython(self, pythonVersion):
+        """>>> supportsPython(pythonVersion) -> boolean
+        Returns True if the wheel can be used with the Python version.
+        An unknown version is supported by all wheels.
+        """
+        if pythonVersion is None:
+            return True
+        major = pythonVersion.split('.')[0]
+        return any(tag[2:3] == major for tag in self.pythonTags)
+
+    def getRequirements(self):
+        """>>> getRequirements() -> list of Requirement
+        Read the requirements of the wheel from its metadata.
+        """
+        prefix = '{name}-{version}.dist-info/'.format(name=self.name, version=self.version)
+        requirements = []
+        with zipfile.ZipFile(self.path) as wheelFile:
+            names = [name for name in wheelFile.namelist()
+                     if name.endswith('.dist-info/METADATA')]
+            names.sort(key=lambda name: name != prefix + 'METADATA')
+            if len(names) == 0:
+                return requirements
+            metadata = wheelFile.read(names[0]).decode('utf-8', 'replace')
+        for line in metadata.splitlines():
+            if line == '':
+                break  # The description follows the headers
+            if line.startswith('Requires-Dist:'):
+                requirement = Requirement.parse(line[len('Requires-Dist:'):])
+                if requirement is not None:
+                    requirements.append(requirement)
+        return requirements
+
+
+class Wheelhouse(object):
+    """
+    The pure-Python wheels in a list of directories. A directory can
+    be a flat wheelhouse, as written by 'pip wheel', or a simple index
+    directory with one subdirectory per project. Extracted wheels are
+    stored in the cache directory under the sha256 hash of the wheel.
+    """
+    _HASHES_NAME = 'wheel-hashes.json'
+    paths = None
+    cacheDir = None
+    logger = None
+    jobs = None
+    _wheels = None
+
+    def __init__(self, paths, cacheDir, logger, jobs=None):
+        self.paths = paths
+        self.cacheDir = cacheDir
+        self.logger = logger
+        self.jobs = jobs or cpu_count()
+
+    def getWheels(self):
+        """>>> getWheels() -> dict of normalized project name to list of Wheel
+        Returns all wheels in the directories, the newest first.
+        """
+        if self._wheels is not None:
+            return self._wheels
+        self._wheels = {}
+        for path in self.paths:
+            if not os.path.isdir(path):
+                self.logger.warn('The wheelhouse {path} does not exist.'.format(path=path))
+                continue
+            for dirPath, dirNames, fileNames in os.walk(path):
+                if dirPath != path:
+                    dirNames[:] = []  # Only search the project directories of an index
+                for fileName in fileNames:
+                    wheel = Wheel.fromPath(os.path.join(dirPath, fileName))
+                    if wheel is not None:
+                        self._wheels.setdefault(wheel.key, []).append(wheel)
+        for wheels in self._wheels.values():
+            wheels.sort(key=lambda wheel: versionKey(wheel.version), reverse=True)
+        return self._wheels
+
+    def findWheel(self, requirement, pythonVersion=None):
+        """>>> findWheel(requirement, pythonVersion) -> (Wheel or None, reason)
+        Returns the newest pure-Python wheel that satisfies the
+        requirement, or None and the reason why there is none.
+        """
+        wheels = [wheel for wheel in self.getWheels().get(requirement.key, [])
+                  if requirement.isSatisfiedBy(wheel.version)]
+        if len(wheels) == 0:
+            return None, 'no matching wheel found'
+        for wheel in wheels:
+            if wheel.isPurePython() and wheel.supportsPython(pythonVersion):
+                return wheel, None
+        return None, 'only platform specific wheels found'
+
+    def resolve(self, requirements, pythonVersion=None):
+        """>>> resolve(requirements, pythonVersion) -> (list of Wheel, list of Requirement)
+        Find the wheels for the requirements and all their dependencies.
+        Returns the wheels and the requirements that can't be satisfied
+        by the wheelhouse and must be installed by the app instead.
+        """
+        selected = {}
+        unresolved = []
+        pending = list(requirements)
+        while len(pending) > 0:
+            requirement = pending.pop(0)
+            if requirement.marker is not None and \
+                    not evaluateMarker(requirement.marker, pythonVersion):
+                continue
+            if requirement.key in selected:
+                if not requirement.isSatisfiedBy(selected[requirement.key].version):
+                    self.logger.warn('Requirement {req} conflicts with the selected version '
+                                     '{version}.'.format(req=requirement.text,
+                                                         version=selected[requirement.key].version))
+                continue
+            if any(other.key == requirement.key for other in unresolved):
+                continue
+            wheel, reason = self.findWheel(requirement, pythonVersion)
+            if wheel is None:
+                self.logger.verbose('Not vendoring {req}: {reason}', req=requirement.text,
+                                    reason=reason)
+                unresolved.append(requirement)
+                continue
+            selected[requirement.key] = wheel
+            try:
+                pending += wheel.getRequirements()
+            except (IOError, OSError, zipfile.BadZipfile) as e:
+                self.logger.warn('Failed to read the requirements of {path}: {msg}'
+                                 .format(path=wheel.path, msg=str(e)))
+        return sorted(selected.values(), key=lambda wheel: wheel.key), unresolved
+
+    def _loadHashes(self):
+        try:
+            with open(os.path.join(self.cacheDir, self._HASHES_NAME)) as hashesFile:
+                return json.load(hashesFile)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def hashWheels(self, wheels):
+        """>>> hashWheels(wheels)
+        Set the sha256 hash of the wheels. The hashes are remembered
+        together with the size and modification time of the files.
+        """
+        hashes = self._loadHashes()
+        changed = False
+        for wheel in wheels:
+            path = os.path.abspath(wheel.path)
+            fileStat = os.stat(path)
+            signature = [fileStat.st_size, fileStat.st_mtime]
+            if hashes.get(path, [])[0:2] != signature:
+                hashes[path] = signature + [fileDigest(path, algorithm='sha256')]
+                changed = True
+            wheel.sha256 = hashes[path][2]
+        if changed and mkDirs(self.cacheDir):
+            hashesPath = os.path.join(self.cacheDir, self._HASHES_NAME)
+            with open(hashesPath + '.tmp', 'w') as hashesFile:
+                json.dump(hashes, hashesFile)
+            replaceFile(hashesPath + '.tmp', hashesPath)
+
+    def _extract(self, wheel):
+        """>>> _extract(wheel) -> (path, extracted) or (None, error message)
+        Extract the wheel into the cache, unless it already is.
+        The content of the purelib and platlib directories of
+        the .data directory is moved to the top level, the rest
+        of the .data directory is not extracted.
+        """
+        extractDir = os.path.join(self.cacheDir, wheel.sha256)
+        if os.path.isdir(extractDir):
+            return extractDir, False
+        tempDir = '{path}.tmp-{pid}'.format(path=extractDir, pid=os.getpid())
+        dataPrefix = '{name}-{version}.data/'.format(name=wheel.name, version=wheel.version)
+        try:
+            if os.path.exists(tempDir):
+                shutil.rmtree(tempDir)
+            with zipfile.ZipFile(wheel.path) as wheelFile:
+                for info in wheelFile.infolist():
+                    name = info.filename
+                    if name.startswith(dataPrefix):
+                        parts = name[len(dataPrefix):].split('/', 1)
+                        if parts[0] not in ['purelib', 'platlib'] or len(parts) < 2:
+                            continue
+                        name = parts[1]
+                    if name == '' or name.endswith('/'):
+                        continue
+                    parts = name.split('/')
+                    if name.startswith('/') or '..' in parts or ':' in parts[0]:
+                        return None, 'Invalid path in the wheel: ' + info.filename
+                    destPath = os.path.join(tempDir, *parts)
+                    if not mkDirs(os.path.dirname(destPath)):
+                        return None, 'Failed to create ' + os.path.dirname(destPath)
+                    with wheelFile.open(info) as source, open(destPath, 'wb') as destFile:
+                        shutil.copyfileobj(source, destFile, 1024 * 1024)
+            if os.path.isdir(extractDir):
+                shutil.rmtree(tempDir)  # Extracted by a concurrent build
+            else:
+                os.rename(tempDir, extractDir)
+        except (IOError, OSError, zipfile.BadZipfile) as e:
+            shutil.rmtree(tempDir, ignore_errors=True)
+            return None, str(e)
+        return extractDir, True
+
+    def extract(self, wheels):
+        """>>> extract(wheels) -> list of paths or None
+        Extract the wheels in parallel into the cache and return the
+        directories with their contents, in the order of 'wheels'.
+        """
+        if not mkDirs(self.cacheDir):
+            self.logger.error('Failed to create the wheel cache directory {path}'
+                              .format(path=self.cacheDir))
+            return None
+        self.hashWheels(wheels)
+        if self.jobs > 1 and len(wheels) > 1:
+            pool = ThreadPool(min(self.jobs, len(wheels)))
+            try:
+                results = pool.map(self._extract, wheels)
+            finally:
+                pool.close()
+        else:
+            results = [self._extract(wheel) for wheel in wheels]
+        paths = []
+        for wheel, (path, result) in zip(wheels, results):
+            if path is None:
+                self.logger.error('Failed to extract {path}: {msg}'
+                                  .format(path=wheel.path, msg=result))
+                return None
+            self.logger.verbose('{action} {name} {version}', name=wheel.name,
+                                version=wheel.version,
+                                action='Extracted' if result else 'Reusing the extracted')
+            paths.append(path)
+        return paths